@@ -13,7 +13,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
 import eventlet
+import netaddr
 import socket
 import sys
 import threading
@@ -40,6 +43,8 @@ from neutron.plugins.ovsvapp.common import utils
 from neutron.plugins.ovsvapp.drivers import manager
 from neutron.plugins.ovsvapp.utils import resource_util
 from oslo.config import cfg
+from oslo import messaging
+import six
 from six import moves
 
 
@@ -95,7 +100,149 @@ SECURITYGROUP_OPTS = [
                help=_("<security_bridge>:<phy_interface>")),
     cfg.BoolOpt('defer_apply',
                 default=True,
-                help=_('Enable defer_apply on security bridge')),
+                help=_('Enable defer_apply on security bridge. Port filter '
+                       'operations are queued while firewall updates are '
+                       'deferred, redundant ones are dropped and the rest '
+                       'are applied as one batch')),
+    cfg.BoolOpt('port_range_compression',
+                default=True,
+                help=_('Install TCP/UDP port ranges as the smallest set of '
+                       'value/mask matches instead of one flow per port')),
+    cfg.BoolOpt('use_conjunction',
+                default=False,
+                help=_('Install rules which combine many remote prefixes '
+                       'with many port ranges as conjunctive matches. '
+                       'Requires Open vSwitch 2.4 or later')),
+    cfg.StrOpt('cookie_state_file',
+               default='$state_path/ovsvapp-sg-cookies.json',
+               help=_('File where the security bridge flow cookie of '
+                      'every port is persisted across agent restarts')),
+    cfg.IntOpt('stale_flow_timeout',
+               default=300,
+               help=_('Seconds after a restart in agent_maintenance mode '
+                      'before flows of ports that were not refreshed are '
+                      'deleted from the security bridge')),
+    cfg.BoolOpt('use_bundle',
+                default=False,
+                help=_('Apply batched security bridge flow mods as one '
+                       'atomic OpenFlow bundle. Requires Open vSwitch 2.6 '
+                       'or later with OpenFlow14 enabled on the bridge')),
+    cfg.StrOpt('flow_backend',
+               default='ofctl',
+               help=_('How security bridge flows are programmed: ofctl '
+                      'runs ovs-ofctl, native sends OpenFlow messages over '
+                      'the bridge management socket and falls back to '
+                      'ovs-ofctl for flows it cannot encode')),
+    cfg.BoolOpt('shared_rule_tables',
+                default=False,
+                help=_('Install the rule flows of ports with the same '
+                       'security group rules once in shared tables, and '
+                       'classify each port into them by a register tag')),
+    cfg.BoolOpt('address_set_tables',
+                default=False,
+                help=_('Match remote security group members through '
+                       'address set tables instead of expanding every '
+                       'member address into the rules of every port')),
+    cfg.IntOpt('rule_cache_size',
+               default=256,
+               help=_('Number of distinct security group rule lists whose '
+                      'compiled flows are cached for reuse by every port '
+                      'with the same rules, 0 to disable the cache')),
+    cfg.BoolOpt('normalize_rules',
+                default=True,
+                help=_('Drop duplicate security group rules and rules '
+                       'covered by a broader rule, and merge the remote '
+                       'prefixes of otherwise equal rules before their '
+                       'flows are built')),
+    cfg.BoolOpt('pipeline_tables',
+                default=False,
+                help=_('Dispatch packets by direction from table 0 into '
+                       'separate ingress and egress tables holding the '
+                       'port flows, which match on VLAN and MAC only. '
+                       'Ports are moved between layouts as they are '
+                       'refreshed after an agent_maintenance restart')),
+    cfg.BoolOpt('learned_flow_cookies',
+                default=False,
+                help=_('Install the connection learning flows per port, so '
+                       'that learned flows carry the cookie of their port '
+                       'and all flows of a port are deleted by cookie. '
+                       'Adds twelve flows per port')),
+    cfg.IntOpt('learn_table_flow_limit',
+               default=0,
+               help=_('Maximum number of learned connection flows on the '
+                      'security bridge, 0 for no limit. When reached Open '
+                      'vSwitch evicts the learned flows closest to expiry '
+                      'from the largest group of flows between the same '
+                      'pair of ports')),
+    cfg.IntOpt('learn_table_port_flow_limit',
+               default=0,
+               help=_('Maximum number of learned connection flows of a '
+                      'single port, 0 for no limit. The learned flows of a '
+                      'port found above the limit when sampling are '
+                      'flushed')),
+    cfg.IntOpt('learn_table_sample_interval',
+               default=60,
+               help=_('Seconds between samplings of the learned connection '
+                      'flows of the security bridge, 0 to disable')),
+    cfg.BoolOpt('lazy_other_host_filters',
+                default=False,
+                help=_('Keep the port filters of VMs on other hosts of the '
+                       'cluster in memory only, and install their flows '
+                       'when a VM moves to this host. Reduces the flows '
+                       'of the security bridge to the ports of this host, '
+                       'at the cost of a short delay after vMotion')),
+    cfg.IntOpt('flow_reconcile_interval',
+               default=60,
+               help=_('Seconds between checks of the security bridge flows '
+                      'of the next range of ports against the flows the '
+                      'agent installed, repairing missing or extra flows. '
+                      '0 to disable')),
+    cfg.IntOpt('flow_reconcile_batch_size',
+               default=64,
+               help=_('Number of ports and shared rule sets whose flows '
+                      'are checked per flow reconciliation')),
+    cfg.IntOpt('flow_reconcile_max_repairs',
+               default=8,
+               help=_('Maximum number of ports and shared rule sets whose '
+                      'flows are repaired per flow reconciliation, 0 for '
+                      'no limit')),
+    cfg.FloatOpt('rpc_batch_target_seconds',
+                 default=1.0,
+                 help=_('Targeted duration of a security group rules RPC, '
+                        'which sizes the batches of devices fetched')),
+    cfg.IntOpt('rpc_batch_max_size',
+               default=100,
+               help=_('Maximum number of devices whose security group '
+                      'rules are fetched per RPC')),
+    cfg.IntOpt('rpc_batch_max_rules',
+               default=20000,
+               help=_('Approximate maximum number of security group rules '
+                      'returned per RPC, 0 for no limit')),
+    cfg.IntOpt('rpc_max_in_flight',
+               default=2,
+               help=_('Maximum number of security group rules RPCs in '
+                      'flight while port filters are programmed')),
+    cfg.BoolOpt('security_group_info_rpc',
+                default=True,
+                help=_('Fetch the security groups of ports with the '
+                       'compact security_group_info_for_devices RPC and '
+                       'expand their rules locally, falling back to '
+                       'security_group_rules_for_devices on servers '
+                       'without it')),
+    cfg.BoolOpt('security_group_cache',
+                default=False,
+                help=_('Keep the security groups fetched with '
+                       'security_group_info_rpc, so that only the security '
+                       'groups which changed are fetched again')),
+    cfg.FloatOpt('refresh_coalesce_min_delay',
+                 default=1.0,
+                 help=_('Seconds without security group or port update '
+                        'notifications before the affected port filters '
+                        'are refreshed, merging bursts into one refresh')),
+    cfg.FloatOpt('refresh_coalesce_max_delay',
+                 default=10.0,
+                 help=_('Maximum seconds a refresh of port filters is '
+                        'delayed after the first notification it merges')),
 ]
 
 cfg.CONF.register_opts(OVSVAPP_OPTS, "OVSVAPP")
@@ -116,6 +263,21 @@ ports_dict = {}
 ovsvapplock = threading.RLock()
 network_port_count = {}
 
+# Classes of firewall work, most urgent first
+FW_PRIORITY_BOOT = 0
+FW_PRIORITY_LOCAL_UPDATE = 1
+FW_PRIORITY_OTHER_HOST = 2
+FW_PRIORITY_RESYNC = 3
+FW_PRIORITIES = (FW_PRIORITY_BOOT, FW_PRIORITY_LOCAL_UPDATE,
+                 FW_PRIORITY_OTHER_HOST, FW_PRIORITY_RESYNC)
+# Initial number of devices per security group rules RPC
+FW_WORK_CHUNK_SIZE = 10
+# Weight of the last RPC in the moving averages of RpcBatchSizer
+RPC_COST_WEIGHT = 0.3
+# Rule key of the remote addresses, by direction
+SG_PREFIX_KEYS = {'ingress': 'source_ip_prefix',
+                  'egress': 'dest_ip_prefix'}
+
 
 class portCache():
     def __init__(self):
@@ -138,6 +300,284 @@ class portInfo():
         self.vm_uuid = vm_uuid
 
 
+class FirewallWorkQueue(object):
+    """Port filter work of devices, by priority class.
+
+    A device is queued once, in the most urgent class it was queued
+    with. Preparing its filter supersedes updating it, and the port
+    details queued last are used, None meaning they are fetched.
+    """
+
+    def __init__(self):
+        self.classes = dict((priority, collections.OrderedDict())
+                            for priority in FW_PRIORITIES)
+        self.priorities = {}
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def add(self, device_ids, priority, op, ports=None):
+        for device_id in device_ids:
+            port = ports.get(device_id) if ports else None
+            old_priority = self.priorities.get(device_id)
+            if old_priority is not None:
+                old_op, _old_port = self.classes[old_priority].pop(device_id)
+                if old_op == 'prepare':
+                    op = 'prepare'
+                priority = min(priority, old_priority)
+            self.classes[priority][device_id] = (op, port)
+            self.priorities[device_id] = priority
+
+    def pop(self, count, max_priority=None):
+        """Pop up to count devices of the most urgent class.
+
+        Returns the priority and a list of (device_id, op, port) tuples,
+        or None when nothing up to max_priority is queued.
+        """
+        for priority in FW_PRIORITIES:
+            if max_priority is not None and priority > max_priority:
+                break
+            work = self.classes[priority]
+            if not work:
+                continue
+            items = []
+            while work and len(items) < count:
+                device_id, (op, port) = work.popitem(last=False)
+                del self.priorities[device_id]
+                items.append((device_id, op, port))
+            return priority, items
+        return None
+
+
+class RpcBatchSizer(object):
+    """Number of devices to fetch per security group rules RPC.
+
+    The moving averages of the seconds and rules per device of the
+    RPCs made size the batch to take rpc_batch_target_seconds and to
+    return at most rpc_batch_max_rules rules. The size at most doubles
+    per RPC, so one fast RPC does not make the next one huge.
+    """
+
+    def __init__(self, size=FW_WORK_CHUNK_SIZE):
+        self.size = size
+        self.device_seconds = None
+        self.device_rules = None
+
+    @staticmethod
+    def _average(average, value):
+        if average is None:
+            return value
+        return (1 - RPC_COST_WEIGHT) * average + RPC_COST_WEIGHT * value
+
+    def record(self, devices, seconds, rules):
+        if not devices:
+            return
+        sg_conf = CONF.SECURITYGROUP
+        self.device_seconds = self._average(self.device_seconds,
+                                            seconds / devices)
+        self.device_rules = self._average(self.device_rules,
+                                          float(rules) / devices)
+        size = min(sg_conf.rpc_batch_max_size, self.size * 2)
+        if self.device_seconds > 0:
+            size = min(size, sg_conf.rpc_batch_target_seconds /
+                       self.device_seconds)
+        if sg_conf.rpc_batch_max_rules and self.device_rules > 0:
+            size = min(size, sg_conf.rpc_batch_max_rules / self.device_rules)
+        self.size = max(1, int(size))
+
+
+class SecurityGroupCache(object):
+    """Security groups of the filtered devices, kept by the agent.
+
+    Devices with their security groups and provider rules, the rules of
+    security groups and the member addresses of remote groups are
+    cached as returned by security_group_info_for_devices. The expanded
+    rules of a device are computed locally, so that only the security
+    groups invalidated by an update are fetched again.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.sg_rules = {}
+        # Member addresses of remote groups, by ethertype
+        self.sg_member_ips = {}
+        # Devices by security group, the remote groups of the last rules
+        # of a security group and the groups referencing a remote group
+        self.sg_devices = {}
+        self.sg_remote_groups = {}
+        self.remote_group_refs = {}
+
+    def clear(self):
+        self.devices.clear()
+        self.sg_rules.clear()
+        self.sg_member_ips.clear()
+        self.sg_devices.clear()
+        self.sg_remote_groups.clear()
+        self.remote_group_refs.clear()
+
+    def update(self, sg_info):
+        unused = set()
+        for device_id, device in (sg_info.get('devices') or
+                                  {}).iteritems():
+            unused |= self._unindex_device(device_id)
+            self.devices[device_id] = device
+            for sg_id in device.get('security_groups') or []:
+                self.sg_devices.setdefault(sg_id, set()).add(device_id)
+        for sg_id, rules in (sg_info.get('security_groups') or
+                             {}).iteritems():
+            self.sg_rules[sg_id] = rules
+            # Kept only while a device uses it
+            unused.add(sg_id)
+            unused |= self._index_remote_groups(sg_id, set(
+                rule['remote_group_id'] for rule in rules
+                if rule.get('remote_group_id')))
+        for sg_id, member_ips in (sg_info.get('sg_member_ips') or
+                                  {}).iteritems():
+            self.sg_member_ips.setdefault(sg_id, {}).update(member_ips)
+        self._drop_unused(unused)
+
+    def invalidate_rules(self, sg_ids):
+        for sg_id in sg_ids:
+            self.sg_rules.pop(sg_id, None)
+
+    def invalidate_members(self, sg_ids):
+        for sg_id in sg_ids:
+            self.sg_member_ips.pop(sg_id, None)
+
+    def remove_devices(self, device_ids):
+        """Forget devices, and the security groups left unused."""
+        unused = set()
+        for device_id in device_ids:
+            unused |= self._unindex_device(device_id)
+            self.devices.pop(device_id, None)
+        self._drop_unused(unused)
+
+    def _unindex_device(self, device_id):
+        """Return the security groups left without devices."""
+        device = self.devices.get(device_id)
+        if device is None:
+            return set()
+        unused = set()
+        for sg_id in device.get('security_groups') or []:
+            devices = self.sg_devices.get(sg_id)
+            if devices is None:
+                continue
+            devices.discard(device_id)
+            if not devices:
+                del self.sg_devices[sg_id]
+                unused.add(sg_id)
+        return unused
+
+    def _index_remote_groups(self, sg_id, remote_ids):
+        """Return the remote groups no longer referenced by sg_id."""
+        old_remote_ids = self.sg_remote_groups.pop(sg_id, set())
+        if remote_ids:
+            self.sg_remote_groups[sg_id] = remote_ids
+        for remote_id in remote_ids - old_remote_ids:
+            self.remote_group_refs.setdefault(remote_id, set()).add(sg_id)
+        unused = set()
+        for remote_id in old_remote_ids - remote_ids:
+            refs = self.remote_group_refs[remote_id]
+            refs.discard(sg_id)
+            if not refs:
+                del self.remote_group_refs[remote_id]
+                unused.add(remote_id)
+        return unused
+
+    def _is_used(self, sg_id):
+        return sg_id in self.sg_devices or any(
+            ref in self.sg_devices
+            for ref in self.remote_group_refs.get(sg_id, ()))
+
+    def _drop_unused(self, sg_ids):
+        """Drop the cached groups of sg_ids used by no device anymore.
+
+        A group is used by its devices, and as remote group by the
+        devices of the groups whose rules reference it.
+        """
+        for sg_id in list(sg_ids):
+            sg_ids |= self.sg_remote_groups.get(sg_id, set())
+        for sg_id in sg_ids:
+            if self._is_used(sg_id):
+                continue
+            self.sg_rules.pop(sg_id, None)
+            self.sg_member_ips.pop(sg_id, None)
+            self._index_remote_groups(sg_id, set())
+
+    def _get_keys(self, device):
+        """Return the security groups and remote groups of a device."""
+        keys = set()
+        for sg_id in device.get('security_groups') or []:
+            keys.add(('rules', sg_id))
+            for rule in self.sg_rules.get(sg_id, []):
+                if rule.get('remote_group_id'):
+                    keys.add(('members', rule['remote_group_id'],
+                              rule.get('ethertype')))
+        return keys
+
+    def _is_cached(self, key):
+        if key[0] == 'rules':
+            return key[1] in self.sg_rules
+        return key[2] in self.sg_member_ips.get(key[1], {})
+
+    def get_devices_to_fetch(self, device_ids):
+        """Return the devices to fetch to compute the rules of devices.
+
+        Devices not cached are fetched. Of the cached devices missing
+        security groups, only one device per missing group is fetched.
+        """
+        fetch = []
+        covered = set()
+        for device_id in device_ids:
+            device = self.devices.get(device_id)
+            if device is None:
+                fetch.append(device_id)
+                continue
+            keys = self._get_keys(device)
+            missing = set(key for key in keys if not self._is_cached(key))
+            if missing - covered:
+                fetch.append(device_id)
+                covered |= keys
+        return fetch
+
+    def get_device(self, device_id):
+        """Return a device with its expanded rules, None if unknown."""
+        device = self.devices.get(device_id)
+        if device is None:
+            return None
+        if not all(self._is_cached(key) for key in self._get_keys(device)):
+            return None
+        own_ips = set(device.get('fixed_ips') or [])
+        rules = []
+        seen = set()
+        source_groups = set()
+        for sg_id in device.get('security_groups') or []:
+            for rule in self.sg_rules[sg_id]:
+                remote_group_id = rule.get('remote_group_id')
+                if not remote_group_id:
+                    self._add_rule(rules, seen, rule)
+                    continue
+                source_groups.add(remote_group_id)
+                prefix_key = SG_PREFIX_KEYS[rule['direction']]
+                for ip in self.sg_member_ips[remote_group_id][
+                        rule.get('ethertype')]:
+                    if ip in own_ips:
+                        continue
+                    self._add_rule(rules, seen, dict(rule, **{
+                        prefix_key: str(netaddr.IPNetwork(ip).cidr)}))
+        for rule in device.get('security_group_rules') or []:
+            self._add_rule(rules, seen, rule)
+        return dict(device, security_group_rules=rules,
+                    security_group_source_groups=sorted(source_groups))
+
+    @staticmethod
+    def _add_rule(rules, seen, rule):
+        key = tuple(sorted(rule.iteritems()))
+        if key not in seen:
+            seen.add(key)
+            rules.append(rule)
+
+
 class OVSVAppSecurityGroupAgent(ovs_agent.OVSSecurityGroupAgent):
     """
     OVSvApp derived class for OVSSecurityGroupAgent to override
@@ -148,67 +588,382 @@ class OVSVAppSecurityGroupAgent(ovs_agent.OVSSecurityGroupAgent):
         self.plugin_rpc = plugin_rpc
         self.root_helper = root_helper
         self.init_firewall(defer_apply)
+        self.work_queue = FirewallWorkQueue()
+        self._processing_work = False
+        # Sent when the queue processing pass in progress ends
+        self._work_done = eventlet.event.Event()
+        self._work_done.send()
+        self._work_thread = None
+        self.rpc_batch_sizer = RpcBatchSizer()
+        self.sg_cache = SecurityGroupCache()
+        # Cleared when the server lacks security_group_info_for_devices
+        self.sg_info_rpc_supported = True
+        # Notifications merged into the next refresh, and when the first
+        # and the last of them were received
+        self._refresh_notifications = 0
+        self._refresh_first_notified = None
+        self._refresh_last_notified = None
+        self.refresh_stats = {'refreshes': 0,
+                              'notifications': 0,
+                              'max_absorbed': 0}
+        # Devices of VMs on other hosts, filtered lazily when enabled
+        self.other_host_devices = set()
         LOG.info(_("OVSVAppSecurityGroupAgent initialized"))
 
+    @contextlib.contextmanager
+    def firewall_batch(self):
+        """Apply the port filter calls in the block at once.
+
+        The calls are deferred, so that the firewall can collapse them,
+        and their flows are applied as one batch.
+        """
+        batch_apply = getattr(self.firewall, 'batch_apply', None)
+        if batch_apply is None:
+            with self.firewall.defer_apply():
+                yield
+            return
+        start = time.time()
+        with batch_apply():
+            with self.firewall.defer_apply():
+                yield
+        LOG.debug("Firewall batch applied in %.3f seconds",
+                  time.time() - start)
+
     def add_devices_to_filter(self, devices):
         if not devices:
             return
         self.firewall.add_ports_to_filter(devices)
 
     def ovsvapp_sg_update(self, port_rules):
-        for port in port_rules:
-            if port in self.firewall.ports:
-                self.firewall.prepare_port_filter(port_rules[port])
+        """Filter the ports of a VM booting on this host right away."""
+        device_ids = [port for port in port_rules
+                      if port in self.firewall.ports]
+        self.queue_port_filters(device_ids, FW_PRIORITY_BOOT, 'prepare',
+                                port_rules)
+        self.process_work_queue(FW_PRIORITY_BOOT)
+
+    def queue_port_filters(self, device_ids, priority, op='update',
+                           ports=None):
+        """Queue preparing or updating the filters of devices.
+
+        :param priority: one of the FW_PRIORITY classes
+        :param op: 'prepare' or 'update'
+        :param ports: port details by device id, fetched when missing
+        """
+        if not device_ids:
+            return
+        ovsvapplock.acquire()
+        try:
+            self.work_queue.add(device_ids, priority, op, ports)
+        finally:
+            ovsvapplock.release()
+
+    def firewall_work_pending(self):
+        return bool(self.work_queue) or self._processing_work
+
+    def process_work_queue(self, max_priority=None):
+        """Apply the queued port filter work, most urgent class first.
+
+        The security group rules of the next chunks of work are fetched,
+        with up to rpc_max_in_flight RPCs, while the filters of the
+        current chunk are programmed. Chunks are sized by the cost of
+        the RPCs, so urgent work queued meanwhile waits for the chunks
+        in flight only. When another greenthread is already processing
+        the queue, this call waits for its pass to end and applies the
+        work left, so the queued work is applied on return. The caller
+        must not hold ovsvapplock, which that pass needs.
+        """
+        if self._work_thread is eventlet.getcurrent():
+            # Called back from the pass in progress, which goes on
+            # with the new work
+            return
+        while self._processing_work:
+            self._work_done.wait()
+        self._processing_work = True
+        self._work_done = eventlet.event.Event()
+        self._work_thread = eventlet.getcurrent()
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < max(1, CONF.SECURITYGROUP.
+                                         rpc_max_in_flight):
+                    work = self._pop_work(max_priority)
+                    if not work:
+                        break
+                    priority, items = work
+                    pending.append((priority, items, eventlet.spawn(
+                        self._fetch_port_rules, items)))
+                if not pending:
+                    break
+                priority, items, fetch = pending.popleft()
+                devices, exc_info = fetch.wait()
+                if exc_info:
+                    # Keep the work of the failed and pending chunks
+                    self._requeue_work([(priority, items)] + [
+                        (chunk[0], chunk[1]) for chunk in pending])
+                    for chunk in pending:
+                        chunk[2].kill()
+                    pending.clear()
+                    six.reraise(*exc_info)
+                LOG.debug("Applying firewall work of priority %(priority)s "
+                          "for %(devices)s devices, %(left)s queued",
+                          {'priority': priority, 'devices': len(items),
+                           'left': len(self.work_queue)})
+                self._apply_work(items, devices)
+        finally:
+            self._processing_work = False
+            self._work_thread = None
+            self._work_done.send()
+
+    def _pop_work(self, max_priority):
+        ovsvapplock.acquire()
+        try:
+            return self.work_queue.pop(self.rpc_batch_sizer.size,
+                                       max_priority)
+        finally:
+            ovsvapplock.release()
+
+    def _requeue_work(self, chunks):
+        ovsvapplock.acquire()
+        try:
+            for priority, items in chunks:
+                for device_id, op, port in items:
+                    # Port details queued meanwhile are newer
+                    queued = self.work_queue.priorities.get(device_id)
+                    if queued is not None:
+                        port = self.work_queue.classes[queued][device_id][1]
+                    self.work_queue.add(
+                        [device_id], priority, op,
+                        {device_id: port} if port else None)
+        finally:
+            ovsvapplock.release()
+
+    def _fetch_port_rules(self, items):
+        """Return the details of the devices to fetch and the error."""
+        device_ids = [device_id for device_id, op, port in items
+                      if port is None]
+        if not device_ids:
+            return {}, None
+        try:
+            devices = None
+            if (CONF.SECURITYGROUP.security_group_info_rpc and
+                    self.sg_info_rpc_supported):
+                devices = self._get_sg_info_port_rules(device_ids)
+            if devices is None:
+                start = time.time()
+                devices = self.plugin_rpc.security_group_rules_for_devices(
+                    self.context, device_ids)
+                self.rpc_batch_sizer.record(
+                    len(device_ids), time.time() - start,
+                    sum(len(device.get('security_group_rules') or [])
+                        for device in devices.itervalues()))
+        except Exception:
+            # Raised by the caller of process_work_queue
+            return None, sys.exc_info()
+        return devices, None
+
+    def _get_sg_info_port_rules(self, device_ids):
+        """Expand the port rules of the compact security group info.
+
+        Returns None when the server does not support the RPC.
+        """
+        sg_cache = self.sg_cache
+        if not CONF.SECURITYGROUP.security_group_cache:
+            sg_cache = SecurityGroupCache()
+        fetch_ids = sg_cache.get_devices_to_fetch(device_ids)
+        if fetch_ids:
+            start = time.time()
+            try:
+                sg_info = self.plugin_rpc.security_group_info_for_devices(
+                    self.context, fetch_ids)
+            except (messaging.UnsupportedVersion, messaging.NoSuchMethod):
+                LOG.warning(_("Server does not support "
+                              "security_group_info_for_devices, using "
+                              "security_group_rules_for_devices"))
+                self.sg_info_rpc_supported = False
+                return None
+            sg_cache.update(sg_info)
+            self.rpc_batch_sizer.record(
+                len(fetch_ids), time.time() - start,
+                sum(len(rules) for rules in
+                    (sg_info.get('security_groups') or {}).itervalues()) +
+                sum(len(ips) for member_ips in
+                    (sg_info.get('sg_member_ips') or {}).itervalues()
+                    for ips in member_ips.itervalues()))
+        LOG.debug("Fetched the security groups of %(fetched)s devices to "
+                  "filter %(devices)s devices",
+                  {'fetched': len(fetch_ids), 'devices': len(device_ids)})
+        devices = {}
+        for device_id in device_ids:
+            device = sg_cache.get_device(device_id)
+            if device:
+                devices[device_id] = device
+        return devices
+
+    def _apply_work(self, items, devices):
+        with self.firewall_batch():
+            for device_id, op, port in items:
+                port = port or devices.get(device_id)
+                if not port:
+                    continue
+                if self._is_lazy(device_id):
+                    self.firewall.stage_port_filter(port)
+                elif op == 'prepare':
+                    self.firewall.prepare_port_filter(port)
+                else:
+                    self.firewall.update_port_filter(port)
+
+    def remove_stale_filters(self):
+        """Drop firewall leftovers of devices gone during a restart."""
+        remove_stale_flows = getattr(self.firewall, 'remove_stale_flows',
+                                     None)
+        if remove_stale_flows:
+            remove_stale_flows()
+
+    def sample_learn_table(self):
+        """Sample the learned flows of the firewall, if it learns any."""
+        sample_learn_table = getattr(self.firewall, 'sample_learn_table',
+                                     None)
+        if sample_learn_table:
+            sample_learn_table()
+
+    def reconcile_flows(self):
+        """Repair drifted firewall flows, if the firewall supports it."""
+        reconcile_flows = getattr(self.firewall, 'reconcile_flows', None)
+        if reconcile_flows:
+            reconcile_flows()
 
     def remove_devices_filter(self, device_id):
         if not device_id:
             return
         LOG.info(_("Remove device filter for %r"), device_id)
         self.firewall.remove_port_filter(device_id)
+        self.sg_cache.remove_devices([device_id])
+
+    def _is_lazy(self, device_id):
+        return (CONF.SECURITYGROUP.lazy_other_host_filters and
+                device_id in self.other_host_devices and
+                hasattr(self.firewall, 'stage_port_filter'))
+
+    def activate_port_filters(self, device_ids):
+        """Install the staged filters of devices whose VM moved here."""
+        pop_staged_port = getattr(self.firewall, 'pop_staged_port', None)
+        if (not CONF.SECURITYGROUP.lazy_other_host_filters or
+                not pop_staged_port):
+            return
+        ports = {}
+        for device_id in device_ids:
+            port = pop_staged_port(device_id)
+            if port:
+                ports[device_id] = port
+        if not ports:
+            return
+        LOG.info(_("Installing the staged filters of %d devices"),
+                 len(ports))
+        self.queue_port_filters(ports.keys(), FW_PRIORITY_BOOT, 'prepare',
+                                ports)
+        self.process_work_queue(FW_PRIORITY_BOOT)
+
+    def deactivate_port_filters(self, device_ids):
+        """Stage the filters of devices whose VM moved to another host."""
+        if not CONF.SECURITYGROUP.lazy_other_host_filters:
+            return
+        device_ids = [device_id for device_id in device_ids
+                      if device_id in self.firewall.ports]
+        self.queue_port_filters(device_ids, FW_PRIORITY_OTHER_HOST,
+                                'prepare')
 
-    def prepare_firewall(self, device_ids):
+    def prepare_firewall(self, device_ids,
+                         priority=FW_PRIORITY_OTHER_HOST):
         LOG.info(_("Prepare firewall rules %s"), len(device_ids))
-        dev_list = list(device_ids)
-        if len(dev_list) > 10:
-            sublists = [dev_list[x:x + 10] for x in xrange(0, len(dev_list),
-                                                           10)]
-        else:
-            sublists = [dev_list]
-        for dev_ids in sublists:
-            devices = self.plugin_rpc.security_group_rules_for_devices(
-                self.context, dev_ids)
-            for device in devices.values():
-                if device['id'] in dev_ids:
-                    self.firewall.prepare_port_filter(device)
-
-    def refresh_firewall(self, device_ids=None):
+        self.queue_port_filters(device_ids, priority, 'prepare')
+        self.process_work_queue()
+
+    def refresh_firewall(self, device_ids=None,
+                         priority=FW_PRIORITY_LOCAL_UPDATE):
         LOG.info(_("Refresh firewall rules"))
         if not device_ids:
+            # Fetch everything again on a full refresh
+            self.sg_cache.clear()
             device_ids = self.firewall.ports.keys()
             if not device_ids:
                 LOG.info(_("No ports here to refresh firewall"))
                 return
-        dev_list = list(device_ids)
-        if len(dev_list) > 10:
-            sublists = [dev_list[x:x + 10] for x in xrange(0, len(dev_list),
-                                                           10)]
-        else:
-            sublists = [dev_list]
-
-        for dev_ids in sublists:
-            devices = self.plugin_rpc.security_group_rules_for_devices(
-                self.context, dev_ids)
-            for device in devices.values():
-                if device['id'] in dev_ids:
-                    self.firewall.update_port_filter(device)
+            priority = FW_PRIORITY_RESYNC
+        self.queue_port_filters(device_ids, priority)
+        self.process_work_queue()
 
     def _security_group_updated(self, security_groups, attribute):
         ovsvapplock.acquire()
         try:
-            super(OVSVAppSecurityGroupAgent, self)._security_group_updated(
-                security_groups, attribute)
+            if attribute == 'security_groups':
+                self.sg_cache.invalidate_rules(security_groups)
+            else:
+                self.sg_cache.invalidate_members(security_groups)
+            devices = self._get_security_group_devices(security_groups,
+                                                       attribute)
+            if not devices:
+                return
+            if self.defer_refresh_firewall:
+                self.devices_to_refilter |= devices
+                # Only notifications leaving a refresh pending count
+                self.record_refresh_notification()
+                return
+        finally:
+            ovsvapplock.release()
+        # Outside of the lock, which the work queue pass in progress
+        # needs to finish before this refresh is processed
+        self.refresh_firewall(devices)
+
+    def _get_security_group_devices(self, security_groups, attribute):
+        """Return the filtered devices using security_groups."""
+        get_ports = getattr(self.firewall,
+                            'get_ports_for_security_groups', None)
+        if get_ports is not None:
+            # Only the ports indexed under the groups are affected
+            return get_ports(security_groups, attribute)
+        security_groups = set(security_groups)
+        return set(device['device']
+                   for device in self.firewall.ports.itervalues()
+                   if security_groups & set(device.get(attribute) or []))
+
+    def security_groups_provider_updated(self):
+        ovsvapplock.acquire()
+        try:
+            self.record_refresh_notification()
         finally:
             ovsvapplock.release()
+        super(OVSVAppSecurityGroupAgent,
+              self).security_groups_provider_updated()
+
+    def record_refresh_notification(self):
+        """Account a notification merged into the next refresh."""
+        if not self.defer_refresh_firewall:
+            return
+        now = time.time()
+        if self._refresh_first_notified is None:
+            self._refresh_first_notified = now
+        self._refresh_last_notified = now
+        self._refresh_notifications += 1
+
+    def firewall_refresh_needed(self):
+        """Whether the refresh of the notified devices is due.
+
+        The refresh waits for refresh_coalesce_min_delay seconds without
+        notification, but no longer than refresh_coalesce_max_delay
+        seconds after the first one, so that bursts are merged.
+        """
+        if not super(OVSVAppSecurityGroupAgent,
+                     self).firewall_refresh_needed():
+            return False
+        if self._refresh_first_notified is None:
+            return True
+        sg_conf = CONF.SECURITYGROUP
+        now = time.time()
+        return (now - self._refresh_last_notified >=
+                sg_conf.refresh_coalesce_min_delay or
+                now - self._refresh_first_notified >=
+                sg_conf.refresh_coalesce_max_delay)
 
     def prepare_port_filters(self, own_devices, other_devices):
         """Configure port filters for devices.
@@ -225,11 +980,14 @@ class OVSVAppSecurityGroupAgent(ovs_agent.OVSSecurityGroupAgent):
         if own_devices:
             LOG.info(_("Preparing firewall for %d devices")
                      % len(own_devices))
-            self.prepare_firewall(own_devices)
+            self.queue_port_filters(own_devices, FW_PRIORITY_BOOT,
+                                    'prepare')
         if other_devices:
             LOG.info(_("Preparing firewall for %d devices")
                      % len(other_devices))
-            self.prepare_firewall(other_devices)
+            self.queue_port_filters(other_devices, FW_PRIORITY_OTHER_HOST,
+                                    'prepare')
+        self.process_work_queue()
 
     def refresh_port_filters(self, own_devices, other_devices):
         """Update port filters for devices.
@@ -251,26 +1009,39 @@ class OVSVAppSecurityGroupAgent(ovs_agent.OVSSecurityGroupAgent):
             global_refresh_firewall = self.global_refresh_firewall
             self.devices_to_refilter = set()
             self.global_refresh_firewall = False
-            LOG.info(_("Going to refresh for devices: %s")
-                     % devices_to_refilter)
+            notifications = self._refresh_notifications
+            self._refresh_notifications = 0
+            self._refresh_first_notified = None
+            self._refresh_last_notified = None
+            self.refresh_stats['refreshes'] += 1
+            self.refresh_stats['notifications'] += notifications
+            self.refresh_stats['max_absorbed'] = max(
+                self.refresh_stats['max_absorbed'], notifications)
+            LOG.info(_("Going to refresh for devices: %(devices)s, "
+                       "merging %(notifications)s notifications"),
+                     {'devices': devices_to_refilter,
+                      'notifications': notifications})
         finally:
             ovsvapplock.release()
         if global_refresh_firewall:
+            # Filters are updated in place, other hosts ones included
             LOG.debug(_("Refreshing firewall for all filtered devices"))
-            self.firewall.clean_port_filters(other_devices)
             self.refresh_firewall()
-        else:
-            own_devices = (own_devices & devices_to_refilter)
-            other_devices = (other_devices & devices_to_refilter)
+            return
+        own_devices = (own_devices & devices_to_refilter)
+        other_devices = (other_devices & devices_to_refilter)
+        with self.firewall_batch():
             self.firewall.clean_port_filters(other_devices)
-            if own_devices:
-                LOG.info(_("Refreshing firewall for %d devices")
-                         % len(own_devices))
-                self.refresh_firewall(own_devices)
-            if other_devices:
-                LOG.info(_("Refreshing firewall for %d devices")
-                         % len(other_devices))
-                self.prepare_firewall(other_devices)
+        if own_devices:
+            LOG.info(_("Refreshing firewall for %d devices")
+                     % len(own_devices))
+            self.queue_port_filters(own_devices, FW_PRIORITY_LOCAL_UPDATE)
+        if other_devices:
+            LOG.info(_("Refreshing firewall for %d devices")
+                     % len(other_devices))
+            self.queue_port_filters(other_devices, FW_PRIORITY_OTHER_HOST,
+                                    'prepare')
+        self.process_work_queue()
 
 
 # A class to represent a VIF (i.e., a port that has 'iface-id' and 'vif-mac'
@@ -324,6 +1095,10 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
         self.veth_mtu = CONF.OVSVAPPAGENT.veth_mtu
         self.use_veth_interconnection = False
         self.agent_under_maintenance = CONF.OVSVAPPAGENT.agent_maintenance
+        self.stale_filters_deadline = None
+        if self.agent_under_maintenance:
+            self.stale_filters_deadline = (
+                time.time() + CONF.SECURITYGROUP.stale_flow_timeout)
         self.root_helper = cfg.CONF.AGENT.root_helper
         self.int_br = ovs_lib.OVSBridge(CONF.OVSVAPP.integration_bridge,
                                         self.root_helper)
@@ -342,7 +1117,11 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
                                                   self.plugin_rpc,
                                                   self.root_helper,
                                                   defer_apply)
+        # Shared, so that the firewall follows VMs between hosts
+        self.sg_agent.other_host_devices = self.cluster_other_ports
         self.setup_report_states()
+        self.setup_learn_table_sampling()
+        self.setup_flow_reconciliation()
 
     def init_parameters(self):
         self.tenant_network_type = CONF.OVSVAPP.tenant_network_type
@@ -550,7 +1329,13 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
                             finally:
                                 ovsvapplock.release()
                     if device_list:
-                        self.sg_agent.refresh_firewall(device_list)
+                        own_devices = device_list & self.cluster_host_ports
+                        self.sg_agent.queue_port_filters(
+                            own_devices, FW_PRIORITY_BOOT)
+                        self.sg_agent.queue_port_filters(
+                            device_list - own_devices,
+                            FW_PRIORITY_OTHER_HOST)
+                        self.sg_agent.process_work_queue()
                         LOG.info(_("Processed Ports list: %s") % device_list)
                 except Exception:
                     LOG.exception(_('Exception occurred'))
@@ -561,6 +1346,17 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
             except Exception:
                     LOG.exception(_("Could not invoke "
                                     "firewall_refresh_needed"))
+            try:
+                self.sg_agent.process_work_queue()
+            except Exception:
+                LOG.exception(_("Unable to apply the queued firewall work"))
+            if (self.stale_filters_deadline and
+                    time.time() > self.stale_filters_deadline):
+                self.stale_filters_deadline = None
+                try:
+                    self.sg_agent.remove_stale_filters()
+                except Exception:
+                    LOG.exception(_("Unable to remove stale port filters"))
             self._update_port_bindings()
             time.sleep(2)
 
@@ -799,9 +1595,11 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
     def _notify_device_updated(self, vm, host):
         """Handle VM updated event."""
         try:
+            port_ids = [vnic.port_uuid for vnic in vm.vnics]
             if host == self.esx_hostname:
+                self._add_ports_to_host_ports(port_ids)
+                self.sg_agent.activate_port_filters(port_ids)
                 for vnic in vm.vnics:
-                    self._add_ports_to_host_ports([vnic.port_uuid])
                     LOG.debug(_("Invoking update_port_binding for port %s")
                               % vnic.port_uuid)
                     self.ovsvapp_rpc.update_port_binding(self.context,
@@ -809,8 +1607,8 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
                                                        port_id=vnic.port_uuid,
                                                        host=self.hostname)
             else:
-                for vnic in vm.vnics:
-                    self._add_ports_to_host_ports([vnic.port_uuid], False)
+                self._add_ports_to_host_ports(port_ids, False)
+                self.sg_agent.deactivate_port_filters(port_ids)
 
         except Exception as e:
             LOG.exception(_("Failed to update port bindings for device: %s")
@@ -1099,6 +1897,40 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
             LOG.info(_("report interval is not defined.Cannot send "
                        "heartbeats"))
 
+    def _sample_learn_table(self):
+        try:
+            self.sg_agent.sample_learn_table()
+        except Exception:
+            LOG.exception(_("Unable to sample the learned flows"))
+
+    def setup_learn_table_sampling(self):
+        """Start the looping call sampling the learned flows."""
+        sample_interval = CONF.SECURITYGROUP.learn_table_sample_interval
+        if sample_interval:
+            sampler = loopingcall.FixedIntervalLoopingCall(
+                self._sample_learn_table)
+            sampler.start(interval=sample_interval)
+
+    def _reconcile_flows(self):
+        if (self.refresh_firewall_required or
+                self.sg_agent.firewall_work_pending()):
+            # Port filters are about to be updated, check the next time
+            return
+        try:
+            self.sg_agent.reconcile_flows()
+        except Exception:
+            LOG.exception(_("Unable to reconcile the security bridge "
+                            "flows"))
+
+    def setup_flow_reconciliation(self):
+        """Start the looping call repairing drifted firewall flows."""
+        reconcile_interval = CONF.SECURITYGROUP.flow_reconcile_interval
+        if reconcile_interval:
+            reconciler = loopingcall.FixedIntervalLoopingCall(
+                self._reconcile_flows)
+            reconciler.start(interval=reconcile_interval,
+                             initial_delay=reconcile_interval)
+
     def setup_rpc(self):
         # Ensure that the control exchange is set correctly
         self.agent_id = "ovsvapp-agent %s" % self.hostname
@@ -1426,7 +2258,13 @@ class OVSvAppL2Agent(agent.Agent, ovs_agent.OVSNeutronAgent,
                                                                local_vlan_id)
                 self._port_update_status_change(network, port)
 
-            self.sg_agent.devices_to_refilter.add(new_port['id'])
+            self.sg_agent.sg_cache.remove_devices([new_port['id']])
+            ovsvapplock.acquire()
+            try:
+                self.sg_agent.record_refresh_notification()
+                self.sg_agent.devices_to_refilter.add(new_port['id'])
+            finally:
+                ovsvapplock.release()
             try:
                 if(new_port['admin_state_up']):
                     LOG.debug(_("Invoking update_device_up for %s")
@@ -0,0 +1,501 @@
+# Copyright 2014, Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Minimal OpenFlow 1.0 + Nicira extensions client.
+
+Encodes the subset of ovs-ofctl flow syntax used by the security bridge
+into NXT_FLOW_MOD messages and sends them over the bridge management
+socket. Anything outside that subset raises NotEncodable so that the
+caller can fall back to ovs-ofctl.
+"""
+
+import binascii
+import itertools
+import netaddr
+from neutron.openstack.common import log as logging
+import re
+import socket
+import struct
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+OVS_RUNDIR = '/var/run/openvswitch'
+
+OFP_VERSION = 0x01
+OFP_HEADER = '!BBHI'
+OFP_HEADER_LEN = 8
+
+OFPT_HELLO = 0
+OFPT_ERROR = 1
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_VENDOR = 4
+OFPT_BARRIER_REQUEST = 18
+OFPT_BARRIER_REPLY = 19
+
+OFPFC_ADD = 0
+OFPFC_DELETE = 3
+OFPFC_DELETE_STRICT = 4
+FLOW_MOD_COMMANDS = {'add': OFPFC_ADD,
+                     'del': OFPFC_DELETE,
+                     'del_strict': OFPFC_DELETE_STRICT}
+
+OFPP_IN_PORT = 0xfff8
+OFPP_NORMAL = 0xfffa
+OFPP_NONE = 0xffff
+OFP_NO_BUFFER = 0xffffffff
+OFP_DEFAULT_PRIORITY = 0x8000
+OFPTT_ALL = 0xff
+
+NX_VENDOR_ID = 0x00002320
+NXT_SET_FLOW_FORMAT = 12
+NXT_FLOW_MOD = 13
+NXT_FLOW_MOD_TABLE_ID = 15
+NXFF_NXM = 2
+NX_FLOW_MOD = '!QHHHHIHHH6x'
+
+OFPAT_OUTPUT = 0
+OFPAT_VENDOR = 0xffff
+NXAST_REG_LOAD = 7
+NXAST_RESUBMIT_TABLE = 14
+NXAST_CONJUNCTION = 34
+
+
+def nxm_header(vendor, field, length, masked=False):
+    if masked:
+        return (vendor << 16) | (field << 9) | (1 << 8) | (length * 2)
+    return (vendor << 16) | (field << 9) | length
+
+
+# NXM and OXM fields as (class, field, length)
+NXM_OF_IN_PORT = (0x0000, 0, 2)
+NXM_OF_ETH_DST = (0x0000, 1, 6)
+NXM_OF_ETH_SRC = (0x0000, 2, 6)
+NXM_OF_ETH_TYPE = (0x0000, 3, 2)
+NXM_OF_VLAN_TCI = (0x0000, 4, 2)
+NXM_OF_IP_PROTO = (0x0000, 6, 1)
+NXM_OF_IP_SRC = (0x0000, 7, 4)
+NXM_OF_IP_DST = (0x0000, 8, 4)
+NXM_OF_TCP_SRC = (0x0000, 9, 2)
+NXM_OF_TCP_DST = (0x0000, 10, 2)
+NXM_OF_UDP_SRC = (0x0000, 11, 2)
+NXM_OF_UDP_DST = (0x0000, 12, 2)
+NXM_OF_ICMP_TYPE = (0x0000, 13, 1)
+NXM_OF_ICMP_CODE = (0x0000, 14, 1)
+NXM_NX_REG = [(0x0001, reg, 4) for reg in range(8)]
+NXM_NX_IPV6_SRC = (0x0001, 19, 16)
+NXM_NX_IPV6_DST = (0x0001, 20, 16)
+NXM_NX_ICMPV6_TYPE = (0x0001, 21, 1)
+NXM_NX_ICMPV6_CODE = (0x0001, 22, 1)
+NXM_NX_COOKIE = (0x0001, 30, 8)
+NXM_NX_CONJ_ID = (0x0001, 37, 4)
+OXM_OF_METADATA = (0x8000, 2, 8)
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_RARP = 0x8035
+ETH_TYPE_IPV6 = 0x86dd
+IP_PROTO_ICMP = 1
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+IP_PROTO_ICMPV6 = 58
+
+# ovs-ofctl protocol shorthands as (dl_type, nw_proto)
+PROTO_SHORTHANDS = {'ip': (ETH_TYPE_IP, None),
+                    'ipv6': (ETH_TYPE_IPV6, None),
+                    'arp': (ETH_TYPE_ARP, None),
+                    'rarp': (ETH_TYPE_RARP, None),
+                    'icmp': (ETH_TYPE_IP, IP_PROTO_ICMP),
+                    'tcp': (ETH_TYPE_IP, IP_PROTO_TCP),
+                    'udp': (ETH_TYPE_IP, IP_PROTO_UDP),
+                    'icmp6': (ETH_TYPE_IPV6, IP_PROTO_ICMPV6),
+                    'tcp6': (ETH_TYPE_IPV6, IP_PROTO_TCP),
+                    'udp6': (ETH_TYPE_IPV6, IP_PROTO_UDP)}
+
+# Flow keys which are not part of the match
+FLOW_FIELD_KEYS = ('table', 'cookie', 'priority', 'idle_timeout',
+                   'hard_timeout', 'actions')
+
+RESUBMIT_RE = re.compile(r'^resubmit\((\d*),(\d*)\)$')
+CONJUNCTION_RE = re.compile(r'^conjunction\((\d+),(\d+)/(\d+)\)$')
+OUTPUT_RE = re.compile(r'^output:(\d+)$')
+LOAD_RE = re.compile(r'^load:(\w+)->NXM_NX_REG([0-7])\[\]$')
+REG_RE = re.compile(r'^reg([0-7])$')
+
+MAX_UINT64 = 0xffffffffffffffff
+
+
+class NotEncodable(Exception):
+    """The flow uses syntax outside of the supported subset."""
+
+
+class OpenFlowError(Exception):
+    """The switch rejected a message or the connection failed."""
+
+
+def _parse_int(value):
+    if isinstance(value, (int, long)):
+        return value
+    value = str(value).strip()
+    if value == '-1':
+        return MAX_UINT64
+    return int(value, 0)
+
+
+def _parse_masked(value, default_mask):
+    """Return (value, mask) of a "value/mask" or plain match value."""
+    if isinstance(value, basestring) and '/' in value:
+        value, mask = value.split('/', 1)
+        return _parse_int(value), _parse_int(mask)
+    return _parse_int(value), default_mask
+
+
+def _pack_uint(value, length):
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def _nxm_entry(field, value, mask=None):
+    vendor, nr, length = field
+    full_mask = (1 << (length * 8)) - 1
+    if mask is not None:
+        mask &= full_mask
+        if not mask:
+            return ''
+    if mask is None or mask == full_mask:
+        return (struct.pack('!I', nxm_header(vendor, nr, length)) +
+                _pack_uint(value & full_mask, length))
+    return (struct.pack('!I', nxm_header(vendor, nr, length, True)) +
+            _pack_uint(value & mask, length) + _pack_uint(mask, length))
+
+
+def _nxm_address(field, value):
+    net = netaddr.IPNetwork(value)
+    length = field[2]
+    if (net.version == 4) != (length == 4):
+        raise NotEncodable("address %s does not fit field" % value)
+    full_mask = (1 << (length * 8)) - 1
+    mask = full_mask ^ ((1 << (length * 8 - net.prefixlen)) - 1)
+    return _nxm_entry(field, int(net.ip), mask)
+
+
+def _nxm_mac(field, value):
+    if '/' in value:
+        raise NotEncodable("masked MAC %s" % value)
+    return _nxm_entry(field, int(netaddr.EUI(value)))
+
+
+def encode_match(flow, action):
+    """Return the NXM encoding of the match fields of an ofctl flow."""
+    fields = dict((key, value) for key, value in flow.iteritems()
+                  if key not in FLOW_FIELD_KEYS)
+    dl_type = nw_proto = None
+    if 'proto' in fields:
+        try:
+            dl_type, nw_proto = PROTO_SHORTHANDS[fields.pop('proto')]
+        except KeyError:
+            raise NotEncodable("protocol %s" % flow['proto'])
+    if 'dl_type' in fields:
+        dl_type = _parse_int(fields.pop('dl_type'))
+    if 'nw_proto' in fields:
+        nw_proto = _parse_int(fields.pop('nw_proto'))
+
+    # Prerequisite fields have to precede the fields depending on them
+    match = []
+    if 'in_port' in fields:
+        match.append(_nxm_entry(NXM_OF_IN_PORT,
+                                _parse_int(fields.pop('in_port'))))
+    if 'dl_dst' in fields:
+        match.append(_nxm_mac(NXM_OF_ETH_DST, fields.pop('dl_dst')))
+    if 'dl_src' in fields:
+        match.append(_nxm_mac(NXM_OF_ETH_SRC, fields.pop('dl_src')))
+    if dl_type is not None:
+        match.append(_nxm_entry(NXM_OF_ETH_TYPE, dl_type))
+    if 'dl_vlan' in fields:
+        vid = _parse_int(fields.pop('dl_vlan'))
+        if vid == 0xffff:
+            match.append(_nxm_entry(NXM_OF_VLAN_TCI, 0))
+        else:
+            match.append(_nxm_entry(NXM_OF_VLAN_TCI, 0x1000 | vid, 0x1fff))
+    elif 'vlan_tci' in fields:
+        match.append(_nxm_entry(NXM_OF_VLAN_TCI,
+                                *_parse_masked(fields.pop('vlan_tci'),
+                                               None)))
+    if nw_proto is not None:
+        if dl_type not in (ETH_TYPE_IP, ETH_TYPE_IPV6):
+            raise NotEncodable("nw_proto without IP")
+        match.append(_nxm_entry(NXM_OF_IP_PROTO, nw_proto))
+    for key, ip_field, ip6_field in (
+            ('nw_src', NXM_OF_IP_SRC, None),
+            ('nw_dst', NXM_OF_IP_DST, None),
+            ('ipv6_src', None, NXM_NX_IPV6_SRC),
+            ('ipv6_dst', None, NXM_NX_IPV6_DST)):
+        if key not in fields:
+            continue
+        if dl_type == ETH_TYPE_IP and ip_field:
+            match.append(_nxm_address(ip_field, fields.pop(key)))
+        elif dl_type == ETH_TYPE_IPV6 and ip6_field:
+            match.append(_nxm_address(ip6_field, fields.pop(key)))
+        else:
+            raise NotEncodable("%s with dl_type %s" % (key, dl_type))
+    tp_fields = {IP_PROTO_TCP: (NXM_OF_TCP_SRC, NXM_OF_TCP_DST),
+                 IP_PROTO_UDP: (NXM_OF_UDP_SRC, NXM_OF_UDP_DST)}
+    for key, index in (('tp_src', 0), ('tp_dst', 1)):
+        if key not in fields:
+            continue
+        if nw_proto not in tp_fields:
+            raise NotEncodable("%s with nw_proto %s" % (key, nw_proto))
+        match.append(_nxm_entry(tp_fields[nw_proto][index],
+                                *_parse_masked(fields.pop(key), None)))
+    icmp_fields = {IP_PROTO_ICMP: (NXM_OF_ICMP_TYPE, NXM_OF_ICMP_CODE),
+                   IP_PROTO_ICMPV6: (NXM_NX_ICMPV6_TYPE, NXM_NX_ICMPV6_CODE)}
+    for key, index in (('icmp_type', 0), ('icmp_code', 1)):
+        if key not in fields:
+            continue
+        if nw_proto not in icmp_fields:
+            raise NotEncodable("%s with nw_proto %s" % (key, nw_proto))
+        match.append(_nxm_entry(icmp_fields[nw_proto][index],
+                                _parse_int(fields.pop(key))))
+    for key in sorted(fields):
+        reg = REG_RE.match(key)
+        if reg:
+            match.append(_nxm_entry(NXM_NX_REG[int(reg.group(1))],
+                                    *_parse_masked(fields.pop(key), None)))
+    if 'metadata' in fields:
+        match.append(_nxm_entry(OXM_OF_METADATA,
+                                *_parse_masked(fields.pop('metadata'), None)))
+    if 'conj_id' in fields:
+        match.append(_nxm_entry(NXM_NX_CONJ_ID,
+                                _parse_int(fields.pop('conj_id'))))
+    if action != 'add' and 'cookie' in flow:
+        cookie, mask = _parse_masked(flow['cookie'], None)
+        if mask is None:
+            raise NotEncodable("cookie without mask")
+        match.append(_nxm_entry(NXM_NX_COOKIE, cookie, mask))
+    if fields:
+        raise NotEncodable("fields %s" % ', '.join(sorted(fields)))
+    return ''.join(match)
+
+
+def _split_actions(actions):
+    parts = []
+    depth = 0
+    current = ''
+    for char in actions:
+        if char == ',' and not depth:
+            parts.append(current.strip())
+            current = ''
+            continue
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        current += char
+    parts.append(current.strip())
+    return [part for part in parts if part]
+
+
+def _output_action(port):
+    return struct.pack('!HHHH', OFPAT_OUTPUT, 8, port, 0)
+
+
+def encode_actions(actions):
+    """Return the OpenFlow 1.0 encoding of an ofctl action list."""
+    encoded = []
+    for action in _split_actions(actions):
+        if action == 'drop':
+            continue
+        if action == 'normal':
+            encoded.append(_output_action(OFPP_NORMAL))
+            continue
+        if action == 'in_port':
+            encoded.append(_output_action(OFPP_IN_PORT))
+            continue
+        output = OUTPUT_RE.match(action)
+        if output:
+            encoded.append(_output_action(int(output.group(1))))
+            continue
+        resubmit = RESUBMIT_RE.match(action)
+        if resubmit:
+            in_port = int(resubmit.group(1) or OFPP_IN_PORT)
+            table = int(resubmit.group(2) or OFPTT_ALL)
+            encoded.append(struct.pack('!HHIHHB3x', OFPAT_VENDOR, 16,
+                                       NX_VENDOR_ID, NXAST_RESUBMIT_TABLE,
+                                       in_port, table))
+            continue
+        load = LOAD_RE.match(action)
+        if load:
+            vendor, nr, length = NXM_NX_REG[int(load.group(2))]
+            encoded.append(struct.pack('!HHIHHIQ', OFPAT_VENDOR, 24,
+                                       NX_VENDOR_ID, NXAST_REG_LOAD,
+                                       length * 8 - 1,
+                                       nxm_header(vendor, nr, length),
+                                       _parse_int(load.group(1))))
+            continue
+        conjunction = CONJUNCTION_RE.match(action)
+        if conjunction:
+            conj_id, clause, n_clauses = map(int, conjunction.groups())
+            encoded.append(struct.pack('!HHIHBBI', OFPAT_VENDOR, 16,
+                                       NX_VENDOR_ID, NXAST_CONJUNCTION,
+                                       clause - 1, n_clauses, conj_id))
+            continue
+        raise NotEncodable("action %s" % action)
+    return ''.join(encoded)
+
+
+def _pad8(data):
+    return data + '\0' * (-len(data) % 8)
+
+
+def _vendor_msg(subtype, body, xid):
+    length = OFP_HEADER_LEN + 8 + len(body)
+    return (struct.pack(OFP_HEADER, OFP_VERSION, OFPT_VENDOR, length, xid) +
+            struct.pack('!II', NX_VENDOR_ID, subtype) + body)
+
+
+def encode_flow_mod(action, flow, xid):
+    """Return an NXT_FLOW_MOD message for a deferred bridge flow action."""
+    if action not in FLOW_MOD_COMMANDS:
+        raise NotEncodable("flow action %s" % action)
+    match = encode_match(flow, action)
+    if action == 'add':
+        actions = encode_actions(flow.get('actions', ''))
+        cookie = _parse_int(flow.get('cookie', 0))
+        table = _parse_int(flow.get('table', 0))
+    else:
+        actions = ''
+        cookie = 0
+        table = _parse_int(flow.get('table', OFPTT_ALL))
+    body = struct.pack(NX_FLOW_MOD, cookie,
+                       (table << 8) | FLOW_MOD_COMMANDS[action],
+                       _parse_int(flow.get('idle_timeout', 0)),
+                       _parse_int(flow.get('hard_timeout', 0)),
+                       _parse_int(flow.get('priority', OFP_DEFAULT_PRIORITY)),
+                       OFP_NO_BUFFER, OFPP_NONE, 0, len(match))
+    return _vendor_msg(NXT_FLOW_MOD, body + _pad8(match) + actions, xid)
+
+
+class OpenFlowConnection(object):
+    """Persistent OpenFlow connection to a bridge management socket."""
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+        self._xids = itertools.count(1)
+
+    @classmethod
+    def for_bridge(cls, br_name):
+        return cls('%s/%s.mgmt' % (OVS_RUNDIR, br_name))
+
+    def _send(self, data):
+        self.sock.sendall(data)
+
+    def _recv_exact(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise OpenFlowError("connection to %s closed" % self.path)
+            data += chunk
+        return data
+
+    def _recv_msg(self):
+        header = self._recv_exact(OFP_HEADER_LEN)
+        version, msg_type, length, xid = struct.unpack(OFP_HEADER, header)
+        body = self._recv_exact(length - OFP_HEADER_LEN)
+        if msg_type == OFPT_ECHO_REQUEST:
+            self._send(struct.pack(OFP_HEADER, version, OFPT_ECHO_REPLY,
+                                   length, xid) + body)
+            return self._recv_msg()
+        return msg_type, xid, body
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        self.sock = sock
+        try:
+            sock.connect(self.path)
+            self._send(struct.pack(OFP_HEADER, OFP_VERSION, OFPT_HELLO,
+                                   OFP_HEADER_LEN, next(self._xids)))
+            msg_type, xid, body = self._recv_msg()
+            if msg_type != OFPT_HELLO:
+                raise OpenFlowError("unexpected message %s" % msg_type)
+            self._send(_vendor_msg(NXT_SET_FLOW_FORMAT,
+                                   struct.pack('!I', NXFF_NXM),
+                                   next(self._xids)) +
+                       _vendor_msg(NXT_FLOW_MOD_TABLE_ID,
+                                   struct.pack('!B7x', 1),
+                                   next(self._xids)))
+            if self.barrier():
+                raise OpenFlowError("%s does not support NXM flow mods" %
+                                    self.path)
+        except socket.error as e:
+            self.close()
+            raise OpenFlowError("unable to connect to %s: %s" %
+                                (self.path, e))
+        except Exception:
+            self.close()
+            raise
+        LOG.debug("OpenFlow connection to %s established", self.path)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def barrier(self):
+        """Wait until the switch processed all messages sent so far.
+
+        Returns the (xid, type, code) of the errors reported meanwhile.
+        """
+        barrier_xid = next(self._xids)
+        self._send(struct.pack(OFP_HEADER, OFP_VERSION, OFPT_BARRIER_REQUEST,
+                               OFP_HEADER_LEN, barrier_xid))
+        errors = []
+        while True:
+            msg_type, xid, body = self._recv_msg()
+            if msg_type == OFPT_BARRIER_REPLY and xid == barrier_xid:
+                return errors
+            if msg_type == OFPT_ERROR:
+                errors.append((xid,) + struct.unpack('!HH', body[:4]))
+
+    def send_flow_mods(self, action, flows):
+        """Send flow mods pipelined and wait for them with one barrier.
+
+        Raises NotEncodable before anything is sent when a flow is
+        outside of the supported subset, and OpenFlowError when the
+        switch rejects a flow mod or the connection fails.
+        """
+        with self.lock:
+            msgs = ''.join(encode_flow_mod(action, flow, next(self._xids))
+                           for flow in flows)
+            if self.sock is None:
+                self.connect()
+            try:
+                self._send(msgs)
+                errors = self.barrier()
+            except socket.error as e:
+                self.close()
+                raise OpenFlowError("connection to %s failed: %s" %
+                                    (self.path, e))
+            except OpenFlowError:
+                self.close()
+                raise
+            if errors:
+                raise OpenFlowError("switch rejected %s of %s flow mods: "
+                                    "%s" % (len(errors), len(flows), errors))
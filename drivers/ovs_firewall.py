@@ -13,31 +13,67 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import hashlib
+import heapq
 import itertools
+import json
 import netaddr
 from neutron.agent import firewall
 from neutron.agent.linux import ovs_lib
+from neutron.agent.linux import utils
 from neutron.common import constants
 from neutron.openstack.common import log as logging
 from neutron.plugins.ovsvapp.agent import ovsvapp_agent
+from neutron.plugins.ovsvapp.drivers import openflow
 from oslo.config import cfg
+import os
+import re
 import threading
+import time
 
 
 SG_DROPALL_PRI = 0
 SG_DEFAULT_PRI = 1
+SG_DISPATCH_PRI = 2
 SG_LOW_PRI = 5
 SG_RULES_PRI = 10
 SG_TP_PRI = 20
+# Conjunctive rule flows, see use_conjunction. OVS leaves the result of
+# a conjunctive flow overlapping a plain one of the same priority
+# undefined, so no other flow of the rule tables uses this priority
+SG_CONJ_PRI = 21
 SG_TCP_FLAG_PRI = 25
+SG_PORT_LEARN_PRI = 30
 SG_DROP_HIGH_PRI = 50
+SG_CONNTRACK_PRI = 60
 
 SG_DEFAULT_TABLE_ID = 0
+SG_CONNTRACK_TABLE_ID = 1
 SG_IP_TABLE_ID = 2
 SG_TCP_TABLE_ID = 2
 SG_UDP_TABLE_ID = 2
 SG_ICMP_TABLE_ID = 2
 SG_LEARN_TABLE_ID = 5
+# Rule flows shared by ports with the same rules, see shared_rule_tables
+SG_SHARED_INGRESS_TABLE_ID = 10
+SG_SHARED_EGRESS_TABLE_ID = 11
+# Remote group address sets, see address_set_tables
+SG_ADDRSET_SRC_TABLE_ID = 12
+SG_ADDRSET_DST_TABLE_ID = 13
+SG_REMOTE_INGRESS_TABLE_ID = 14
+SG_REMOTE_EGRESS_TABLE_ID = 15
+# Port flows by direction when pipeline_tables is set
+SG_INGRESS_TABLE_ID = 20
+SG_EGRESS_TABLE_ID = 21
+# Never reached by packets, holds one flow per port recording the
+# digest of its installed flows in the metadata match
+SG_STATE_TABLE_ID = 250
+
+# Flow cookies owned by this driver are COOKIE_PREFIX | index
+COOKIE_PREFIX = 0x5347 << 48
+COOKIE_PREFIX_MASK = 0xffff << 48
 
 ICMP_ECHO_REQ = 8
 ICMP_ECHO_REP = 0
@@ -49,10 +85,44 @@ ICMP_INFO_REP = 16
 ICMP_AM_REQ = 17
 ICMP_AM_REP = 18
 ICMP_DEST_UNREACH = 3
+# ICMP requests whose reply is learned, with the reply type
+ICMP_LEARN_TYPES = ((ICMP_ECHO_REQ, ICMP_ECHO_REP),
+                    (ICMP_TS_REQ, ICMP_TS_REP),
+                    (ICMP_INFO_REQ, ICMP_INFO_REP),
+                    (ICMP_AM_REQ, ICMP_AM_REP))
 
 LOG = logging.getLogger(__name__)
 INGRESS_DIRECTION = 'ingress'
 EGRESS_DIRECTION = 'egress'
+SG_SHARED_TABLES = {INGRESS_DIRECTION: SG_SHARED_INGRESS_TABLE_ID,
+                    EGRESS_DIRECTION: SG_SHARED_EGRESS_TABLE_ID}
+# Rule key and flow match field of the remote prefix, then of the local
+# prefix, by direction
+SG_PREFIX_FIELDS = {
+    INGRESS_DIRECTION: (('source_ip_prefix', 'nw_src'),
+                        ('dest_ip_prefix', 'nw_dst')),
+    EGRESS_DIRECTION: (('dest_ip_prefix', 'nw_dst'),
+                       ('source_ip_prefix', 'nw_src'))}
+# Register the port classifier loads the rule set tag into
+SG_RULESET_REG = 'reg0'
+# The remote address of a packet is looked up in the address set table
+# of its direction, which sets one bit of this register for every
+# remote group, per ethertype, the address is a member of
+SG_ADDRSET_REG = 'reg1'
+SG_ADDRSET_MAX_GROUPS = 32
+SG_ADDRSET_TABLES = {INGRESS_DIRECTION: SG_ADDRSET_SRC_TABLE_ID,
+                     EGRESS_DIRECTION: SG_ADDRSET_DST_TABLE_ID}
+SG_REMOTE_TABLES = {INGRESS_DIRECTION: SG_REMOTE_INGRESS_TABLE_ID,
+                    EGRESS_DIRECTION: SG_REMOTE_EGRESS_TABLE_ID}
+# Rule key of the member address of an expanded remote group rule
+REMOTE_PREFIX_KEYS = {INGRESS_DIRECTION: 'source_ip_prefix',
+                      EGRESS_DIRECTION: 'dest_ip_prefix'}
+ADDRSET_COOKIE_OWNER = 'address-sets'
+SG_DIRECTION_TABLES = {INGRESS_DIRECTION: SG_INGRESS_TABLE_ID,
+                       EGRESS_DIRECTION: SG_EGRESS_TABLE_ID}
+PIPELINE_COOKIE_OWNER = 'pipeline'
+# Register holding the conntrack zone, the VLAN of the packet
+SG_CT_ZONE_REG = 'reg6'
 PROTOCOLS = {constants.PROTO_NAME_TCP: constants.PROTO_NAME_TCP,
              constants.PROTO_NUM_TCP: constants.PROTO_NAME_TCP,
              constants.PROTO_NAME_UDP: constants.PROTO_NAME_UDP,
@@ -67,6 +137,43 @@ ETHERTYPE = {constants.IPv4: "ip",
 
 sg_conf = cfg.CONF.SECURITYGROUP
 
+# Flow dict keys which are not part of the flow match
+FLOW_NON_MATCH_KEYS = ('priority', 'actions', 'idle_timeout', 'hard_timeout')
+
+# Open vSwitch evicts learned flows from the largest group of flows
+# sharing these fields, one group per VLAN and pair of endpoints
+LEARN_EVICTION_GROUPS = ('NXM_OF_VLAN_TCI[0..11]',
+                         'NXM_OF_ETH_SRC[]',
+                         'NXM_OF_ETH_DST[]')
+
+# Seconds before the native flow backend retries a failed connection
+NATIVE_RETRY_INTERVAL = 60
+
+# ovs-ofctl flow file keywords of the deferred bridge actions
+BUNDLE_COMMANDS = {'add': 'add',
+                   'mod': 'modify',
+                   'del': 'delete',
+                   'del_strict': 'delete_strict'}
+
+# ovs-ofctl dump-flows fields which are not part of the flow match
+FLOW_DUMP_STAT_KEYS = ('cookie', 'duration', 'table', 'n_packets', 'n_bytes',
+                       'idle_timeout', 'hard_timeout', 'idle_age', 'hard_age')
+# Priority of flows added without one by ovs_lib, and the one left out
+# of dumped flows by ovs-ofctl
+FLOW_ADD_PRIORITY = 1
+OFP_DEFAULT_PRIORITY = 32768
+FLOW_IP_MATCH_KEYS = ('nw_src', 'nw_dst', 'ipv6_src', 'ipv6_dst')
+
+FLOW_COOKIE_RE = re.compile(r'cookie=0x([0-9a-f]+)')
+FLOW_MAC_RE = re.compile(r'dl_(?:src|dst)=([0-9a-f:]{17})')
+FLOW_METADATA_RE = re.compile(r'metadata=0x([0-9a-f]+)')
+
+# Rule keys which make up the traffic matched by a rule
+RULE_MATCH_KEYS = ('direction', 'ethertype', 'protocol',
+                   'port_range_min', 'port_range_max',
+                   'source_port_range_min', 'source_port_range_max',
+                   'source_ip_prefix', 'dest_ip_prefix', 'address_set_bit')
+
 PORT_KEYS = ['security_group_source_groups',
              'mac_address',
              'network_id',
@@ -81,6 +188,10 @@ class OVSFirewallDriver(firewall.FirewallDriver):
     def __init__(self):
         # list of port which has security group
         self.filtered_ports = {}
+        # Filtered port ids by security group, of the ports in the group
+        # and of the ports with rules whose remote group it is
+        self.sg_port_index = {'security_groups': {},
+                              'security_group_source_groups': {}}
         self.root_helper = cfg.CONF.AGENT.root_helper
 
         if sg_conf.security_bridge is None:
@@ -96,11 +207,247 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         self.patch_ofport = self.sg_br.get_port_ofport(
             ovsvapp_agent.SEC_TO_INT_PATCH)
         self.portCache = ovsvapp_agent.portCache()
+        self.cookies = CookieAllocator(sg_conf.cookie_state_file)
+        # Flow digests found on the bridge at restart, keyed by cookie
+        self.installed_digests = {}
+        # Desired flows of every programmed port, keyed by flow match
+        self.port_flows = {}
+        # Flows of the ports and rule sets as installed on the bridge
+        self.shadow = FlowShadow()
+        # Compiled flow templates of rule lists, shared by all ports
+        self.rule_cache = None
+        if sg_conf.rule_cache_size > 0:
+            self.rule_cache = RuleCache(sg_conf.rule_cache_size)
+        self.delta_stats = {'updates': 0,
+                            'flows_added': 0,
+                            'flows_removed': 0}
+        # Shared rule sets keyed by the digest of their rules, with the
+        # rule set key of every port referencing one
+        self.rulesets = {}
+        self.port_rulesets = {}
+        self._stale_rulesets = set()
+        # Remote group address sets keyed by (remote group, ethertype),
+        # the register bits of every member address and the address set
+        # keys referenced by every port
+        self.address_sets = {}
+        self.address_set_ips = {}
+        self.port_address_sets = {}
+        self._stale_address_set_ips = set()
+        # Ports of VMs on other hosts whose flows are not installed,
+        # and their rule lists shared by digest with a reference count
+        self.staged_ports = {}
+        self._staged_rules = {}
         self._defer_apply = False
+        self._defer_depth = 0
+        # Thread which turned defer apply on, only its calls are queued
+        self._defer_thread = None
+        # Port filter operations queued while defer apply is on
+        self._deferred_ops = collections.OrderedDict()
+        # Deferred bridge collecting the flows of a batch_apply() block
+        self._batch_br = None
+        self._batch_ports = set()
+        # Learned flow counts of the last learn table sampling
+        self.learn_stats = {'flows': 0, 'ports': {}}
+        # Highest cookie audited by the last flow reconciliation
+        self._reconcile_cookie = 0
+        self.reconcile_stats = {'audited': 0, 'repaired': 0}
+        self.setup_learn_table_limits()
         if not cfg.CONF.OVSVAPPAGENT.agent_maintenance:
+            # The agent wiped the bridge, no cookie is in use anymore
+            self.cookies.reset()
             self.setup_base_flows()
+        else:
+            self._load_installed_flows()
+            self._remove_address_set_flows()
+            if sg_conf.pipeline_tables:
+                # Ports move over to the direction tables as they are
+                # refreshed, their old flows take precedence until then
+                self.setup_pipeline_flows()
         self.locks = {}
 
+    def _load_installed_flows(self):
+        """Index the flows left on the bridge by the previous agent.
+
+        Flows with a cookie unknown to the cookie allocator are deleted,
+        the state flow digests of known cookies are kept so that ports
+        whose flows are unchanged can be adopted without reprogramming.
+        """
+        try:
+            dump = self.sg_br.run_ofctl("dump-flows", [])
+        except Exception:
+            LOG.exception(_("Unable to dump security bridge flows"))
+            return
+        known_cookies = set(self.cookies.cookies.itervalues())
+        stale_cookies = set()
+        for line in (dump or '').splitlines():
+            cookie = FLOW_COOKIE_RE.search(line)
+            if not cookie:
+                continue
+            cookie = int(cookie.group(1), 16)
+            if cookie & COOKIE_PREFIX_MASK != COOKIE_PREFIX:
+                continue
+            if cookie not in known_cookies:
+                stale_cookies.add(cookie)
+            elif "table=%s," % SG_STATE_TABLE_ID in line:
+                digest = FLOW_METADATA_RE.search(line)
+                if digest:
+                    self.installed_digests[cookie] = int(digest.group(1), 16)
+        LOG.info(_("Found installed flows for %(ports)s ports, "
+                   "deleting flows of %(stale)s unknown cookies"),
+                 {'ports': len(self.installed_digests),
+                  'stale': len(stale_cookies)})
+        if stale_cookies:
+            with self.sg_br.deferred() as deferred_sec_br:
+                for cookie in stale_cookies:
+                    deferred_sec_br.delete_flows(cookie="0x%x/-1" % cookie)
+
+    def _adopt_installed_flows(self, owner, flows):
+        """Reuse the flows of a port or rule set found at restart.
+
+        Returns True when the installed flows match the desired ones.
+        """
+        cookie = self.cookies.lookup(owner)
+        installed_digest = self.installed_digests.pop(cookie, None)
+        if installed_digest is None:
+            return False
+        if installed_digest != get_flows_digest(flows):
+            LOG.debug("OVSF installed flows of %s are outdated", owner)
+            return False
+        LOG.debug("OVSF reusing installed flows of %s", owner)
+        return True
+
+    def remove_stale_flows(self):
+        """Delete restart leftovers of ports which were never refreshed."""
+        if not sg_conf.pipeline_tables:
+            self._remove_pipeline_flows()
+        if not self.installed_digests:
+            return
+        owners = dict((cookie, owner)
+                      for owner, cookie in self.cookies.cookies.iteritems())
+        LOG.info(_("Deleting leftover flows of %s ports"),
+                 len(self.installed_digests))
+        with self.cookies.batch():
+            with self.sg_br.deferred() as deferred_sec_br:
+                for cookie in self.installed_digests:
+                    deferred_sec_br.delete_flows(cookie="0x%x/-1" % cookie)
+                    if owners.get(cookie) not in self.filtered_ports:
+                        self.cookies.release(owners.get(cookie))
+        self.installed_digests = {}
+
+    def _remove_address_set_flows(self):
+        """Delete the address set flows of the previous agent.
+
+        Register bits are reassigned, so the old flows could mark an
+        address as member of the wrong group. The sets are rebuilt as
+        ports are refreshed.
+        """
+        cookie = self.cookies.lookup(ADDRSET_COOKIE_OWNER)
+        if cookie is None:
+            return
+        with self.sg_br.deferred() as deferred_sec_br:
+            deferred_sec_br.delete_flows(cookie="0x%x/-1" % cookie)
+
+    def setup_learn_table_limits(self):
+        """Limit the size of the learn table of the security bridge.
+
+        The bridge is kept across agent restarts, so the Flow_Table
+        settings are replaced or removed every time. Only learned flows
+        have a timeout, OVS never evicts the other learn table flows.
+        """
+        limit = sg_conf.learn_table_flow_limit
+        br_name = self.sg_br.br_name
+        if limit > 0:
+            groups = '[%s]' % ','.join('"%s"' % field
+                                       for field in LEARN_EVICTION_GROUPS)
+            args = ["--", "--id=@ft", "create", "Flow_Table",
+                    "name=sg-learn", "flow_limit=%d" % limit,
+                    "overflow_policy=evict", "groups=%s" % groups,
+                    "--", "set", "Bridge", br_name,
+                    "flow_tables:%s=@ft" % SG_LEARN_TABLE_ID]
+        else:
+            args = ["remove", "Bridge", br_name, "flow_tables",
+                    str(SG_LEARN_TABLE_ID)]
+        self.sg_br.run_vsctl(args)
+
+    def sample_learn_table(self):
+        """Count the learned flows, in total and per port.
+
+        Every learned flow carries the idle_timeout of its learn spec,
+        the flows installed by the driver have none. ICMP replies are
+        learned without MAC addresses, they are only part of the total.
+        The learned flows of ports above learn_table_port_flow_limit are
+        flushed. Returns the number of learned flows.
+        """
+        dump = self.sg_br.dump_flows_for_table(SG_LEARN_TABLE_ID)
+        port_macs = dict((port['mac_address'], port_id)
+                         for port_id, port in self.filtered_ports.iteritems()
+                         if 'mac_address' in port)
+        total = 0
+        port_counts = {}
+        for line in (dump or '').splitlines():
+            if 'idle_timeout=' not in line:
+                continue
+            total += 1
+            for mac in set(FLOW_MAC_RE.findall(line)):
+                port_id = port_macs.get(mac)
+                if port_id:
+                    port_counts[port_id] = port_counts.get(port_id, 0) + 1
+        self.learn_stats = {'flows': total, 'ports': port_counts}
+        LOG.debug("OVSF %(flows)s learned flows, largest ports %(ports)s",
+                  {'flows': total,
+                   'ports': sorted(port_counts.iteritems(),
+                                   key=lambda item: item[1],
+                                   reverse=True)[:5]})
+        limit = sg_conf.learn_table_port_flow_limit
+        if limit > 0:
+            for port_id, count in port_counts.iteritems():
+                if count > limit:
+                    LOG.warn(_("Port %(port)s has %(count)s learned flows, "
+                               "above the limit of %(limit)s. Flushing "
+                               "them"),
+                             {'port': port_id, 'count': count,
+                              'limit': limit})
+                    self.flush_learned_flows(port_id)
+        return total
+
+    def flush_learned_flows(self, port_id):
+        """Delete the learned flows of a port, other tables untouched."""
+        port = self.filtered_ports.get(port_id)
+        vlan = self._get_port_vlan(port_id)
+        if not port or 'mac_address' not in port or not vlan:
+            return
+        with self._deferred_br() as deferred_sec_br:
+            self._delete_learned_flows(deferred_sec_br, port, vlan)
+
+    def setup_pipeline_flows(self):
+        """Dispatch packets to the port flows of their direction."""
+        cookie = "0x%x" % self.cookies.get(PIPELINE_COOKIE_OWNER)
+        for direction, table in SG_DIRECTION_TABLES.iteritems():
+            self.sg_br.add_flow(priority=SG_DISPATCH_PRI,
+                                table=SG_DEFAULT_TABLE_ID,
+                                cookie=cookie,
+                                in_port=self._get_direction_in_port(direction),
+                                actions="resubmit(,%s)" % table)
+            # Packets no port flow allows may still be learned replies
+            self.sg_br.add_flow(priority=SG_DROPALL_PRI,
+                                table=table,
+                                cookie=cookie,
+                                actions="resubmit(,%s)" % SG_LEARN_TABLE_ID)
+
+    def _remove_pipeline_flows(self):
+        """Delete the direction dispatch of a previous agent.
+
+        Called once all ports were refreshed into table 0, so no port
+        flow is left in the direction tables.
+        """
+        cookie = self.cookies.lookup(PIPELINE_COOKIE_OWNER)
+        if cookie is None:
+            return
+        LOG.info(_("Removing the direction tables of the security bridge"))
+        with self.sg_br.deferred() as deferred_sec_br:
+            deferred_sec_br.delete_flows(cookie="0x%x/-1" % cookie)
+        self.cookies.release(PIPELINE_COOKIE_OWNER)
+
     def get_lock(self, port_id):
         if port_id not in self.locks:
             LOG.debug(_("Creating lock for port %s") % port_id)
@@ -119,6 +466,45 @@ class OVSFirewallDriver(firewall.FirewallDriver):
     def ports(self):
         return self.filtered_ports
 
+    def _set_filtered_port(self, port):
+        self._unindex_port(port['id'])
+        mini_port = self._get_mini_port(port)
+        self.filtered_ports[port['id']] = mini_port
+        for attribute, index in self.sg_port_index.iteritems():
+            for sg_id in mini_port.get(attribute) or []:
+                index.setdefault(sg_id, set()).add(port['id'])
+
+    def _pop_filtered_port(self, port_id):
+        self._unindex_port(port_id)
+        self.filtered_ports.pop(port_id, None)
+
+    def _unindex_port(self, port_id):
+        port = self.filtered_ports.get(port_id)
+        if not port:
+            return
+        for attribute, index in self.sg_port_index.iteritems():
+            for sg_id in port.get(attribute) or []:
+                port_ids = index.get(sg_id)
+                if port_ids is None:
+                    continue
+                port_ids.discard(port_id)
+                if not port_ids:
+                    del index[sg_id]
+
+    def get_ports_for_security_groups(self, security_groups,
+                                      attribute='security_groups'):
+        """Return the ids of the filtered ports using security groups.
+
+        :param attribute: 'security_groups' for the ports in the groups,
+        'security_group_source_groups' for the ports with rules whose
+        remote group is one of them
+        """
+        index = self.sg_port_index[attribute]
+        port_ids = set()
+        for sg_id in security_groups:
+            port_ids |= index.get(sg_id, set())
+        return port_ids
+
     def setup_base_flows(self):
         self.sg_br.add_flow(priority=SG_DEFAULT_PRI,
                             table=SG_DEFAULT_TABLE_ID,
@@ -126,6 +512,25 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         self.sg_br.add_flow(priority=SG_DROPALL_PRI,
                             table=SG_LEARN_TABLE_ID,
                             actions="drop")
+        if sg_conf.shared_rule_tables:
+            # Packets no shared rule allows may still be learned replies
+            for table in SG_SHARED_TABLES.itervalues():
+                self.sg_br.add_flow(priority=SG_DROPALL_PRI,
+                                    table=table,
+                                    actions="resubmit(,%s)" %
+                                    SG_LEARN_TABLE_ID)
+        if sg_conf.pipeline_tables:
+            self.setup_pipeline_flows()
+        if sg_conf.address_set_tables:
+            for table in SG_ADDRSET_TABLES.itervalues():
+                self.sg_br.add_flow(priority=SG_DROPALL_PRI,
+                                    table=table,
+                                    actions="drop")
+            for table in SG_REMOTE_TABLES.itervalues():
+                self.sg_br.add_flow(priority=SG_DROPALL_PRI,
+                                    table=table,
+                                    actions="resubmit(,%s)" %
+                                    SG_LEARN_TABLE_ID)
         # Allow all ARP, parity with iptables
         self.sg_br.add_flow(priority=SG_RULES_PRI,
                             table=SG_DEFAULT_TABLE_ID,
@@ -159,6 +564,10 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                             icmp_type=ICMP_TIME_EXCEEDED,
                             actions="normal")
 
+        self._setup_stateful_flows()
+
+    def _setup_stateful_flows(self):
+        """Set up the flows learning the reverse flows of connections."""
         # Always resubmit FIN pkts to learn table
         self.sg_br.add_flow(priority=SG_TCP_FLAG_PRI,
                             table=SG_DEFAULT_TABLE_ID,
@@ -190,44 +599,13 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                             actions="drop")
 
         # Now we add learning flows
-        learned_tcp_flow = ("table=%s,"
-                            "priority=%s,"
-                            "fin_idle_timeout=1,"
-                            "idle_timeout=7200,"
-                            "NXM_OF_ETH_SRC[]=NXM_OF_ETH_DST[],"
-                            "NXM_OF_ETH_DST[]=NXM_OF_ETH_SRC[],"
-                            "dl_type=0x0800,"
-                            "NXM_OF_VLAN_TCI[0..11],"
-                            "nw_proto=%s,"
-                            "NXM_OF_IP_SRC[]=NXM_OF_IP_DST[],"
-                            "NXM_OF_IP_DST[]=NXM_OF_IP_SRC[],"
-                            "NXM_OF_TCP_SRC[]=NXM_OF_TCP_DST[],"
-                            "NXM_OF_TCP_DST[]=NXM_OF_TCP_SRC[],"
-                            "output:NXM_OF_IN_PORT[]" %
-                            (SG_LEARN_TABLE_ID,
-                            SG_TP_PRI,
-                            constants.PROTO_NUM_TCP))
+        learned_tcp_flow = self.get_tcp_learn_flow()
         self.sg_br.add_flow(priority=SG_TP_PRI,
                             table=SG_TCP_TABLE_ID,
                             proto=constants.PROTO_NAME_TCP,
                             actions="learn(%s)" % learned_tcp_flow)
 
-        learned_udp_flow = ("table=%s,"
-                            "priority=%s,"
-                            "idle_timeout=300,"
-                            "NXM_OF_ETH_SRC[]=NXM_OF_ETH_DST[],"
-                            "NXM_OF_ETH_DST[]=NXM_OF_ETH_SRC[],"
-                            "dl_type=0x0800,"
-                            "NXM_OF_VLAN_TCI[0..11],"
-                            "nw_proto=%s,"
-                            "NXM_OF_IP_SRC[]=NXM_OF_IP_DST[],"
-                            "NXM_OF_IP_DST[]=NXM_OF_IP_SRC[],"
-                            "NXM_OF_UDP_SRC[]=NXM_OF_UDP_DST[],"
-                            "NXM_OF_UDP_DST[]=NXM_OF_UDP_SRC[],"
-                            "output:NXM_OF_IN_PORT[]" %
-                            (SG_LEARN_TABLE_ID,
-                            SG_TP_PRI,
-                            constants.PROTO_NUM_UDP))
+        learned_udp_flow = self.get_udp_learn_flow()
         self.sg_br.add_flow(priority=SG_TP_PRI,
                             table=SG_UDP_TABLE_ID,
                             proto=constants.PROTO_NAME_UDP,
@@ -272,12 +650,52 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                             actions="learn(%s)" %
                             self.get_icmp_learn_flow(resType))
 
-    def get_icmp_learn_flow(self, resType):
+    def get_tcp_learn_flow(self, cookie=None):
+        return (_get_learn_cookie(cookie) +
+                "table=%s,"
+                "priority=%s,"
+                "fin_idle_timeout=1,"
+                "idle_timeout=7200,"
+                "NXM_OF_ETH_SRC[]=NXM_OF_ETH_DST[],"
+                "NXM_OF_ETH_DST[]=NXM_OF_ETH_SRC[],"
+                "dl_type=0x0800,"
+                "NXM_OF_VLAN_TCI[0..11],"
+                "nw_proto=%s,"
+                "NXM_OF_IP_SRC[]=NXM_OF_IP_DST[],"
+                "NXM_OF_IP_DST[]=NXM_OF_IP_SRC[],"
+                "NXM_OF_TCP_SRC[]=NXM_OF_TCP_DST[],"
+                "NXM_OF_TCP_DST[]=NXM_OF_TCP_SRC[],"
+                "output:NXM_OF_IN_PORT[]" %
+                (SG_LEARN_TABLE_ID,
+                 SG_TP_PRI,
+                 constants.PROTO_NUM_TCP))
+
+    def get_udp_learn_flow(self, cookie=None):
+        return (_get_learn_cookie(cookie) +
+                "table=%s,"
+                "priority=%s,"
+                "idle_timeout=300,"
+                "NXM_OF_ETH_SRC[]=NXM_OF_ETH_DST[],"
+                "NXM_OF_ETH_DST[]=NXM_OF_ETH_SRC[],"
+                "dl_type=0x0800,"
+                "NXM_OF_VLAN_TCI[0..11],"
+                "nw_proto=%s,"
+                "NXM_OF_IP_SRC[]=NXM_OF_IP_DST[],"
+                "NXM_OF_IP_DST[]=NXM_OF_IP_SRC[],"
+                "NXM_OF_UDP_SRC[]=NXM_OF_UDP_DST[],"
+                "NXM_OF_UDP_DST[]=NXM_OF_UDP_SRC[],"
+                "output:NXM_OF_IN_PORT[]" %
+                (SG_LEARN_TABLE_ID,
+                 SG_TP_PRI,
+                 constants.PROTO_NUM_UDP))
+
+    def get_icmp_learn_flow(self, resType, cookie=None):
         if resType is ICMP_DEST_UNREACH:
             ip_str = ""
         else:
             ip_str = "NXM_OF_IP_SRC[]=NXM_OF_IP_DST[],"
-        return ("table=%s,"
+        return (_get_learn_cookie(cookie) +
+                "table=%s,"
                 "priority=%s,"
                 "idle_timeout=30,"
                 "dl_type=0x0800,"
@@ -292,6 +710,95 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                  constants.PROTO_NUM_ICMP,
                  resType, ip_str))
 
+    def _add_learn_flows(self, deferred_sec_br, port, vlan):
+        """Learn the reverse flows of a port under the port cookie.
+
+        These flows take precedence over the shared learn flows, so the
+        learned flows of the port go away with its cookie.
+        """
+        cookie = self.get_cookie(port)
+        learns = [dict(proto=constants.PROTO_NAME_TCP,
+                       actions="learn(%s)" % self.get_tcp_learn_flow(cookie)),
+                  dict(proto=constants.PROTO_NAME_UDP,
+                       actions="learn(%s)" % self.get_udp_learn_flow(cookie))]
+        for req_type, res_type in ICMP_LEARN_TYPES:
+            learns.append(dict(proto=constants.PROTO_NAME_ICMP,
+                               icmp_type=req_type,
+                               actions="learn(%s)" %
+                               self.get_icmp_learn_flow(res_type, cookie)))
+        for direction in (INGRESS_DIRECTION, EGRESS_DIRECTION):
+            match, action = self._get_direction_match(port, vlan, direction)
+            match.update(table=SG_IP_TABLE_ID, priority=SG_PORT_LEARN_PRI,
+                         in_port=self._get_direction_in_port(direction))
+            for learn in learns:
+                flow = match.copy()
+                flow.update(learn)
+                deferred_sec_br.add_flow(**flow)
+
+    @contextlib.contextmanager
+    def batch_apply(self):
+        """Apply the flows of all port operations in the block at once.
+
+        Flow mods of every prepare, update and clean call made inside
+        the block are collected and applied on exit, as one OpenFlow
+        bundle when use_bundle is set, otherwise as one ovs-ofctl call
+        per del/mod/add action. Nested blocks join the outer batch.
+        """
+        if self._batch_br is not None:
+            yield
+            return
+        self._batch_br = self.sg_br.deferred(order=('del', 'mod', 'add'))
+        try:
+            with self.cookies.batch():
+                yield
+        finally:
+            self._flush_batch(restart=False)
+        if self.rule_cache is not None:
+            LOG.debug("OVSF rule cache: %(size)s entries, %(hits)s hits, "
+                      "%(misses)s misses, hit rate %(rate).2f",
+                      {'size': len(self.rule_cache.entries),
+                       'hits': self.rule_cache.hits,
+                       'misses': self.rule_cache.misses,
+                       'rate': self.rule_cache.get_hit_rate()})
+
+    def _flush_batch(self, restart=True):
+        batch_br = self._batch_br
+        batch_ports = self._batch_ports
+        self._batch_br = None
+        self._batch_ports = set()
+        if restart:
+            self._batch_br = self.sg_br.deferred(order=('del', 'mod', 'add'))
+        try:
+            batch_br.apply_flows()
+        except Exception:
+            LOG.exception(_("Unable to apply flows for %s ports"),
+                          len(batch_ports))
+            # Their installed flows are unknown now, reprogram on update
+            for port_id in batch_ports:
+                self._pop_port_flows(port_id)
+        self._remove_batch_leftovers()
+
+    def _deferred_br(self, port_id=None):
+        """Return the deferred bridge a port operation records flows in.
+
+        Inside batch_apply() the flows join the batch when the returned
+        context exits cleanly, otherwise they are applied right away.
+        """
+        if self._batch_br is None:
+            return self.sg_br.deferred(full_ordered=True,
+                                       order=('del', 'mod', 'add'))
+        if port_id is not None:
+            self._batch_ports.add(port_id)
+        return self.sg_br.deferred(full_ordered=True,
+                                   order=('del', 'mod', 'add'),
+                                   batch=self._batch_br)
+
+    def _flush_batch_for_removal(self, port_id):
+        # Batched flows are applied as del, mod then add, so pending
+        # adds of a port must hit the bridge before it is removed
+        if self._batch_br is not None and port_id in self._batch_ports:
+            self._flush_batch()
+
     def _get_mini_port(self, port):
         new_port = {}
         new_port['device'] = port['id']
@@ -301,14 +808,23 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         return new_port
 
     def prepare_port_filter(self, port):
+        if self._is_deferred():
+            self._queue_port_op(port['id'], 'prepare', port)
+            return
         LOG.debug("OVSF Preparing port %s filter", port['id'])
+        self._unstage_port(port['id'])
         self.get_lock(port['id'])
         try:
-            with self.sg_br.deferred(full_ordered=True, order=(
-                'del', 'mod', 'add')) as deferred_br:
-                self._setup_flows(deferred_br, port)
-                self._add_flows(deferred_br, port)
-            self.filtered_ports[port['id']] = self._get_mini_port(port)
+            with self._deferred_br(port['id']) as deferred_br:
+                self._acquire_address_sets(deferred_br, port)
+                old_ruleset = self._acquire_ruleset(deferred_br, port)
+                flows = self._get_port_flows(port)
+                if not self._adopt_installed_flows(port['id'], flows):
+                    for flow in flows.itervalues():
+                        deferred_br.add_flow(**flow)
+                self._release_old_ruleset(deferred_br, port, old_ruleset)
+            self._set_port_flows(port, flows)
+            self._set_filtered_port(port)
 
         except Exception:
             LOG.exception(_("Unabled to add flows for %s") % port['id'])
@@ -318,33 +834,534 @@ class OVSFirewallDriver(firewall.FirewallDriver):
     def add_ports_to_filter(self, ports):
         for port in ports:
             LOG.debug("OVSF Adding port %s to filter", port['id'])
-            self.filtered_ports[port['id']] = self._get_mini_port(port)
+            self._set_filtered_port(port)
+
+    def stage_port_filter(self, port):
+        """Keep the filter of a port in memory without installing flows.
+
+        Meant for ports of VMs on other hosts, whose flows are only
+        needed once the VM moves here. Ports with the same rules share
+        one rule list, which is compiled into the rule cache so that
+        installing the flows later is cheap. Flows the port had are
+        removed.
+        """
+        LOG.debug("OVSF staging port %s filter", port['id'])
+        if port['id'] in self.port_flows or port['id'] in self._deferred_ops:
+            self.clean_port_filters([port['id']])
+        self._unstage_port(port['id'])
+        rules = port.get('security_group_rules') or []
+        digest = get_rules_digest(rules)
+        entry = self._staged_rules.get(digest)
+        if entry is None:
+            entry = self._staged_rules[digest] = [rules, 0]
+            if not sg_conf.address_set_tables:
+                self._get_compiled_rules(rules)
+        entry[1] += 1
+        staged = dict((key, value) for key, value in port.iteritems()
+                      if key != 'security_group_rules')
+        staged['rules_digest'] = digest
+        self.staged_ports[port['id']] = staged
+        self._set_filtered_port(port)
+
+    def pop_staged_port(self, port_id):
+        """Return the staged port with its rules, no longer staged."""
+        staged = self.staged_ports.get(port_id)
+        if staged is None:
+            return None
+        port = dict(staged)
+        port['security_group_rules'] = self._staged_rules[
+            port.pop('rules_digest')][0]
+        self._unstage_port(port_id)
+        return port
+
+    def _unstage_port(self, port_id):
+        staged = self.staged_ports.pop(port_id, None)
+        if staged is None:
+            return
+        entry = self._staged_rules[staged['rules_digest']]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._staged_rules[staged['rules_digest']]
 
     def update_port_filter(self, port):
+        if self._is_deferred():
+            self._queue_port_op(port['id'], 'update', port)
+            return
         LOG.debug(_("OVSF Updating port %s filter") % port['id'])
         if port['id'] not in self.filtered_ports:
             LOG.debug(_("Attempted to update port filter which is not "
                         "filtered %s") % port['id'])
             return
+        self._unstage_port(port['id'])
 
         self.get_lock(port['id'])
         try:
-            with self.sg_br.deferred(full_ordered=True, order=(
-                'del', 'mod', 'add')) as deferred_br:
-                self._remove_flows(deferred_br, port)
-                self._setup_flows(deferred_br, port)
-                self._add_flows(deferred_br, port)
-            self.filtered_ports[port['id']] = self._get_mini_port(port)
+            old_flows = self.port_flows.get(port['id'])
+            with self._deferred_br(port['id']) as deferred_br:
+                self._acquire_address_sets(deferred_br, port)
+                old_ruleset = self._acquire_ruleset(deferred_br, port)
+                if old_flows is None:
+                    flows = None
+                    if self.installed_digests:
+                        flows = self._get_port_flows(port)
+                    if flows and self._adopt_installed_flows(port['id'],
+                                                             flows):
+                        added, removed = 0, 0
+                    else:
+                        # Nothing known about the installed flows,
+                        # reprogram the port
+                        self._remove_flows(deferred_br, port)
+                        if flows is None:
+                            flows = self._get_port_flows(port)
+                        for flow in flows.itervalues():
+                            deferred_br.add_flow(**flow)
+                        added, removed = len(flows), None
+                else:
+                    flows = self._get_port_flows(port)
+                    added, removed = self._apply_flow_delta(
+                        deferred_br, old_flows, flows)
+                self._release_old_ruleset(deferred_br, port, old_ruleset)
+            self._set_port_flows(port, flows)
+            self._set_filtered_port(port)
+            self.delta_stats['updates'] += 1
+            self.delta_stats['flows_added'] += added
+            self.delta_stats['flows_removed'] += removed or 0
+            LOG.debug("OVSF port %(port)s updated: %(added)s flows added, "
+                      "%(removed)s flows removed",
+                      {'port': port['id'], 'added': added,
+                       'removed': 'all' if removed is None else removed})
         except Exception:
             LOG.exception(_("Unable to update flows for %s") % port['id'])
         finally:
             self.release_lock(port['id'])
 
+    def _get_port_flows(self, port):
+        """Build the desired flows of a port without installing them."""
+        recorder = FlowRecorder()
+        self._setup_flows(recorder, port)
+        if sg_conf.shared_rule_tables:
+            self._add_classifier_flows(recorder, port)
+        else:
+            self._add_flows(recorder, port)
+        if recorder.flows:
+            # Lets a restarted agent check the flows without parsing them
+            recorder.add_flow(priority=SG_DROPALL_PRI,
+                              table=SG_STATE_TABLE_ID,
+                              cookie=self.get_cookie(port),
+                              metadata="0x%x" %
+                              get_flows_digest(recorder.flows),
+                              actions="drop")
+        return recorder.flows
+
+    def _set_port_flows(self, port, flows):
+        self.port_flows[port['id']] = flows
+        self.shadow.set_flows(port['id'], self.cookies.get(port['id']),
+                              flows, port.get('security_groups') or ())
+
+    def _pop_port_flows(self, port_id):
+        self.port_flows.pop(port_id, None)
+        self.shadow.remove(port_id)
+
+    def get_installed_flows(self, port_id):
+        """Return the flows installed for a port, from the shadow."""
+        return self.shadow.get_flows(port_id)
+
+    def get_security_group_flow_counts(self):
+        """Return the number of port flows of every security group."""
+        return self.shadow.get_security_group_flow_counts()
+
+    def audit_flows(self, owners=None):
+        """Compare the shadow with the flows on the bridge.
+
+        Only the flows of the cookies of owners, all ports and rule
+        sets by default, are dumped, with a few cookie masked dumps.
+        Learned flows are not compared. Returns the owners whose flow
+        matches differ in any table, so a modified flow is found too.
+        """
+        if owners is None:
+            owners = self.shadow.flows.keys()
+        expected = {}
+        for owner in owners:
+            cookie = self.shadow.owner_cookies.get(owner)
+            if cookie is not None:
+                expected[cookie] = self.shadow.get_table_keys(owner)
+        found = self._dump_installed_flows(expected)
+        drifted = sorted(self.shadow.cookies[cookie]
+                         for cookie, keys in expected.iteritems()
+                         if found[cookie] != keys)
+        if drifted:
+            LOG.warn(_("Flows of %(drifted)s of %(owners)s audited ports "
+                       "and rule sets differ from the bridge"),
+                     {'drifted': len(drifted), 'owners': len(expected)})
+        return drifted
+
+    def _dump_installed_flows(self, cookies):
+        """Return the match keys of the flows of cookies per table.
+
+        The flows are dumped with a few cookie masked dumps, learned
+        flows are left out.
+        """
+        found = dict((cookie, {}) for cookie in cookies)
+        for value, mask in get_cookie_masks(cookies):
+            dump = self.sg_br.run_ofctl("dump-flows",
+                                        ["cookie=0x%x/0x%x" % (value, mask)])
+            for line in (dump or '').splitlines():
+                flow = parse_dumped_flow(line)
+                if flow is None:
+                    continue
+                cookie, table, key = flow
+                if cookie not in found or table == SG_LEARN_TABLE_ID:
+                    continue
+                found[cookie].setdefault(table, set()).add(key)
+        return found
+
+    def reconcile_flows(self):
+        """Repair the flows of the next cookie range of the shadow.
+
+        Ports and rule sets are audited in cookie order, at most
+        flow_reconcile_batch_size per call, and the next call goes on
+        after the last cookie audited. Missing flows are added again,
+        tables with extra or modified flows are emptied first. At most
+        flow_reconcile_max_repairs owners are repaired per call, the
+        ones left are audited again by the next call.
+        Nothing is done while port filters are being updated. Returns
+        the repaired owners.
+        """
+        if self._is_busy():
+            LOG.debug("OVSF port filters are being updated, skipping "
+                      "flow reconciliation")
+            return []
+        cookies = sorted(self.shadow.cookies)
+        # Wrap around to the lowest cookie after the highest one
+        cookies = ([cookie for cookie in cookies
+                    if cookie > self._reconcile_cookie] or cookies)
+        cookies = cookies[:sg_conf.flow_reconcile_batch_size]
+        if not cookies:
+            return []
+        expected = dict((cookie, self.shadow.get_table_keys(
+            self.shadow.cookies[cookie])) for cookie in cookies)
+        found = self._dump_installed_flows(cookies)
+        if self._is_busy():
+            return []
+        self._reconcile_cookie = cookies[-1]
+        max_repairs = sg_conf.flow_reconcile_max_repairs or None
+        repaired = []
+        with self.sg_br.deferred(order=('del', 'mod', 'add')) as \
+                deferred_sec_br:
+            for index, cookie in enumerate(cookies):
+                owner = self.shadow.cookies.get(cookie)
+                if owner is None or found[cookie] == expected[cookie]:
+                    continue
+                if self.shadow.get_table_keys(owner) != expected[cookie]:
+                    # Updated while the bridge was dumped
+                    continue
+                if len(repaired) == max_repairs:
+                    self._reconcile_cookie = cookies[index - 1]
+                    break
+                self._repair_flows(deferred_sec_br, owner, found[cookie])
+                repaired.append(owner)
+        self.reconcile_stats['audited'] += len(cookies)
+        self.reconcile_stats['repaired'] += len(repaired)
+        if repaired:
+            LOG.warn(_("Repaired the flows of %(repaired)s of %(owners)s "
+                       "audited ports and rule sets"),
+                     {'repaired': len(repaired), 'owners': len(cookies)})
+        return repaired
+
+    def _is_busy(self):
+        return bool(self._batch_br is not None or self._defer_apply or
+                    self._deferred_ops)
+
+    def _repair_flows(self, deferred_sec_br, owner, found):
+        """Install the shadow flows of an owner in the drifted tables."""
+        cookie = self.shadow.owner_cookies[owner]
+        expected = self.shadow.get_table_keys(owner)
+        for table in set(expected) | set(found):
+            keys = found.get(table, frozenset())
+            expected_keys = expected.get(table, frozenset())
+            if keys == expected_keys:
+                continue
+            extra = keys - expected_keys
+            LOG.debug("OVSF %(owner)s has %(missing)s missing and "
+                      "%(extra)s unknown flows in table %(table)s",
+                      {'owner': owner, 'table': table,
+                       'missing': len(expected_keys - keys),
+                       'extra': len(extra)})
+            if extra:
+                deferred_sec_br.delete_flows(table=table,
+                                             cookie="0x%x/-1" % cookie)
+            for flow in self.shadow.get_flows(owner):
+                if (flow.get('table', 0) == table and
+                        (extra or get_flow_match_key(flow) not in keys)):
+                    deferred_sec_br.add_flow(**flow)
+
+    def _get_ruleset_key(self, port):
+        rules = self._get_address_set_rules(
+            port.get("security_group_rules") or [])
+        return "ruleset:%s" % get_rules_digest(rules)
+
+    def _get_ruleset_flows(self, port, ruleset):
+        """Build the shared flows of a rule set from a member port."""
+        recorder = FlowRecorder()
+        self._add_flows(recorder, port, ruleset=ruleset)
+        recorder.add_flow(priority=SG_DROPALL_PRI,
+                          table=SG_STATE_TABLE_ID,
+                          cookie="0x%x" % ruleset['cookie'],
+                          metadata="0x%x" % get_flows_digest(recorder.flows),
+                          actions="drop")
+        return recorder.flows
+
+    def _acquire_ruleset(self, deferred_sec_br, port):
+        """Point a port at the shared rule set of its rules.
+
+        The rule set flows are installed when no other port uses them.
+        Returns the key of the rule set the port referenced before.
+        """
+        if not sg_conf.shared_rule_tables:
+            return None
+        key = self._get_ruleset_key(port)
+        ruleset = self.rulesets.get(key)
+        if ruleset is None:
+            cookie = self.cookies.get(key)
+            ruleset = {'cookie': cookie,
+                       'tag': cookie & ~COOKIE_PREFIX_MASK,
+                       'ports': set()}
+            flows = self._get_ruleset_flows(port, ruleset)
+            outdated = cookie in self.installed_digests
+            if not self._adopt_installed_flows(key, flows):
+                if outdated:
+                    deferred_sec_br.delete_flows(cookie="0x%x/-1" % cookie)
+                for flow in flows.itervalues():
+                    deferred_sec_br.add_flow(**flow)
+            self.rulesets[key] = ruleset
+            self.shadow.set_flows(key, cookie, flows)
+            LOG.debug("OVSF added rule set %(key)s with %(flows)s flows",
+                      {'key': key, 'flows': len(flows)})
+        ruleset['ports'].add(port['id'])
+        self._stale_rulesets.discard(key)
+        old_key = self.port_rulesets.get(port['id'])
+        self.port_rulesets[port['id']] = key
+        return old_key
+
+    def _release_old_ruleset(self, deferred_sec_br, port, old_key):
+        if old_key and old_key != self.port_rulesets.get(port['id']):
+            self._release_ruleset(deferred_sec_br, old_key, port['id'])
+
+    def _release_port_ruleset(self, deferred_sec_br, port_id):
+        key = self.port_rulesets.pop(port_id, None)
+        if key:
+            self._release_ruleset(deferred_sec_br, key, port_id)
+
+    def _release_ruleset(self, deferred_sec_br, key, port_id):
+        """Drop a port reference, removing the rule set when unused."""
+        ruleset = self.rulesets.get(key)
+        if ruleset is None:
+            return
+        ruleset['ports'].discard(port_id)
+        if ruleset['ports']:
+            return
+        if self._batch_br is not None:
+            # Batched deletes go first, so keep the flows until the
+            # classifiers of the batch moved to their new rule sets
+            self._stale_rulesets.add(key)
+            return
+        self._remove_ruleset(deferred_sec_br, key)
+
+    def _remove_ruleset(self, deferred_sec_br, key):
+        ruleset = self.rulesets.pop(key)
+        deferred_sec_br.delete_flows(cookie="0x%x/-1" % ruleset['cookie'])
+        self.shadow.remove(key)
+        self.cookies.release(key)
+        LOG.debug("OVSF removed rule set %s", key)
+
+    def _remove_batch_leftovers(self):
+        """Delete the rule sets and addresses released during a batch."""
+        stale = [key for key in self._stale_rulesets
+                 if key in self.rulesets and not self.rulesets[key]['ports']]
+        stale_ips = [ip for ip in self._stale_address_set_ips
+                     if ip not in self.address_set_ips]
+        self._stale_rulesets = set()
+        self._stale_address_set_ips = set()
+        if not stale and not stale_ips:
+            return
+        try:
+            with self.sg_br.deferred() as deferred_sec_br:
+                for key in stale:
+                    self._remove_ruleset(deferred_sec_br, key)
+                for ip in stale_ips:
+                    self._set_address_set_ip(deferred_sec_br, ip, 0)
+        except Exception:
+            LOG.exception(_("Unable to remove %(rulesets)s rule sets and "
+                            "%(ips)s address set members"),
+                          {'rulesets': len(stale), 'ips': len(stale_ips)})
+
+    def _get_address_set_rules(self, rules):
+        """Replace expanded remote group rules by address set rules.
+
+        Rules of a remote group with an address set lose their member
+        address and are merged, they match the register bit of the
+        address set instead.
+        """
+        if not sg_conf.address_set_tables:
+            return rules
+        address_set_rules = []
+        seen = set()
+        for rule in rules:
+            prefix_key = REMOTE_PREFIX_KEYS.get(rule.get('direction'))
+            address_set = self.address_sets.get(
+                (rule.get('remote_group_id'), rule.get('ethertype')))
+            if not rule.get(prefix_key) or address_set is None:
+                address_set_rules.append(rule)
+                continue
+            rule = dict(rule, address_set_bit=address_set['bit'])
+            del rule[prefix_key]
+            key = json.dumps(rule, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                address_set_rules.append(rule)
+        return address_set_rules
+
+    def _acquire_address_sets(self, deferred_sec_br, port):
+        """Update the address sets of the remote groups of a port.
+
+        The expanded remote group rules of a port carry the current
+        members, so only addresses which joined or left a group are
+        written, whatever the number of ports using the group.
+        """
+        if not sg_conf.address_set_tables:
+            return
+        members = {}
+        for rule in port.get("security_group_rules") or []:
+            prefix = rule.get(REMOTE_PREFIX_KEYS.get(rule.get('direction')))
+            if rule.get('remote_group_id') and prefix:
+                key = (rule['remote_group_id'], rule.get('ethertype'))
+                members.setdefault(key, set()).add(
+                    str(netaddr.IPNetwork(prefix)))
+        keys = set()
+        for key, ips in members.iteritems():
+            address_set = self.address_sets.get(key)
+            if address_set is None:
+                bit = self._get_free_address_set_bit()
+                if bit is None:
+                    LOG.debug("OVSF no register bit left for remote group "
+                              "%s, expanding its members", key[0])
+                    continue
+                address_set = {'bit': bit, 'members': set(), 'ports': set()}
+                self.address_sets[key] = address_set
+            address_set['ports'].add(port['id'])
+            keys.add(key)
+            self._set_address_set_members(deferred_sec_br, key, ips)
+        for key in self.port_address_sets.get(port['id'], set()) - keys:
+            self._release_address_set(deferred_sec_br, key, port['id'])
+        self.port_address_sets[port['id']] = keys
+
+    def _release_port_address_sets(self, deferred_sec_br, port_id):
+        for key in self.port_address_sets.pop(port_id, set()):
+            self._release_address_set(deferred_sec_br, key, port_id)
+
+    def _release_address_set(self, deferred_sec_br, key, port_id):
+        address_set = self.address_sets.get(key)
+        if address_set is None:
+            return
+        address_set['ports'].discard(port_id)
+        if not address_set['ports']:
+            self._set_address_set_members(deferred_sec_br, key, set())
+            del self.address_sets[key]
+
+    def _get_free_address_set_bit(self):
+        used = set(address_set['bit']
+                   for address_set in self.address_sets.itervalues())
+        for bit in range(SG_ADDRSET_MAX_GROUPS):
+            if bit not in used:
+                return bit
+
+    def _set_address_set_members(self, deferred_sec_br, key, ips):
+        address_set = self.address_sets[key]
+        bit = 1 << address_set['bit']
+        for ip in address_set['members'] ^ ips:
+            self._set_address_set_ip(deferred_sec_br, ip,
+                                     self.address_set_ips.get(ip, 0) ^ bit)
+        address_set['members'] = set(ips)
+
+    def _set_address_set_ip(self, deferred_sec_br, ip, bits):
+        """Write the register bits of a member address."""
+        if netaddr.IPNetwork(ip).version == 4:
+            proto, src_key, dst_key = 'ip', 'nw_src', 'nw_dst'
+        else:
+            proto, src_key, dst_key = 'ipv6', 'ipv6_src', 'ipv6_dst'
+        # Batched deletes go first, so inside a batch an address leaving
+        # its last group gets its bits cleared and is deleted afterwards
+        delete = not bits and self._batch_br is None
+        for table, match_key in ((SG_ADDRSET_SRC_TABLE_ID, src_key),
+                                 (SG_ADDRSET_DST_TABLE_ID, dst_key)):
+            match = {'table': table, 'proto': proto, match_key: ip}
+            if delete:
+                deferred_sec_br.delete_flows(**match)
+            else:
+                deferred_sec_br.add_flow(
+                    priority=SG_RULES_PRI,
+                    cookie="0x%x" % self.cookies.get(ADDRSET_COOKIE_OWNER),
+                    actions="load:0x%x->NXM_NX_%s[]" %
+                    (bits, SG_ADDRSET_REG.upper()),
+                    **match)
+        if bits:
+            self.address_set_ips[ip] = bits
+        else:
+            self.address_set_ips.pop(ip, None)
+            if not delete:
+                self._stale_address_set_ips.add(ip)
+
+    def _add_classifier_flows(self, deferred_sec_br, port):
+        """Send the traffic of a port to the rules of its rule set."""
+        vlan = self._get_port_vlan(port['id'])
+        if not vlan:
+            LOG.warn(_('Missing VLAN for port %s') % port['id'])
+            return
+        ruleset = self.rulesets[self.port_rulesets[port['id']]]
+        for direction in (INGRESS_DIRECTION, EGRESS_DIRECTION):
+            flow, action = self._get_direction_match(port, vlan, direction)
+            flow["priority"] = SG_LOW_PRI
+            flow["actions"] = "load:%s->NXM_NX_%s[]," % (
+                ruleset['tag'], SG_RULESET_REG.upper())
+            if sg_conf.address_set_tables:
+                flow["actions"] += "resubmit(,%s)," % (
+                    SG_ADDRSET_TABLES[direction])
+            flow["actions"] += "resubmit(,%s)" % SG_SHARED_TABLES[direction]
+            deferred_sec_br.add_flow(**flow)
+
+    def _apply_flow_delta(self, deferred_sec_br, old_flows, new_flows):
+        """Move a port from its installed flows to its desired flows.
+
+        Only flows missing on either side are deleted or added. Deletes
+        are strict, so kept flows with a more specific match are never
+        touched. Returns the number of added and removed flows.
+        """
+        removed = [get_flow_match(flow, strict=True)
+                   for key, flow in old_flows.iteritems()
+                   if key not in new_flows]
+        added = [flow for key, flow in new_flows.iteritems()
+                 if key not in old_flows]
+        for match in removed:
+            deferred_sec_br.delete_flows_strict(**match)
+        for flow in added:
+            deferred_sec_br.add_flow(**flow)
+        return len(added), len(removed)
+
     def clean_port_filters(self, ports, remove_port=False):
+        if self._is_deferred():
+            for port_id in ports:
+                self._queue_port_op(port_id, remove=remove_port)
+            return
         LOG.debug("OVSF Cleaning filters for  %s ports", len(ports))
         if not ports:
             return
-        with self.sg_br.deferred() as deferred_sec_br:
+        for port_id in ports:
+            self._discard_deferred_op(port_id)
+            self._flush_batch_for_removal(port_id)
+        # With learned flow cookies all flows of the ports go away with
+        # a few masked cookie deletes
+        cookies = []
+        with self.cookies.batch(), self._deferred_br() as deferred_sec_br:
             for port_id in ports:
                 self.get_lock(port_id)
                 try:
@@ -352,28 +1369,52 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                         LOG.debug("Attempted to remove port filter "
                               "which is not in filtered %s", port_id)
                         continue
-                    self._remove_flows(deferred_sec_br,
-                                       self.filtered_ports.get(port_id))
+                    if sg_conf.learned_flow_cookies:
+                        cookie = self.cookies.lookup(port_id)
+                        if cookie is not None:
+                            cookies.append(cookie)
+                    else:
+                        self._remove_flows(deferred_sec_br,
+                                           self.filtered_ports.get(port_id))
+                    self._release_port_ruleset(deferred_sec_br, port_id)
+                    self._release_port_address_sets(deferred_sec_br,
+                                                    port_id)
+                    self._pop_port_flows(port_id)
                     if remove_port:
-                        self.filtered_ports.pop(port_id, None)
+                        self._unstage_port(port_id)
+                        self._pop_filtered_port(port_id)
+                        self.cookies.release(port_id)
                 except Exception:
                     LOG.exception(_("Unable to delete flows for %s") % port_id)
                 finally:
                     self.release_lock(port_id)
                     self.remove_lock(port_id)
+            for value, mask in get_cookie_masks(cookies):
+                deferred_sec_br.delete_flows(cookie="0x%x/0x%x" %
+                                             (value, mask))
 
     def remove_port_filter(self, port_id):
+        if self._is_deferred():
+            self._queue_port_op(port_id, remove=True)
+            return
         LOG.debug("OVSF Removing port %s filter", port_id)
+        self._discard_deferred_op(port_id)
         if not self.filtered_ports.get(port_id):
             LOG.debug("Attempted to remove port filter which is not "
                       "filtered %s", port_id)
             return
         self.get_lock(port_id)
         try:
-            with self.sg_br.deferred() as deferred_sec_br:
+            self._flush_batch_for_removal(port_id)
+            with self._deferred_br() as deferred_sec_br:
                 self._remove_flows(deferred_sec_br,
                                    self.filtered_ports.get(port_id))
-            self.filtered_ports.pop(port_id, None)
+                self._release_port_ruleset(deferred_sec_br, port_id)
+                self._release_port_address_sets(deferred_sec_br, port_id)
+            self._pop_port_flows(port_id)
+            self._unstage_port(port_id)
+            self._pop_filtered_port(port_id)
+            self.cookies.release(port_id)
         except Exception:
             LOG.exception(_("Unable to delete flows for %s") % port_id)
         finally:
@@ -397,41 +1438,40 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         if not vlan:
             LOG.warn(_('Missing VLAN information for port %s') % port['id'])
             return
+        if sg_conf.learned_flow_cookies:
+            self._add_learn_flows(deferred_sec_br, port, vlan)
         if isinstance(port.get('allowed_address_pairs'), list):
             for address_pair in port['allowed_address_pairs']:
                 if netaddr.IPNetwork(address_pair["ip_address"]).version == 4:
                     ap_proto = "ip"
                 else:
                     ap_proto = "ipv6"
+                flow, action = self._get_direction_match(
+                    port, vlan, INGRESS_DIRECTION)
                 deferred_sec_br.add_flow(priority=SG_RULES_PRI,
-                                table=SG_DEFAULT_TABLE_ID,
-                                cookie=self.get_cookie(port),
-                                dl_dst=port["mac_address"],
-                                in_port=self.patch_ofport,
                                 dl_src=address_pair["mac_address"],
-                                dl_vlan=vlan,
                                 proto=ap_proto,
                                 nw_src=address_pair["ip_address"],
-                                actions="resubmit(,%s),output:%s" %
-                                (SG_IP_TABLE_ID, self.phy_ofport))
+                                actions=self._get_allow_actions(
+                                    SG_IP_TABLE_ID, action),
+                                **flow)
 
     def _remove_flows(self, deferred_sec_br, port):
         """Remove all flows for a port."""
         LOG.debug("OVSF Removing flows start  %s ", port['id'])
         try:
-            deferred_sec_br.delete_flows(cookie="%s/-1"
-                % self.get_cookie(port))
+            cookie = self.cookies.lookup(port['id'])
+            if cookie is not None:
+                deferred_sec_br.delete_flows(cookie="0x%x/-1" % cookie)
+            if sg_conf.learned_flow_cookies:
+                # Learned flows carry the port cookie too
+                return
             port = self.filtered_ports.get(port['id'])
             vlan = self._get_port_vlan(port['id'])
             if 'mac_address' not in port or not vlan:
                 LOG.debug("OVSF Removing flows stop  %s ", port['id'])
                 return
-            deferred_sec_br.delete_flows(table=SG_LEARN_TABLE_ID,
-                                dl_src=port['mac_address'],
-                                vlan_tci="0x%04x/0x0fff" % vlan)
-            deferred_sec_br.delete_flows(table=SG_LEARN_TABLE_ID,
-                                dl_dst=port['mac_address'],
-                                vlan_tci="0x%04x/0x0fff" % vlan)
+            self._delete_learned_flows(deferred_sec_br, port, vlan)
             deferred_sec_br.delete_flows(table=SG_DEFAULT_TABLE_ID,
                                 dl_src=port['mac_address'],
                                 vlan_tci="0x%04x/0x0fff" % vlan)
@@ -441,17 +1481,179 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         except Exception:
             LOG.exception(_("Unable to remove flows %s") % port['id'])
 
-    def _add_flows(self, deferred_sec_br, port, rules=None):
-        egress_action = 'normal'
-        ingress_action = 'output:%s' % self.phy_ofport
+    def _delete_learned_flows(self, deferred_sec_br, port, vlan):
+        if sg_conf.learned_flow_cookies:
+            cookie = self.cookies.lookup(port['id'])
+            if cookie is not None:
+                deferred_sec_br.delete_flows(table=SG_LEARN_TABLE_ID,
+                                             cookie="0x%x/-1" % cookie)
+            return
+        deferred_sec_br.delete_flows(table=SG_LEARN_TABLE_ID,
+                                     dl_src=port['mac_address'],
+                                     vlan_tci="0x%04x/0x0fff" % vlan)
+        deferred_sec_br.delete_flows(table=SG_LEARN_TABLE_ID,
+                                     dl_dst=port['mac_address'],
+                                     vlan_tci="0x%04x/0x0fff" % vlan)
 
-        if not rules:
-            rules = port["security_group_rules"]
+    def _get_direction_match(self, port, vlan, direction, ruleset=None,
+                             remote=False):
+        """Return the port match and allow action for a rule direction.
 
-        vlan = self._get_port_vlan(port['id'])
-        if not vlan:
-            LOG.warn(_('Missing VLAN for port %s') % port['id'])
-            return
+        Rules of a shared rule set match its tag instead of the port,
+        address set rules of a port go to the remote table.
+        """
+        if ruleset is not None:
+            flow = {'table': SG_SHARED_TABLES[direction],
+                    'cookie': "0x%x" % ruleset['cookie'],
+                    SG_RULESET_REG: ruleset['tag']}
+            return flow, self._get_direction_action(direction)
+        flow = dict(table=SG_DEFAULT_TABLE_ID,
+                    cookie=self.get_cookie(port),
+                    dl_vlan=vlan)
+        if direction == INGRESS_DIRECTION:
+            flow["dl_dst"] = port["mac_address"]
+        else:
+            flow["dl_src"] = port["mac_address"]
+        if remote:
+            flow["table"] = SG_REMOTE_TABLES[direction]
+        elif sg_conf.pipeline_tables:
+            # The direction table implies the in_port
+            flow["table"] = SG_DIRECTION_TABLES[direction]
+            return flow, self._get_direction_action(direction)
+        flow["in_port"] = self._get_direction_in_port(direction)
+        return flow, self._get_direction_action(direction)
+
+    def _get_direction_in_port(self, direction):
+        """Return the port packets of a direction enter the bridge on."""
+        if direction == INGRESS_DIRECTION:
+            return self.patch_ofport
+        return self.phy_ofport
+
+    def _get_direction_action(self, direction):
+        """Return the action forwarding an allowed packet."""
+        if direction == INGRESS_DIRECTION:
+            return 'output:%s' % self.phy_ofport
+        return 'normal'
+
+    def _get_conjunction_groups(self, rules):
+        """Split rules into conjunctive groups and plain rules.
+
+        TCP/UDP IPv4 rules which only differ by their remote prefix,
+        the source prefix of ingress and the destination prefix of
+        egress rules, are collected per port range, and port ranges
+        sharing the same set of remote prefixes are merged, so every
+        group is an exact cross product of remote prefixes and
+        (protocol, port range) matches. Groups where conjunction would
+        not save flows are returned as plain rules.
+        """
+        port_groups = {}
+        for rule in rules:
+            proto = PROTOCOLS.get(rule.get('protocol'))
+            prefix_fields = SG_PREFIX_FIELDS.get(rule.get('direction'))
+            if (rule.get('ethertype') != constants.IPv4 or
+                    prefix_fields is None or
+                    not rule.get(prefix_fields[0][0]) or
+                    proto not in (constants.PROTO_NAME_TCP,
+                                  constants.PROTO_NAME_UDP)):
+                continue
+            key = (rule.get('direction'), rule.get(prefix_fields[1][0]),
+                   proto,
+                   rule.get('port_range_min'), rule.get('port_range_max'),
+                   rule.get('source_port_range_min'),
+                   rule.get('source_port_range_max'))
+            port_groups.setdefault(key, []).append(rule)
+
+        prefix_groups = {}
+        for key, key_rules in port_groups.iteritems():
+            remote_key = SG_PREFIX_FIELDS[key[0]][0][0]
+            prefixes = frozenset(rule[remote_key] for rule in key_rules)
+            prefix_groups.setdefault((key[0], key[1], prefixes),
+                                     []).append(key)
+
+        groups = []
+        grouped_rules = set()
+        for (direction, local_prefix, prefixes), keys in sorted(
+                prefix_groups.iteritems(),
+                key=lambda item: (item[0][:2], sorted(item[0][2]))):
+            num_port_flows = sum(
+                len(self._get_port_matches(key[3], key[4])) *
+                len(self._get_port_matches(key[5], key[6]))
+                for key in keys)
+            if (len(prefixes) * num_port_flows <=
+                    len(prefixes) + num_port_flows + 1):
+                continue
+            groups.append((direction, local_prefix, sorted(prefixes),
+                           sorted(key[2:] for key in keys)))
+            for key in keys:
+                grouped_rules.update(id(rule) for rule in port_groups[key])
+        remaining = [rule for rule in rules if id(rule) not in grouped_rules]
+        return groups, remaining
+
+    def _compile_conjunction_groups(self, groups):
+        """Compile remote prefix x port groups into conjunctive matches.
+
+        Conjunction ids restart at 1 for every rule list, so that the
+        compiled flows can be cached and shared by ports. Ids of two
+        ports cannot clash: _add_flows puts the port match (VLAN, MAC
+        and in_port, or the rule set register) in front of every clause
+        and conj_id flow, so a packet only matches the clauses of one
+        port and direction and can only complete that port's
+        conjunctions. Clauses of several groups with the same match,
+        a shared prefix or port mask, are one flow with the conjunction
+        actions of all of them, OVS would replace one with the other.
+        """
+        recorders = collections.OrderedDict()
+        for conj_id, (direction, local_prefix, prefixes, port_specs) in \
+                enumerate(groups, 1):
+            recorder = recorders.setdefault(direction, ConjunctionRecorder())
+            (_remote_key, remote_field), (_local_key, local_field) = \
+                SG_PREFIX_FIELDS[direction]
+            base_flow = {"priority": SG_CONJ_PRI}
+            if (local_prefix and
+                    netaddr.IPNetwork(local_prefix).prefixlen > 0):
+                base_flow[local_field] = local_prefix
+
+            for prefix in prefixes:
+                flow = dict(base_flow, proto='ip',
+                            actions="conjunction(%s,1/2)" % conj_id)
+                if netaddr.IPNetwork(prefix).prefixlen > 0:
+                    flow[remote_field] = prefix
+                recorder.add_flow(**flow)
+
+            for proto, pr_min, pr_max, spr_min, spr_max in port_specs:
+                flow = dict(base_flow, proto=proto,
+                            actions="conjunction(%s,2/2)" % conj_id)
+                self.add_flow_with_range(recorder, flow,
+                                         pr_min, pr_max, spr_min, spr_max)
+
+            recorder.add_flow(**dict(
+                base_flow, conj_id=conj_id,
+                actions=self._get_allow_actions(
+                    SG_IP_TABLE_ID, self._get_direction_action(direction))))
+            LOG.debug("OVSF compiled conjunction %(id)s: %(prefixes)s "
+                      "prefixes x %(ports)s port ranges",
+                      {'id': conj_id, 'prefixes': len(prefixes),
+                       'ports': len(port_specs)})
+        return [(direction, False, direction_recorder.flows.values())
+                for direction, direction_recorder in recorders.iteritems()]
+
+    def _compile_rules(self, rules):
+        """Compile rules into flow templates which fit any port.
+
+        Returns (direction, remote, flows) entries and the number of
+        flows rule normalization saved. The flows lack the port or rule
+        set match, which _add_flows puts in front of them.
+        """
+        compiled = []
+        saved = 0
+        if sg_conf.normalize_rules:
+            normalized = normalize_rules(rules)
+            saved = (self._count_rule_flows(rules) -
+                     self._count_rule_flows(normalized))
+            rules = normalized
+        if sg_conf.use_conjunction:
+            groups, rules = self._get_conjunction_groups(rules)
+            compiled.extend(self._compile_conjunction_groups(groups))
         for rule in rules:
             direction = rule.get('direction')
             proto = rule.get('protocol')
@@ -462,11 +1664,14 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             ethertype = rule.get('ethertype')
             src_ip_prefix = rule.get('source_ip_prefix')
             dest_ip_prefix = rule.get('dest_ip_prefix')
-            flow = dict(priority=SG_RULES_PRI)
-            flow["table"] = SG_DEFAULT_TABLE_ID
-            # Lets try using port id as cookie
-            flow["cookie"] = self.get_cookie(port)
-            flow["dl_vlan"] = vlan
+            address_set_bit = rule.get('address_set_bit')
+            remote = address_set_bit is not None
+            action = self._get_direction_action(direction)
+            recorder = FlowRecorder()
+            flow = {"priority": SG_RULES_PRI}
+            if remote:
+                flow[SG_ADDRSET_REG] = "0x%x/0x%x" % (1 << address_set_bit,
+                                                      1 << address_set_bit)
 
             src_ip_prefixlen = 0
             dest_ip_prefixlen = 0
@@ -497,30 +1702,21 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             elif ethertype == constants.IPv6:
                 flow["proto"] = 'ipv6'
 
-            if direction == INGRESS_DIRECTION:
-                flow["dl_dst"] = port["mac_address"]
-                flow["in_port"] = self.patch_ofport
-                action = ingress_action
-            elif direction == EGRESS_DIRECTION:
-                flow["dl_src"] = port["mac_address"]
-                flow["in_port"] = self.phy_ofport
-                action = egress_action
-
             if proto == constants.PROTO_NAME_TCP:
                 flow["proto"] = "tcp"
                 flow["priority"] = SG_TP_PRI
-                flow["actions"] = ("resubmit(,%s),%s" %
-                                   (SG_TCP_TABLE_ID, action))
-                self.add_flow_with_range(deferred_sec_br, flow,
+                flow["actions"] = self._get_allow_actions(
+                    SG_TCP_TABLE_ID, action)
+                self.add_flow_with_range(recorder, flow,
                                          pr_min, pr_max,
                                          spr_min, spr_max)
 
             elif proto == constants.PROTO_NAME_UDP:
                 flow["proto"] = "udp"
                 flow["priority"] = SG_TP_PRI
-                flow["actions"] = ("resubmit(,%s),%s" %
-                                   (SG_UDP_TABLE_ID, action))
-                self.add_flow_with_range(deferred_sec_br,
+                flow["actions"] = self._get_allow_actions(
+                    SG_UDP_TABLE_ID, action)
+                self.add_flow_with_range(recorder,
                                          flow,
                                          pr_min, pr_max,
                                          spr_min, spr_max)
@@ -532,50 +1728,899 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                     flow["icmp_type"] = pr_min
                 if pr_max is not None:
                     flow["icmp_code"] = pr_max
-                flow["actions"] = ("resubmit(,%s),%s" %
-                                   (SG_ICMP_TABLE_ID, action))
-                deferred_sec_br.add_flow(**flow)
+                flow["actions"] = self._get_allow_actions(
+                    SG_ICMP_TABLE_ID, action)
+                recorder.add_flow(**flow)
 
             else:
-                flow["actions"] = ("resubmit(,%s),%s" % (SG_IP_TABLE_ID,
-                                                        action))
-                deferred_sec_br.add_flow(**flow)
-            LOG.debug("OVSF adding flow: %s", flow)
+                flow["actions"] = self._get_allow_actions(SG_IP_TABLE_ID,
+                                                          action)
+                recorder.add_flow(**flow)
+            compiled.append((direction, remote, recorder.flows.values()))
+        return compiled, saved
+
+    def _count_rule_flows(self, rules):
+        """Return the number of flows rules install without conjunction."""
+        count = 0
+        for rule in rules:
+            if PROTOCOLS.get(rule.get('protocol')) in (
+                    constants.PROTO_NAME_TCP, constants.PROTO_NAME_UDP):
+                count += (len(self._get_port_matches(
+                    rule.get('port_range_min'), rule.get('port_range_max'))) *
+                    len(self._get_port_matches(
+                        rule.get('source_port_range_min'),
+                        rule.get('source_port_range_max'))))
+            else:
+                count += 1
+        return count
+
+    def _get_compiled_rules(self, rules):
+        """Return the compiled rules and the flows normalization saved.
+
+        Compiled rules come from the rule cache when possible.
+        """
+        if self.rule_cache is None:
+            return self._compile_rules(rules)
+        key = (sg_conf.use_conjunction, sg_conf.port_range_compression,
+               sg_conf.normalize_rules, get_rules_digest(rules))
+        compiled = self.rule_cache.get(key)
+        if compiled is None:
+            compiled = self._compile_rules(rules)
+            self.rule_cache.put(key, compiled)
+        return compiled
+
+    def _add_flows(self, deferred_sec_br, port, rules=None, ruleset=None):
+        if not rules:
+            rules = port["security_group_rules"]
+        rules = self._get_address_set_rules(rules)
+
+        vlan = self._get_port_vlan(port['id'])
+        if not vlan and ruleset is None:
+            LOG.warn(_('Missing VLAN for port %s') % port['id'])
+            return
+        remote_directions = set()
+        num_flows = 0
+        compiled, saved = self._get_compiled_rules(rules)
+        for direction, remote, flows in compiled:
+            match, action = self._get_direction_match(port, vlan, direction,
+                                                      ruleset, remote)
+            if remote:
+                remote_directions.add(direction)
+            for flow in flows:
+                deferred_sec_br.add_flow(**dict(match, **flow))
+            num_flows += len(flows)
+        LOG.debug("OVSF adding %(flows)s rule flows for port %(port)s, "
+                  "%(saved)s saved by rule normalization",
+                  {'flows': num_flows, 'port': port['id'], 'saved': saved})
+        if ruleset is not None:
+            return
+        # Look up the remote address before the address set rules
+        for direction in remote_directions:
+            flow, action = self._get_direction_match(port, vlan, direction)
+            flow["priority"] = SG_LOW_PRI
+            flow["actions"] = "resubmit(,%s),resubmit(,%s)" % (
+                SG_ADDRSET_TABLES[direction], SG_REMOTE_TABLES[direction])
+            deferred_sec_br.add_flow(**flow)
+
+    def _get_allow_actions(self, table, action):
+        """Return the actions of a flow allowing a new connection.
+
+        The packet goes through the learn table, which installs the
+        reverse flow of its connection, before it is forwarded.
+        """
+        return "resubmit(,%s),%s" % (table, action)
 
     def _get_device_name(self, port):
         return port['id']
 
     def filter_defer_apply_on(self):
+        if not sg_conf.defer_apply:
+            return
         if not self._defer_apply:
             self._defer_apply = True
+            self._defer_thread = threading.current_thread()
+        elif self._defer_thread is not threading.current_thread():
+            # Another caller owns the batch, this one applies its port
+            # operations right away instead of waiting for it to close
+            return
+        self._defer_depth += 1
 
     def filter_defer_apply_off(self):
-        if self._defer_apply:
+        if (not self._defer_apply or
+                self._defer_thread is not threading.current_thread()):
+            return
+        self._defer_depth -= 1
+        if self._defer_depth <= 0:
+            self._defer_depth = 0
             self._defer_apply = False
+            self._defer_thread = None
+            self._apply_deferred_ops()
+
+    def _is_deferred(self):
+        """Return True when port operations of the caller are queued."""
+        return (self._defer_apply and
+                self._defer_thread is threading.current_thread())
+
+    def _discard_deferred_op(self, port_id):
+        # Operations queued by the defer apply owner predate a removal
+        # made outside of its batch, they must not bring the port back
+        if port_id in self._deferred_ops and not self._is_deferred():
+            del self._deferred_ops[port_id]
+
+    def _queue_port_op(self, port_id, op=None, port=None, remove=None):
+        """Queue a port filter operation, collapsing it with earlier ones.
+
+        A port ends up with an optional removal followed by an optional
+        prepare or update with the latest port. The removal is a
+        remove_port flag, an earlier prepare or update is superseded.
+        Like FirewallWorkQueue, a prepare replaces a pending update.
+        """
+        entry = self._deferred_ops.get(port_id)
+        if entry is None:
+            entry = {'remove': None, 'op': None, 'port': None,
+                     'filtered': port_id in self.filtered_ports}
+            self._deferred_ops[port_id] = entry
+        if remove is not None:
+            if (remove and entry['op'] == 'prepare' and
+                    entry['remove'] is None and not entry['filtered']):
+                # Prepared and removed while deferred, nothing to do
+                del self._deferred_ops[port_id]
+                return
+            entry['remove'] = bool(entry['remove']) or remove
+            entry['op'] = None
+            entry['port'] = None
+            return
+        if op == 'update' and entry['remove'] and entry['op'] is None:
+            # The port is gone by then, so is its update
+            return
+        # A prepare stays a prepare, so the port is added. A later
+        # prepare wins over an update, it installs the flows anew.
+        if entry['op'] is None or op == 'prepare':
+            entry['op'] = op
+        entry['port'] = port
+
+    def _apply_deferred_ops(self):
+        """Apply the queued port filter operations as one batch."""
+        ops = self._deferred_ops
+        self._deferred_ops = collections.OrderedDict()
+        if not ops:
+            return
+        LOG.debug("OVSF applying deferred filter operations of %s ports",
+                  len(ops))
+        with self.batch_apply():
+            for remove_port in (True, False):
+                port_ids = [port_id for port_id, entry in ops.iteritems()
+                            if entry['remove'] is remove_port]
+                if port_ids:
+                    self.clean_port_filters(port_ids, remove_port)
+            for entry in ops.itervalues():
+                if entry['op'] == 'prepare':
+                    self.prepare_port_filter(entry['port'])
+                elif entry['op'] == 'update':
+                    self.update_port_filter(entry['port'])
 
     def get_cookie(self, port):
-        return ("0x%x" % (hash(port['id']) & 0xffffffffffffffff))
+        """Return the cookie of a port, allocating it for its flows.
+
+        Removal paths look the cookie up instead, a port which was
+        never programmed has no flows to delete.
+        """
+        return "0x%x" % self.cookies.get(port['id'])
+
+    def _get_port_matches(self, port_min, port_max):
+        """Return the tp_src/tp_dst match values covering a port range."""
+        if port_min is None and port_max is None:
+            return [None]
+        if port_min is None:
+            port_min = port_max
+        if port_max is None:
+            port_max = port_min
+        if not sg_conf.port_range_compression:
+            return xrange(port_min, port_max + 1)
+        return [get_port_mask_match(value, mask)
+                for value, mask in get_port_range_masks(port_min, port_max)]
 
     def add_flow_with_range(self, deferred_sec_br, flow,
                             pr_min=None, pr_max=None,
                             spr_min=None, spr_max=None):
-        if pr_min is None and pr_max is None:
-            pr_min = -1
-            pr_max = -1
-        if spr_min is None and spr_max is None:
-            spr_min = -1
-            spr_max = -1
-
-        for dport, sport in itertools.product(xrange(pr_min, pr_max + 1),
-                                              xrange(spr_min, spr_max + 1)):
-            if dport >= 0:
+        for dport, sport in itertools.product(
+                self._get_port_matches(pr_min, pr_max),
+                self._get_port_matches(spr_min, spr_max)):
+            if dport is not None:
                 flow["tp_dst"] = dport
-            if sport >= 0:
+            if sport is not None:
                 flow["tp_src"] = sport
             deferred_sec_br.add_flow(**flow)
 
 
+class OVSConntrackFirewallDriver(OVSFirewallDriver):
+    """OVSFirewallDriver keeping connection state in OVS conntrack.
+
+    IP packets go through ct() in the zone of their VLAN before any
+    rule. Established and related packets are forwarded right away,
+    rule flows commit new connections instead of learning their reverse
+    flows, so no flow is installed per connection. Needs Open vSwitch
+    2.5 or later with a conntrack capable datapath.
+    """
+
+    def _setup_stateful_flows(self):
+        for proto in ('ip', 'ipv6'):
+            self.sg_br.add_flow(priority=SG_CONNTRACK_PRI,
+                                table=SG_DEFAULT_TABLE_ID,
+                                proto=proto,
+                                ct_state="-trk",
+                                actions="move:NXM_OF_VLAN_TCI[0..11]->"
+                                "NXM_NX_%s[0..11],ct(table=%s,zone=%s)" %
+                                (SG_CT_ZONE_REG.upper(),
+                                 SG_CONNTRACK_TABLE_ID, self._get_ct_zone()))
+        self.sg_br.add_flow(priority=SG_DROP_HIGH_PRI,
+                            table=SG_CONNTRACK_TABLE_ID,
+                            ct_state="+trk+inv",
+                            actions="drop")
+        for ct_state in ("+trk+est", "+trk+rel"):
+            self.sg_br.add_flow(priority=SG_TP_PRI,
+                                table=SG_CONNTRACK_TABLE_ID,
+                                ct_state=ct_state,
+                                actions="normal")
+        # New connections are checked against the rules
+        self.sg_br.add_flow(priority=SG_RULES_PRI,
+                            table=SG_CONNTRACK_TABLE_ID,
+                            ct_state="+trk+new",
+                            actions="resubmit(,%s)" % SG_DEFAULT_TABLE_ID)
+        self.sg_br.add_flow(priority=SG_DROPALL_PRI,
+                            table=SG_CONNTRACK_TABLE_ID,
+                            actions="drop")
+
+    def _add_learn_flows(self, deferred_sec_br, port, vlan):
+        # Connection state lives in conntrack, nothing is learned
+        pass
+
+    def _get_ct_zone(self):
+        return "NXM_NX_%s[0..15]" % SG_CT_ZONE_REG.upper()
+
+    def _get_allow_actions(self, table, action):
+        return "ct(commit,zone=%s),%s" % (self._get_ct_zone(), action)
+
+
+class CookieAllocator(object):
+    """Hands out stable, collision free flow cookies.
+
+    Every owner (a port id) gets the lowest free index under
+    COOKIE_PREFIX, released indexes are kept in a heap so that this
+    does not scan the allocated cookies. The mapping is persisted to
+    state_file so that the agent finds its own flows again after a
+    restart, changes made inside a batch() block are saved once on
+    exit.
+    """
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.cookies = {}
+        self._free = []
+        self._next_index = 1
+        self._batch_depth = 0
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as state:
+                self.cookies = dict((owner, int(cookie))
+                                    for owner, cookie in
+                                    json.load(state).iteritems())
+        except Exception:
+            LOG.exception(_("Unable to load flow cookies from %s"),
+                          self.state_file)
+            self.cookies = {}
+        used = set(cookie & ~COOKIE_PREFIX_MASK
+                   for cookie in self.cookies.itervalues())
+        self._next_index = max(used) + 1 if used else 1
+        self._free = [index for index in xrange(1, self._next_index)
+                      if index not in used]
+        heapq.heapify(self._free)
+
+    def _save(self):
+        if not self.state_file:
+            return
+        if self._batch_depth:
+            self._dirty = True
+            return
+        self._dirty = False
+        try:
+            tmp_file = "%s.tmp" % self.state_file
+            with open(tmp_file, 'w') as state:
+                json.dump(self.cookies, state)
+            os.rename(tmp_file, self.state_file)
+        except Exception:
+            LOG.exception(_("Unable to save flow cookies to %s"),
+                          self.state_file)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Save the cookies changed in the block once, on exit."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._dirty:
+                self._save()
+
+    def get(self, owner):
+        """Return the cookie of owner, allocating one if needed."""
+        cookie = self.cookies.get(owner)
+        if cookie is None:
+            if self._free:
+                index = heapq.heappop(self._free)
+            else:
+                index = self._next_index
+                self._next_index += 1
+            cookie = COOKIE_PREFIX | index
+            self.cookies[owner] = cookie
+            self._save()
+        return cookie
+
+    def lookup(self, owner):
+        """Return the cookie of owner, None if it has none."""
+        return self.cookies.get(owner)
+
+    def release(self, owner):
+        cookie = self.cookies.pop(owner, None)
+        if cookie is not None:
+            heapq.heappush(self._free, cookie & ~COOKIE_PREFIX_MASK)
+            self._save()
+
+    def reset(self):
+        self.cookies = {}
+        self._free = []
+        self._next_index = 1
+        self._save()
+
+
+class FlowRecorder(object):
+    """Bridge stand-in which records added flows by their match."""
+
+    def __init__(self):
+        self.flows = {}
+
+    def add_flow(self, **kwargs):
+        self.flows[get_flow_key(kwargs)] = kwargs
+
+
+class ConjunctionRecorder(FlowRecorder):
+    """Flow recorder joining the actions of flows with the same match."""
+
+    def __init__(self):
+        super(ConjunctionRecorder, self).__init__()
+        self.actions = {}
+
+    def add_flow(self, **kwargs):
+        match = dict(kwargs)
+        action = match.pop('actions')
+        key = get_flow_key(match)
+        actions = self.actions.setdefault(key, [])
+        if action not in actions:
+            actions.append(action)
+        self.flows[key] = dict(match, actions=",".join(actions))
+
+
+class RuleCache(object):
+    """LRU cache of compiled rule lists, counting hits and misses."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        compiled = self.entries.pop(key, None)
+        if compiled is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = compiled
+        return compiled
+
+    def put(self, key, compiled):
+        self.entries[key] = compiled
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+
+class FlowShadow(object):
+    """Flows installed by the driver, indexed for queries and audits.
+
+    Flows belong to an owner, a port or a shared rule set, and are kept
+    by flow key. Owners are indexed by cookie and security group, flows
+    are counted per table. The match keys of the flows of an owner are
+    computed once, for audits.
+    """
+
+    def __init__(self):
+        self.flows = {}
+        self.owner_cookies = {}
+        self.cookies = {}
+        self.owner_groups = {}
+        self.security_groups = {}
+        self.tables = {}
+        self.table_keys = {}
+
+    def set_flows(self, owner, cookie, flows, security_groups=()):
+        self.remove(owner)
+        self.flows[owner] = flows
+        self.owner_cookies[owner] = cookie
+        self.cookies[cookie] = owner
+        self.owner_groups[owner] = tuple(security_groups)
+        for sg in security_groups:
+            self.security_groups.setdefault(sg, set()).add(owner)
+        for table, count in self.get_table_counts(owner).iteritems():
+            self.tables[table] = self.tables.get(table, 0) + count
+
+    def remove(self, owner):
+        if owner not in self.flows:
+            return
+        for table, count in self.get_table_counts(owner).iteritems():
+            self.tables[table] -= count
+            if not self.tables[table]:
+                del self.tables[table]
+        del self.flows[owner]
+        self.table_keys.pop(owner, None)
+        self.cookies.pop(self.owner_cookies.pop(owner), None)
+        for sg in self.owner_groups.pop(owner):
+            owners = self.security_groups[sg]
+            owners.discard(owner)
+            if not owners:
+                del self.security_groups[sg]
+
+    def get_flows(self, owner):
+        return self.flows.get(owner, {}).values()
+
+    def get_table_counts(self, owner):
+        counts = {}
+        for flow in self.flows.get(owner, {}).itervalues():
+            table = flow.get('table', 0)
+            counts[table] = counts.get(table, 0) + 1
+        return counts
+
+    def get_table_keys(self, owner):
+        """Return the match keys of the flows of owner per table."""
+        keys = self.table_keys.get(owner)
+        if keys is None:
+            keys = {}
+            for flow in self.flows.get(owner, {}).itervalues():
+                keys.setdefault(flow.get('table', 0), set()).add(
+                    get_flow_match_key(flow))
+            keys = dict((table, frozenset(table_keys))
+                        for table, table_keys in keys.iteritems())
+            if owner in self.flows:
+                self.table_keys[owner] = keys
+        return keys
+
+    def get_security_group_flow_counts(self):
+        return dict((sg, sum(len(self.flows[owner]) for owner in owners))
+                    for sg, owners in self.security_groups.iteritems())
+
+
+def _get_learn_cookie(cookie):
+    if cookie is None:
+        return ""
+    return "cookie=%s," % cookie
+
+
+def get_flow_key(flow):
+    """Return a hashable identity for a flow dict."""
+    return tuple(sorted(flow.iteritems()))
+
+
+def get_flow_match_key(flow):
+    """Return the priority and match of a flow dict as a comparable key.
+
+    The key equals the one parse_dumped_flow() returns for the flow
+    once installed, cookie, table and actions are not part of it.
+    """
+    fields = []
+    for key, value in flow.iteritems():
+        if key in FLOW_NON_MATCH_KEYS or key in ('cookie', 'table'):
+            continue
+        if key == 'proto':
+            fields.append((value, None))
+        else:
+            fields.append((key, str(value)))
+    return _get_match_key(flow.get('priority', FLOW_ADD_PRIORITY), fields)
+
+
+def parse_dumped_flow(line):
+    """Return the cookie, table and match key of an ovs-ofctl dump line.
+
+    Returns None for lines which are not flows.
+    """
+    head, sep, _actions = line.partition(' actions=')
+    if not sep:
+        return None
+    cookie = None
+    table = 0
+    priority = OFP_DEFAULT_PRIORITY
+    fields = []
+    for field in head.split(','):
+        key, sep, value = field.strip().partition('=')
+        if not key:
+            continue
+        if key == 'cookie':
+            cookie = int(value, 16)
+        elif key == 'table':
+            table = int(value)
+        elif key == 'priority':
+            priority = value
+        elif key not in FLOW_DUMP_STAT_KEYS:
+            fields.append((key, value if sep else None))
+    if cookie is None:
+        return None
+    return cookie, table, _get_match_key(priority, fields)
+
+
+def _get_match_key(priority, fields):
+    match = [('priority', str(int(priority)))]
+    for key, value in fields:
+        if value is not None:
+            value = _normalize_match_value(key, value)
+            if value is None:
+                # Wildcarded, ovs-ofctl does not print it
+                continue
+        match.append((key, value))
+    return tuple(sorted(match))
+
+
+def _normalize_match_value(key, value):
+    """Return a match value in the form ovs-ofctl prints it in."""
+    if key in FLOW_IP_MATCH_KEYS:
+        cidr = netaddr.IPNetwork(value).cidr
+        return str(cidr) if cidr.prefixlen else None
+    if value[:1] in ('+', '-'):
+        # ct_state flags are printed in their own order
+        return ''.join(sorted(re.findall(r'[+-][a-z]+', value)))
+    parts = []
+    for part in value.split('/'):
+        try:
+            parts.append(str(int(part, 16) if part.startswith('0x')
+                             else int(part)))
+        except ValueError:
+            parts.append(part.lower())
+    return '/'.join(parts)
+
+
+def normalize_rules(rules):
+    """Return rules without duplicate and covered rules.
+
+    Remote prefixes of rules which only differ by them are merged. All
+    rules allow traffic into the same learn table, so a rule matching a
+    subset of the traffic of another rule adds nothing.
+    """
+    unique = collections.OrderedDict()
+    for rule in rules:
+        unique.setdefault(tuple(rule.get(key) for key in RULE_MATCH_KEYS),
+                          rule)
+    rules = unique.values()
+    for prefix_key in ('source_ip_prefix', 'dest_ip_prefix'):
+        rules = _merge_rule_prefixes(rules, prefix_key)
+    normalized = []
+    for index, rule in enumerate(rules):
+        for other_index, other in enumerate(rules):
+            # Of two rules covering each other the first one is kept
+            if (other_index != index and _is_rule_covered(rule, other) and
+                    (other_index < index or
+                     not _is_rule_covered(other, rule))):
+                break
+        else:
+            normalized.append(rule)
+    return normalized
+
+
+def _merge_rule_prefixes(rules, prefix_key):
+    """Merge the prefix_key prefixes of rules equal in everything else."""
+    groups = collections.OrderedDict()
+    for rule in rules:
+        if rule.get(prefix_key):
+            key = tuple(rule.get(key) for key in RULE_MATCH_KEYS
+                        if key != prefix_key)
+        else:
+            key = id(rule)
+        groups.setdefault(key, []).append(rule)
+    merged_rules = []
+    for group in groups.itervalues():
+        if len(group) > 1:
+            merged = netaddr.cidr_merge([rule[prefix_key] for rule in group])
+            if len(merged) < len(group):
+                group = [dict(group[0], **{prefix_key: str(cidr)})
+                         for cidr in merged]
+        merged_rules.extend(group)
+    return merged_rules
+
+
+def _is_rule_covered(rule, other):
+    """Return True when other allows all traffic rule allows."""
+    if (rule.get('direction') != other.get('direction') or
+            rule.get('ethertype') != other.get('ethertype')):
+        return False
+    if (other.get('address_set_bit') is not None and
+            other.get('address_set_bit') != rule.get('address_set_bit')):
+        return False
+    other_proto = other.get('protocol')
+    if other_proto is not None:
+        proto = PROTOCOLS.get(rule.get('protocol'), rule.get('protocol'))
+        if proto != PROTOCOLS.get(other_proto, other_proto):
+            return False
+        if proto in (constants.PROTO_NAME_TCP, constants.PROTO_NAME_UDP):
+            if not (_is_port_range_covered(rule, other, 'port_range_min',
+                                           'port_range_max') and
+                    _is_port_range_covered(rule, other,
+                                           'source_port_range_min',
+                                           'source_port_range_max')):
+                return False
+        elif proto == constants.PROTO_NAME_ICMP:
+            # ICMP rules carry the type and code in the port range
+            for key in ('port_range_min', 'port_range_max'):
+                if (other.get(key) is not None and
+                        other.get(key) != rule.get(key)):
+                    return False
+    return (_is_prefix_covered(rule.get('source_ip_prefix'),
+                               other.get('source_ip_prefix')) and
+            _is_prefix_covered(rule.get('dest_ip_prefix'),
+                               other.get('dest_ip_prefix')))
+
+
+def _get_port_range(rule, min_key, max_key):
+    port_min = rule.get(min_key)
+    port_max = rule.get(max_key)
+    if port_min is None and port_max is None:
+        return 0, 0xffff
+    if port_min is None:
+        return port_max, port_max
+    if port_max is None:
+        return port_min, port_min
+    return port_min, port_max
+
+
+def _is_port_range_covered(rule, other, min_key, max_key):
+    port_min, port_max = _get_port_range(rule, min_key, max_key)
+    other_min, other_max = _get_port_range(other, min_key, max_key)
+    return other_min <= port_min and port_max <= other_max
+
+
+def _is_prefix_covered(prefix, other_prefix):
+    if not other_prefix:
+        return True
+    other_net = netaddr.IPNetwork(other_prefix)
+    if other_net.prefixlen == 0:
+        return True
+    if not prefix:
+        return False
+    net = netaddr.IPNetwork(prefix)
+    return (net.version == other_net.version and
+            other_net.first <= net.first and net.last <= other_net.last)
+
+
+def get_rules_digest(rules):
+    """Return a digest of a rule list which ignores the rule order."""
+    rules = sorted(json.dumps(rule, sort_keys=True) for rule in rules)
+    return hashlib.sha1('\n'.join(rules)).hexdigest()
+
+
+def get_flows_digest(flows):
+    """Return a stable 64 bit digest of a set of port flows."""
+    keys = sorted(key for key, flow in flows.iteritems()
+                  if flow.get('table') != SG_STATE_TABLE_ID)
+    return int(hashlib.sha1(repr(keys)).hexdigest()[:16], 16)
+
+
+def get_flow_match(flow, strict=False):
+    """Return the delete_flows arguments matching an installed flow.
+
+    With strict, the priority is kept for delete_flows_strict, which
+    removes that flow only.
+    """
+    match = dict((key, value) for key, value in flow.iteritems()
+                 if key not in FLOW_NON_MATCH_KEYS)
+    if 'cookie' in match:
+        match['cookie'] = "%s/-1" % match['cookie']
+    if strict and 'priority' in flow:
+        match['priority'] = flow['priority']
+    return match
+
+
+def build_flow_str(flow, action):
+    """Return the ovs-ofctl string of a deferred bridge flow action.
+
+    ovs_lib matches no priority on deletes, strict deletes carry it.
+    """
+    if action != 'del_strict':
+        return ovs_lib._build_flow_expr_str(flow, action)
+    priority = flow.pop('priority', None)
+    flow_str = ovs_lib._build_flow_expr_str(flow, 'del')
+    if priority is None:
+        return flow_str
+    return "priority=%s,%s" % (priority, flow_str)
+
+
+def get_port_range_masks(port_min, port_max):
+    """Split a port range into (value, mask) pairs.
+
+    The returned pairs are the smallest set of bitwise matches which
+    together cover exactly the ports in [port_min, port_max].
+    """
+    masks = []
+    while port_min <= port_max:
+        # Largest aligned block starting at port_min which fits the range
+        size = (port_min & -port_min) if port_min else 0x10000
+        while port_min + size - 1 > port_max:
+            size >>= 1
+        masks.append((port_min, 0xffff & ~(size - 1)))
+        port_min += size
+    return masks
+
+
+def get_cookie_masks(cookies):
+    """Split a set of cookies into (value, mask) pairs.
+
+    The returned pairs are the smallest set of bitwise matches which
+    together cover exactly the given cookies.
+    """
+    masks = []
+    cookies = sorted(set(cookies))
+    while cookies:
+        # Run of consecutive cookies starting with the lowest one
+        run = 1
+        while run < len(cookies) and cookies[run] == cookies[0] + run:
+            run += 1
+        low, high = cookies[0], cookies[run - 1]
+        while low <= high:
+            size = low & -low
+            while low + size - 1 > high:
+                size >>= 1
+            masks.append((low, 0xffffffffffffffff & ~(size - 1)))
+            low += size
+        cookies = cookies[run:]
+    return masks
+
+
+def get_port_mask_match(value, mask):
+    """Format a (value, mask) pair as an ovs-ofctl tp_src/tp_dst match."""
+    if mask == 0xffff:
+        return value
+    if mask == 0:
+        return None
+    return "0x%04x/0x%04x" % (value, mask)
+
+
 class OVSFBridge(ovs_lib.OVSBridge):
     def __init__(self, br_name, root_helper, defer_order):
         super(OVSFBridge, self).__init__(br_name, root_helper)
         self.defer_order = defer_order
+        self.flow_stats = {'flows': 0,
+                           'ofctl_calls': 0,
+                           'native_calls': 0,
+                           'seconds': 0.0}
+        self.native = None
+        self._native_retry_at = 0
+        if sg_conf.flow_backend == 'native':
+            self.native = openflow.OpenFlowConnection.for_bridge(br_name)
+        elif sg_conf.flow_backend != 'ofctl':
+            LOG.warn(_("Unknown flow_backend %s, using ofctl"),
+                     sg_conf.flow_backend)
+
+    def deferred(self, **kwargs):
+        return OVSFDeferredBridge(self, **kwargs)
+
+    def _update_flow_stats(self, flows, start, calls='ofctl_calls'):
+        self.flow_stats['flows'] += flows
+        self.flow_stats[calls] += 1
+        self.flow_stats['seconds'] += time.time() - start
+
+    def get_flow_rate(self):
+        """Return the average number of flow mods applied per second."""
+        if not self.flow_stats['seconds']:
+            return 0.0
+        return self.flow_stats['flows'] / self.flow_stats['seconds']
+
+    def _do_native_action_flows(self, action, kwargs_list):
+        """Apply flows over the native connection.
+
+        Returns False when they have to be applied with ovs-ofctl.
+        """
+        if self.native is None or time.time() < self._native_retry_at:
+            return False
+        try:
+            self.native.send_flow_mods(action, kwargs_list)
+        except openflow.NotEncodable as e:
+            LOG.debug("OVSF applying %(action)s flows with ovs-ofctl: "
+                      "%(reason)s", {'action': action, 'reason': e})
+            return False
+        except openflow.OpenFlowError as e:
+            LOG.warn(_("Native flow backend failed, using ovs-ofctl for "
+                       "%(interval)s seconds: %(reason)s"),
+                     {'interval': NATIVE_RETRY_INTERVAL, 'reason': e})
+            self._native_retry_at = time.time() + NATIVE_RETRY_INTERVAL
+            return False
+        return True
+
+    def do_action_flows(self, action, kwargs_list):
+        start = time.time()
+        if self._do_native_action_flows(action, kwargs_list):
+            self._update_flow_stats(len(kwargs_list), start, 'native_calls')
+            return
+        if action == 'del_strict':
+            flow_strs = [build_flow_str(dict(flow), action)
+                         for flow in kwargs_list]
+            self.run_ofctl('del-flows', ['--strict', '-'],
+                           '\n'.join(flow_strs))
+        else:
+            super(OVSFBridge, self).do_action_flows(action, kwargs_list)
+        self._update_flow_stats(len(kwargs_list), start)
+
+    def delete_flows_strict(self, **kwargs):
+        self.do_action_flows('del_strict', [kwargs])
+
+    def do_bundled_action_flows(self, action_flow_tuples):
+        """Apply mixed flow mods as a single atomic OpenFlow bundle."""
+        start = time.time()
+        flow_strs = ["%s %s" % (BUNDLE_COMMANDS[action],
+                                build_flow_str(dict(flow), action))
+                     for action, flow in action_flow_tuples]
+        # run_ofctl only logs failures, the caller needs to know
+        utils.execute(["ovs-ofctl", "add-flows", self.br_name, "--bundle",
+                       "-O", "OpenFlow14", "-"],
+                      root_helper=self.root_helper,
+                      process_input='\n'.join(flow_strs))
+        self._update_flow_stats(len(action_flow_tuples), start)
+
+
+class OVSFDeferredBridge(ovs_lib.DeferredOVSBridge):
+    """Deferred bridge which can join a batch or apply as a bundle."""
+
+    def __init__(self, br, batch=None, **kwargs):
+        super(OVSFDeferredBridge, self).__init__(br, **kwargs)
+        self.batch = batch
+        if not self.full_ordered:
+            self.weights.setdefault('del_strict', self.weights['del'])
+
+    def delete_flows_strict(self, **kwargs):
+        self.action_flow_tuples.append(('del_strict', kwargs))
+
+    def apply_flows(self):
+        if self.batch is not None:
+            self.batch.action_flow_tuples.extend(self.action_flow_tuples)
+            self.action_flow_tuples = []
+            return
+        action_flow_tuples = self.action_flow_tuples
+        if not action_flow_tuples:
+            return
+        flows = self.br.flow_stats['flows']
+        calls = self.br.flow_stats['ofctl_calls']
+        seconds = self.br.flow_stats['seconds']
+        if sg_conf.use_bundle:
+            self.action_flow_tuples = []
+            if not self.full_ordered:
+                action_flow_tuples.sort(key=lambda af: self.weights[af[0]])
+            try:
+                self.br.do_bundled_action_flows(action_flow_tuples)
+            except Exception:
+                LOG.exception(_("Unable to apply %s flows as a bundle, "
+                                "falling back to ovs-ofctl batches"),
+                              len(action_flow_tuples))
+                self.action_flow_tuples = action_flow_tuples
+        if self.action_flow_tuples:
+            super(OVSFDeferredBridge, self).apply_flows()
+        seconds = self.br.flow_stats['seconds'] - seconds
+        LOG.debug("OVSF applied %(flows)s flows in %(calls)s ofctl calls "
+                  "and %(seconds).3f seconds",
+                  {'flows': self.br.flow_stats['flows'] - flows,
+                   'calls': self.br.flow_stats['ofctl_calls'] - calls,
+                   'seconds': seconds})
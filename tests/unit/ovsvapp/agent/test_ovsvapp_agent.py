@@ -15,6 +15,7 @@
 #
 
 import contextlib
+import eventlet
 import mock
 import time
 
@@ -27,6 +28,7 @@ from neutron.plugins.ovsvapp.utils import resource_util
 from neutron.tests.unit.ovsvapp import test
 from neutron.tests.unit.ovsvapp.drivers import fake_manager
 from oslo.config import cfg
+from oslo import messaging
 
 
 class sampleEvent():
@@ -449,6 +451,30 @@ class TestOVSvAppL2Agent(test.TestCase):
                                          self.agent.agent_state)
             self.assertTrue(log_exception.called)
 
+    def test_sample_learn_table_exception(self):
+        with contextlib.nested(
+            mock.patch.object(self.agent.sg_agent, "sample_learn_table",
+                              side_effect=Exception()),
+            mock.patch.object(self.LOG, 'exception'),
+        ) as (sample_fn, log_exception):
+            self.agent._sample_learn_table()
+            self.assertTrue(sample_fn.called)
+            self.assertTrue(log_exception.called)
+
+    def test_reconcile_flows(self):
+        with contextlib.nested(
+            mock.patch.object(self.agent.sg_agent, "reconcile_flows",
+                              side_effect=Exception()),
+            mock.patch.object(self.LOG, 'exception'),
+        ) as (reconcile_fn, log_exception):
+            self.agent.refresh_firewall_required = True
+            self.agent._reconcile_flows()
+            self.assertFalse(reconcile_fn.called)
+            self.agent.refresh_firewall_required = False
+            self.agent._reconcile_flows()
+            self.assertTrue(reconcile_fn.called)
+            self.assertTrue(log_exception.called)
+
     def test_device_create_cluster_mismatch(self):
         device = {'id': "fake_id",
                   'cluster_id': "fake_cluster",
@@ -936,6 +962,34 @@ class TestOVSvAppL2Agent(test.TestCase):
             self.assertIn("fake_port", self.agent.cluster_host_ports)
             self.assertFalse(log_exception.called)
 
+    def test_notify_device_updated_lazy_other_host_filters(self):
+        cfg.CONF.set_override('lazy_other_host_filters', True,
+                              'SECURITYGROUP')
+        cfg.CONF.set_override('security_group_info_rpc', False,
+                              'SECURITYGROUP')
+        self.agent.esx_hostname = 'fakehost-2'
+        sg_agent = self.agent.sg_agent
+        vm = VM("fakevm", [samplePort("fake_port")])
+        port = {'id': "fake_port"}
+        with contextlib.nested(
+            mock.patch.object(self.agent.ovsvapp_rpc,
+                              "update_port_binding"),
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_rules_for_devices',
+                              return_value={"fake_port": port}),
+        ) as (update_port_binding, firewall, rules_fn):
+            firewall.ports = {"fake_port": {}}
+            firewall.pop_staged_port.return_value = port
+            self.agent._notify_device_updated(vm, "fakehost-1")
+            sg_agent.process_work_queue()
+            firewall.stage_port_filter.assert_called_once_with(port)
+            self.assertFalse(firewall.prepare_port_filter.called)
+            self.agent._notify_device_updated(vm, "fakehost-2")
+            firewall.pop_staged_port.assert_called_once_with("fake_port")
+            firewall.prepare_port_filter.assert_called_once_with(port)
+            self.assertEqual(1, firewall.stage_port_filter.call_count)
+
     def test_notify_device_updated_rpc_exception(self):
         self.agent.esx_hostname = 'fakehost-2'
 
@@ -1003,3 +1057,331 @@ class TestOVSvAppL2Agent(test.TestCase):
             self.agent._update_port_bindings()
             self.assertFalse(update_port_binding.called)
             self.assertFalse(log_exception.called)
+
+    def test_process_work_queue_priority(self):
+        cfg.CONF.set_override('security_group_info_rpc', False,
+                              'SECURITYGROUP')
+        sg_agent = self.agent.sg_agent
+        other_devices = ["other-%d" % i for i in range(12)]
+
+        def _rules_for_devices(context, device_ids):
+            return dict((device_id, {'id': device_id})
+                        for device_id in device_ids)
+
+        with contextlib.nested(
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_rules_for_devices',
+                              side_effect=_rules_for_devices),
+        ) as (firewall, rules_fn):
+            firewall.ports = {"boot": {}}
+            sg_agent.queue_port_filters(other_devices,
+                                        ovsvapp_agent.FW_PRIORITY_OTHER_HOST,
+                                        'prepare')
+            sg_agent.queue_port_filters(["local"],
+                                        ovsvapp_agent.FW_PRIORITY_LOCAL_UPDATE)
+            sg_agent.ovsvapp_sg_update({"boot": {'id': "boot"}})
+            # Only the booting VM is filtered right away
+            firewall.prepare_port_filter.assert_called_once_with(
+                {'id': "boot"})
+            self.assertFalse(rules_fn.called)
+            self.assertEqual(13, len(sg_agent.work_queue))
+            sg_agent.process_work_queue()
+            firewall.update_port_filter.assert_called_once_with(
+                {'id': "local"})
+            self.assertEqual([mock.call(mock.ANY, ["local"]),
+                              mock.call(mock.ANY, other_devices[:10]),
+                              mock.call(mock.ANY, other_devices[10:])],
+                             rules_fn.call_args_list)
+            self.assertEqual(13, firewall.prepare_port_filter.call_count)
+            self.assertFalse(sg_agent.firewall_work_pending())
+
+    def test_process_work_queue_rpc_failure(self):
+        cfg.CONF.set_override('security_group_info_rpc', False,
+                              'SECURITYGROUP')
+        sg_agent = self.agent.sg_agent
+        with contextlib.nested(
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_rules_for_devices',
+                              side_effect=Exception()),
+        ) as (firewall, rules_fn):
+            sg_agent.queue_port_filters(["1", "2"],
+                                        ovsvapp_agent.FW_PRIORITY_RESYNC)
+            self.assertRaises(Exception, sg_agent.process_work_queue)
+            self.assertFalse(firewall.update_port_filter.called)
+            # The work is kept for the next try
+            self.assertEqual(2, len(sg_agent.work_queue))
+            self.assertFalse(sg_agent._processing_work)
+
+    def test_process_work_queue_concurrent_call(self):
+        cfg.CONF.set_override('security_group_info_rpc', False,
+                              'SECURITYGROUP')
+        sg_agent = self.agent.sg_agent
+        fetching = eventlet.event.Event()
+        release = eventlet.event.Event()
+
+        def _rules_for_devices(context, device_ids):
+            if not fetching.ready():
+                fetching.send()
+                release.wait()
+            return dict((device_id, {'id': device_id})
+                        for device_id in device_ids)
+
+        with contextlib.nested(
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_rules_for_devices',
+                              side_effect=_rules_for_devices),
+        ) as (firewall, rules_fn):
+            sg_agent.queue_port_filters(["1"],
+                                        ovsvapp_agent.FW_PRIORITY_RESYNC)
+            first = eventlet.spawn(sg_agent.process_work_queue)
+            fetching.wait()
+            sg_agent.queue_port_filters(["2"],
+                                        ovsvapp_agent.FW_PRIORITY_RESYNC)
+            second = eventlet.spawn(sg_agent.process_work_queue)
+            eventlet.sleep(0)
+            # Waits for the pass in progress instead of returning
+            self.assertFalse(second.dead)
+            release.send()
+            second.wait()
+            self.assertEqual([mock.call({'id': "1"}), mock.call({'id': "2"})],
+                             firewall.update_port_filter.call_args_list)
+            first.wait()
+            self.assertFalse(sg_agent.firewall_work_pending())
+
+    def test_security_group_updated_refreshes_unlocked(self):
+        sg_agent = self.agent.sg_agent
+        sg_agent.defer_refresh_firewall = False
+        lock = mock.Mock()
+
+        def _refresh_firewall(devices):
+            # The work queue pass in progress needs the lock
+            self.assertEqual(lock.acquire.call_count,
+                             lock.release.call_count)
+
+        with contextlib.nested(
+            mock.patch.object(ovsvapp_agent, 'ovsvapplock', lock),
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent, 'refresh_firewall',
+                              side_effect=_refresh_firewall),
+        ) as (_lock, firewall, refresh_firewall):
+            firewall.get_ports_for_security_groups.return_value = set(["1"])
+            sg_agent.security_groups_rule_updated(["sg1"])
+            refresh_firewall.assert_called_once_with(set(["1"]))
+            self.assertTrue(lock.acquire.called)
+
+    def test_process_work_queue_security_group_cache(self):
+        cfg.CONF.set_override('security_group_cache', True, 'SECURITYGROUP')
+        sg_agent = self.agent.sg_agent
+        sg_info = _get_sg_info()
+        with contextlib.nested(
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_info_for_devices',
+                              return_value=sg_info),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_rules_for_devices'),
+        ) as (firewall, info_fn, rules_fn):
+            firewall.ports = {"1": {'device': "1",
+                                    'security_groups': ["sg1"]},
+                              "2": {'device': "2",
+                                    'security_groups': ["sg1"]}}
+            firewall.get_ports_for_security_groups.return_value = set(
+                ["1", "2"])
+            sg_agent.prepare_firewall(["1", "2"])
+            info_fn.assert_called_once_with(mock.ANY, ["1", "2"])
+            self.assertEqual(2, firewall.prepare_port_filter.call_count)
+            # A rule update fetches one device of the group only
+            sg_agent.defer_refresh_firewall = False
+            sg_agent.security_groups_rule_updated(["sg1"])
+            self.assertEqual(2, info_fn.call_count)
+            self.assertEqual(1, len(info_fn.call_args[0][1]))
+            self.assertEqual(2, firewall.update_port_filter.call_count)
+            self.assertFalse(rules_fn.called)
+
+    def test_firewall_refresh_needed_coalesced(self):
+        sg_agent = self.agent.sg_agent
+        sg_agent.defer_refresh_firewall = True
+        with contextlib.nested(
+            mock.patch.object(ovsvapp_agent.time, 'time'),
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent, 'process_work_queue'),
+        ) as (time_fn, firewall, process_work_queue):
+            firewall.ports = {"1": {'device': "1",
+                                    'security_groups': ["sg1"],
+                                    'security_group_source_groups': ["sg1"]}}
+            firewall.get_ports_for_security_groups.return_value = set(["1"])
+            for now in (100.0, 100.5, 101.0):
+                time_fn.return_value = now
+                sg_agent.security_groups_rule_updated(["sg1"])
+            time_fn.return_value = 101.5
+            self.assertFalse(sg_agent.firewall_refresh_needed())
+            time_fn.return_value = 102.0
+            self.assertTrue(sg_agent.firewall_refresh_needed())
+            sg_agent.refresh_port_filters(set(["1"]), set())
+            self.assertFalse(sg_agent.firewall_refresh_needed())
+            # A steady stream is refreshed after the maximum delay
+            for now in range(200, 211):
+                time_fn.return_value = now
+                sg_agent.security_groups_member_updated(["sg1"])
+                self.assertEqual(now == 210,
+                                 sg_agent.firewall_refresh_needed())
+            sg_agent.refresh_port_filters(set(["1"]), set())
+            self.assertEqual({'refreshes': 2,
+                              'notifications': 14,
+                              'max_absorbed': 11}, sg_agent.refresh_stats)
+
+    def test_firewall_refresh_unrelated_group_not_recorded(self):
+        sg_agent = self.agent.sg_agent
+        sg_agent.defer_refresh_firewall = True
+        with contextlib.nested(
+            mock.patch.object(ovsvapp_agent.time, 'time'),
+            mock.patch.object(sg_agent, 'firewall'),
+        ) as (time_fn, firewall):
+            time_fn.return_value = 100.0
+            firewall.get_ports_for_security_groups.return_value = set()
+            sg_agent.security_groups_rule_updated(["sg-other"])
+            self.assertIsNone(sg_agent._refresh_first_notified)
+            self.assertEqual(0, sg_agent._refresh_notifications)
+            # A later notification of a used group is still coalesced
+            time_fn.return_value = 200.0
+            firewall.get_ports_for_security_groups.return_value = set(["1"])
+            sg_agent.security_groups_rule_updated(["sg1"])
+            self.assertEqual(set(["1"]), sg_agent.devices_to_refilter)
+            self.assertFalse(sg_agent.firewall_refresh_needed())
+            time_fn.return_value = 201.0
+            self.assertTrue(sg_agent.firewall_refresh_needed())
+
+    def test_process_work_queue_sg_info_fallback(self):
+        sg_agent = self.agent.sg_agent
+        port = {'id': "1", 'security_group_rules': []}
+        with contextlib.nested(
+            mock.patch.object(sg_agent, 'firewall'),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_info_for_devices',
+                              side_effect=messaging.UnsupportedVersion(
+                                  '1.2')),
+            mock.patch.object(sg_agent.plugin_rpc,
+                              'security_group_rules_for_devices',
+                              return_value={"1": port}),
+        ) as (firewall, info_fn, rules_fn):
+            sg_agent.prepare_firewall(["1"])
+            sg_agent.prepare_firewall(["1"])
+            # The compact RPC is not tried again
+            self.assertEqual(1, info_fn.call_count)
+            self.assertEqual(2, rules_fn.call_count)
+            firewall.prepare_port_filter.assert_called_with(port)
+            self.assertFalse(sg_agent.sg_info_rpc_supported)
+
+
+class TestFirewallWorkQueue(test.TestCase):
+
+    def test_add_pop(self):
+        queue = ovsvapp_agent.FirewallWorkQueue()
+        queue.add(["1", "2", "3"], ovsvapp_agent.FW_PRIORITY_RESYNC,
+                  'update')
+        queue.add(["2"], ovsvapp_agent.FW_PRIORITY_BOOT, 'prepare',
+                  {"2": {'id': "2"}})
+        # Keeps the most urgent class and the prepare operation
+        queue.add(["2"], ovsvapp_agent.FW_PRIORITY_OTHER_HOST, 'update')
+        self.assertEqual(3, len(queue))
+        self.assertEqual((ovsvapp_agent.FW_PRIORITY_BOOT,
+                          [("2", 'prepare', None)]), queue.pop(10))
+        self.assertIsNone(queue.pop(10, ovsvapp_agent.FW_PRIORITY_BOOT))
+        self.assertEqual((ovsvapp_agent.FW_PRIORITY_RESYNC,
+                          [("1", 'update', None)]), queue.pop(1))
+        self.assertEqual(1, len(queue))
+
+
+def _get_sg_info():
+    rules = [{'direction': 'ingress', 'ethertype': 'IPv4',
+              'protocol': 'tcp', 'remote_group_id': "sg1"},
+             {'direction': 'egress', 'ethertype': 'IPv4'}]
+    return {'devices': {"1": {'id': "1", 'security_groups': ["sg1"],
+                              'fixed_ips': ["10.0.0.1"],
+                              'security_group_rules': []},
+                        "2": {'id': "2", 'security_groups': ["sg1"],
+                              'fixed_ips': ["10.0.0.2"],
+                              'security_group_rules': []}},
+            'security_groups': {"sg1": rules},
+            'sg_member_ips': {"sg1": {'IPv4': ["10.0.0.1", "10.0.0.2"]}}}
+
+
+class TestSecurityGroupCache(test.TestCase):
+
+    def setUp(self):
+        super(TestSecurityGroupCache, self).setUp()
+        self.cache = ovsvapp_agent.SecurityGroupCache()
+        self.cache.update(_get_sg_info())
+
+    def test_get_device(self):
+        device = self.cache.get_device("1")
+        # Expanded like security_group_rules_for_devices, own IP skipped
+        self.assertEqual([{'direction': 'ingress', 'ethertype': 'IPv4',
+                           'protocol': 'tcp', 'remote_group_id': "sg1",
+                           'source_ip_prefix': "10.0.0.2/32"},
+                          {'direction': 'egress', 'ethertype': 'IPv4'}],
+                         device['security_group_rules'])
+        self.assertEqual(["sg1"], device['security_group_source_groups'])
+        self.assertIsNone(self.cache.get_device("3"))
+
+    def test_get_devices_to_fetch(self):
+        self.assertEqual([], self.cache.get_devices_to_fetch(["1", "2"]))
+        self.assertEqual(["3"], self.cache.get_devices_to_fetch(["1", "3"]))
+        self.cache.invalidate_members(["sg1"])
+        self.assertIsNone(self.cache.get_device("2"))
+        self.assertEqual(["1"], self.cache.get_devices_to_fetch(["1", "2"]))
+        self.cache.update(_get_sg_info())
+        self.cache.invalidate_rules(["sg1"])
+        self.assertEqual(["2"], self.cache.get_devices_to_fetch(["2", "1"]))
+
+    def test_remove_devices(self):
+        self.cache.remove_devices(["1"])
+        self.assertIn("sg1", self.cache.sg_rules)
+        self.cache.remove_devices(["2"])
+        self.assertEqual({}, self.cache.sg_rules)
+        self.assertEqual({}, self.cache.sg_member_ips)
+
+    def test_remove_devices_remote_groups(self):
+        rules = [{'direction': 'ingress', 'ethertype': 'IPv4',
+                  'remote_group_id': "sg3"}]
+        self.cache.update({'devices': {"3": {'id': "3",
+                                             'security_groups': ["sg2"]}},
+                           'security_groups': {"sg2": rules},
+                           'sg_member_ips': {"sg3": {'IPv4': ["10.0.1.1"]}}})
+        self.assertEqual({"sg1": set(["1", "2"]), "sg2": set(["3"])},
+                         self.cache.sg_devices)
+        self.assertEqual({"sg1": set(["sg1"]), "sg3": set(["sg2"])},
+                         self.cache.remote_group_refs)
+        self.cache.remove_devices(["3"])
+        # Only the groups of the removed device and its remote group go
+        self.assertEqual(["sg1"], self.cache.sg_rules.keys())
+        self.assertEqual(["sg1"], self.cache.sg_member_ips.keys())
+        self.assertEqual({"sg1": set(["sg1"])},
+                         self.cache.remote_group_refs)
+
+
+class TestRpcBatchSizer(test.TestCase):
+
+    def test_record(self):
+        sizer = ovsvapp_agent.RpcBatchSizer()
+        self.assertEqual(ovsvapp_agent.FW_WORK_CHUNK_SIZE, sizer.size)
+        # Fast RPCs at most double the size, up to rpc_batch_max_size
+        sizer.record(10, 0.01, 100)
+        self.assertEqual(20, sizer.size)
+        for _i in range(5):
+            sizer.record(sizer.size, 0.0, 10 * sizer.size)
+        self.assertEqual(100, sizer.size)
+        # Slow RPCs shrink it towards rpc_batch_target_seconds
+        sizer.record(100, 50.0, 1000)
+        self.assertTrue(sizer.size < 100)
+        for _i in range(20):
+            sizer.record(sizer.size, 0.5 * sizer.size, 10 * sizer.size)
+        self.assertEqual(2, sizer.size)
+
+    def test_record_max_rules(self):
+        sizer = ovsvapp_agent.RpcBatchSizer()
+        sizer.record(10, 0.0, 100000)
+        self.assertEqual(2, sizer.size)
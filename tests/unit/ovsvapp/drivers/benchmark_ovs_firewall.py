@@ -0,0 +1,246 @@
+# Copyright (c) 2014 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""Benchmark of the OVS firewall driver against a recording bridge.
+
+Representative rule sets are run through prepare, update and clean of
+many ports. For every phase the flow mods generated, the flow mod
+batches issued, the flows left on the bridge, the wall time and the
+peak memory of the process are reported:
+
+    python -m neutron.tests.unit.ovsvapp.drivers.benchmark_ovs_firewall \\
+        --ports 1,100,1000,5000 --set use_conjunction=true
+"""
+
+import argparse
+import contextlib
+import json
+import mock
+from neutron.plugins.ovsvapp.drivers import ovs_firewall as ovs_fw
+from neutron.tests.unit.ovsvapp.drivers import fake_bridge
+from oslo.config import cfg
+import resource
+import sys
+import time
+
+PHASES = ('prepare', 'update', 'clean')
+# Rule added to every port by the update phase
+UPDATE_RULE = {'direction': 'ingress',
+               'ethertype': 'IPv4',
+               'protocol': 'udp',
+               'port_range_min': 5000,
+               'port_range_max': 5000,
+               'source_ip_prefix': '192.168.0.0/16'}
+
+
+def _rule(direction, protocol, port_min=None, port_max=None, prefix=None):
+    rule = {'direction': direction,
+            'ethertype': 'IPv4',
+            'protocol': protocol}
+    if port_min is not None:
+        rule['port_range_min'] = port_min
+        rule['port_range_max'] = port_max
+    if prefix:
+        if direction == 'ingress':
+            rule['source_ip_prefix'] = prefix
+        else:
+            rule['dest_ip_prefix'] = prefix
+    return rule
+
+
+def get_port_range_rules():
+    """Wide and unaligned port ranges, in both directions."""
+    return [_rule('ingress', 'tcp', 1024, 65535),
+            _rule('ingress', 'udp', 10000, 20000, '10.0.0.0/8'),
+            _rule('ingress', 'tcp', 1, 1023, '172.16.0.0/12'),
+            _rule('egress', 'tcp', 1, 65535),
+            _rule('egress', 'udp', 53, 53),
+            _rule('egress', 'icmp')]
+
+
+def get_remote_cidr_rules():
+    """Rules of many remote CIDRs, as expanded remote group members."""
+    rules = [_rule('ingress', 'tcp', 22, 22, '10.%d.%d.0/24' % (i / 8, i))
+             for i in range(64)]
+    rules.extend(_rule('ingress', 'tcp', 443, 443,
+                       '20.0.%d.%d/32' % (i / 250, i % 250 + 1))
+                 for i in range(500))
+    rules.append(_rule('egress', 'ip'))
+    return rules
+
+
+def get_address_pair_rules():
+    return [_rule('ingress', 'tcp', 80, 80),
+            _rule('ingress', 'icmp'),
+            _rule('egress', 'ip')]
+
+
+def get_address_pairs(index, count=32):
+    return [{'mac_address': '02:00:%02x:%02x:%02x:%02x' % (
+                index >> 8 & 0xff, index & 0xff, i >> 8 & 0xff, i & 0xff),
+             'ip_address': '30.%d.%d.%d' % (index >> 8 & 0xff, index & 0xff,
+                                            i + 1)}
+            for i in range(count)]
+
+
+SCENARIOS = {'port_ranges': (get_port_range_rules, None),
+             'remote_cidrs': (get_remote_cidr_rules, None),
+             'address_pairs': (get_address_pair_rules, get_address_pairs)}
+
+
+def get_ports(scenario, port_count):
+    get_rules, get_pairs = SCENARIOS[scenario]
+    rules = get_rules()
+    ports = []
+    for index in range(port_count):
+        port = {'id': 'port-%d' % index,
+                'device': 'port-%d' % index,
+                'mac_address': '00:50:%02x:%02x:%02x:%02x' % (
+                    index >> 24 & 0xff, index >> 16 & 0xff,
+                    index >> 8 & 0xff, index & 0xff),
+                'network_id': 'net-%d' % (index % 16),
+                'segmentation_id': index % 4000 + 1,
+                'security_groups': ['sg-%s' % scenario],
+                'security_group_source_groups': [],
+                'security_group_rules': rules}
+        if get_pairs:
+            port['allowed_address_pairs'] = get_pairs(index)
+        ports.append(port)
+    return ports
+
+
+def create_driver(driver_class=ovs_fw.OVSFirewallDriver):
+    """Create a firewall driver programming a recording fake bridge."""
+    cfg.CONF.set_override('security_bridge', 'br-fake:fake_if',
+                          'SECURITYGROUP')
+    cfg.CONF.set_override('cookie_state_file', None, 'SECURITYGROUP')
+    with contextlib.nested(
+        mock.patch.object(ovs_fw.OVSFBridge, 'get_port_ofport',
+                          return_value=1),
+        mock.patch.object(driver_class, 'setup_base_flows'),
+        mock.patch.object(driver_class, 'setup_learn_table_limits')
+                          ):
+        driver = driver_class()
+    driver.sg_br = fake_bridge.FakeOVSFBridge()
+    driver.setup_learn_table_limits()
+    driver.setup_base_flows()
+    return driver
+
+
+@contextlib.contextmanager
+def firewall_batch(driver, batch):
+    """Group the port operations like the agent does."""
+    if not batch:
+        yield
+        return
+    with driver.batch_apply():
+        with driver.defer_apply():
+            yield
+
+
+def _run_phase(driver, phase, ports, batch):
+    if phase == 'prepare':
+        driver.add_ports_to_filter(ports)
+    with firewall_batch(driver, batch):
+        for port in ports:
+            if phase == 'prepare':
+                driver.prepare_port_filter(port)
+            elif phase == 'update':
+                driver.update_port_filter(port)
+            else:
+                driver.remove_port_filter(port['id'])
+
+
+def run_benchmark(scenario, port_count, batch=True,
+                  driver_class=ovs_fw.OVSFirewallDriver):
+    """Run the phases of a scenario, returning the results of each."""
+    driver = create_driver(driver_class)
+    bridge = driver.sg_br
+    ports = get_ports(scenario, port_count)
+    results = []
+    for phase in PHASES:
+        if phase == 'update':
+            ports = [dict(port, security_group_rules=(
+                port['security_group_rules'] + [UPDATE_RULE]))
+                for port in ports]
+        flows = bridge.flow_stats['flows']
+        batches = bridge.get_batch_count()
+        start = time.time()
+        _run_phase(driver, phase, ports, batch)
+        results.append({
+            'scenario': scenario,
+            'phase': phase,
+            'ports': port_count,
+            'flows': bridge.flow_stats['flows'] - flows,
+            'batches': bridge.get_batch_count() - batches,
+            'installed': bridge.get_flow_count(),
+            'seconds': time.time() - start,
+            # Kilobytes on Linux, the peak of the whole process so far
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    return results
+
+
+def _parse_override(option):
+    name, _sep, value = option.partition('=')
+    if value.lower() in ('true', 'false'):
+        value = value.lower() == 'true'
+    elif value.isdigit():
+        value = int(value)
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ports', default='1,100,1000,5000',
+                        help='Comma separated port counts to run')
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='Scenario to run, all by default')
+    parser.add_argument('--no-batch', dest='batch', action='store_false',
+                        help='Apply every port operation on its own')
+    parser.add_argument('--conntrack', action='store_true',
+                        help='Benchmark the conntrack firewall driver')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='OPTION=VALUE',
+                        help='Override a SECURITYGROUP option')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args(argv)
+    for option in args.set:
+        name, value = _parse_override(option)
+        cfg.CONF.set_override(name, value, 'SECURITYGROUP')
+    driver_class = ovs_fw.OVSFirewallDriver
+    if args.conntrack:
+        driver_class = ovs_fw.OVSConntrackFirewallDriver
+    results = []
+    for scenario in args.scenario or sorted(SCENARIOS):
+        for port_count in [int(count) for count in args.ports.split(',')]:
+            results.extend(run_benchmark(scenario, port_count, args.batch,
+                                         driver_class))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    row = "%-14s %-8s %6s %9s %8s %9s %9s %10s"
+    print(row % ('scenario', 'phase', 'ports', 'flows', 'batches',
+                 'installed', 'seconds', 'peak_rss'))
+    for result in results:
+        print(row % (result['scenario'], result['phase'], result['ports'],
+                     result['flows'], result['batches'], result['installed'],
+                     "%.3f" % result['seconds'], result['peak_rss']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# Copyright (c) 2014 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+from neutron.plugins.ovsvapp.drivers import ovs_firewall as ovs_fw
+
+FLOW_COMMANDS = {'add-flows': 'add',
+                 'mod-flows': 'mod',
+                 'del-flows': 'del'}
+FLOW_NON_MATCH_FIELDS = ('hard_timeout', 'idle_timeout', 'cookie')
+
+
+def parse_flow(flow_str):
+    """Split an ovs-ofctl flow string into its fields and actions."""
+    match, _sep, actions = flow_str.partition('actions=')
+    fields = {}
+    for field in match.rstrip(',').split(','):
+        if not field:
+            continue
+        key, sep, value = field.partition('=')
+        fields[key] = value if sep else True
+    return fields, actions
+
+
+def _is_cookie_match(cookie, match):
+    value, _sep, mask = match.partition('/')
+    if mask == '-1' or not mask:
+        mask = 0xffffffffffffffff
+    else:
+        mask = int(mask, 16)
+    return int(cookie, 16) & mask == int(value, 16) & mask
+
+
+class FakeOVSFBridge(ovs_fw.OVSFBridge):
+    """Security bridge test double recording the flow mods it applies.
+
+    Every ovs-ofctl call and bundle is recorded with its number of flow
+    mods, and added flows are kept in a flow table. Deletions and
+    modifications honour the cookie mask and exact field values only,
+    strict deletions remove the flow with the same match and priority.
+    """
+
+    def __init__(self, br_name="br-fake", root_helper="sudo",
+                 defer_order=('del', 'mod', 'add')):
+        super(FakeOVSFBridge, self).__init__(br_name, root_helper,
+                                             defer_order)
+        self.calls = []
+        self.vsctl_calls = []
+        # Flows keyed by their match, priority included, and indexed by
+        # cookie and table
+        self.flows = {}
+        self.cookie_flows = {}
+        self.table_flows = {}
+
+    def get_port_ofport(self, port_name):
+        return 1
+
+    def run_vsctl(self, args, check_error=False):
+        self.vsctl_calls.append(args)
+
+    def run_ofctl(self, cmd, args, process_input=None):
+        flow_strs = (process_input or '').splitlines()
+        self.calls.append((cmd, len(flow_strs)))
+        if cmd == 'dump-flows':
+            return self.dump_flows(args)
+        action = FLOW_COMMANDS.get(cmd)
+        if action == 'del' and '--strict' in args:
+            action = 'del_strict'
+        for flow_str in flow_strs:
+            self._apply_flow(action, flow_str)
+
+    def do_bundled_action_flows(self, action_flow_tuples):
+        self.calls.append(('bundle', len(action_flow_tuples)))
+        for action, flow in action_flow_tuples:
+            self._apply_flow(action, ovs_fw.build_flow_str(dict(flow),
+                                                           action))
+        self._update_flow_stats(len(action_flow_tuples), 0)
+
+    def _apply_flow(self, action, flow_str):
+        fields, actions = parse_flow(flow_str)
+        key = tuple(sorted((field, value)
+                           for field, value in fields.iteritems()
+                           if field not in FLOW_NON_MATCH_FIELDS))
+        if action == 'del_strict':
+            flow = self.flows.get(key)
+            if flow and _is_cookie_match(flow[0].get('cookie', '0x0'),
+                                         fields.get('cookie', '0x0/0')):
+                self._remove_flow(key)
+            return
+        if action == 'add':
+            self._remove_flow(key)
+            self.flows[key] = (fields, actions)
+            self.cookie_flows.setdefault(fields.get('cookie', '0x0'),
+                                         set()).add(key)
+            self.table_flows.setdefault(fields.get('table', '0'),
+                                        set()).add(key)
+            return
+        for key in self._get_matching_flows(fields):
+            if action == 'del':
+                self._remove_flow(key)
+            else:
+                self.flows[key] = (self.flows[key][0], actions)
+
+    def _remove_flow(self, key):
+        if key not in self.flows:
+            return
+        fields = self.flows.pop(key)[0]
+        for index, value in ((self.cookie_flows, fields.get('cookie', '0x0')),
+                             (self.table_flows, fields.get('table', '0'))):
+            index[value].discard(key)
+            if not index[value]:
+                del index[value]
+
+    def _get_matching_flows(self, fields):
+        cookie, _sep, mask = fields.get('cookie', '').partition('/')
+        if cookie and mask in ('', '-1'):
+            keys = self.cookie_flows.get(cookie, ())
+        elif 'table' in fields:
+            keys = self.table_flows.get(fields['table'], ())
+        else:
+            keys = self.flows
+        return [key for key in keys
+                if self._is_match(self.flows[key][0], fields)]
+
+    @staticmethod
+    def _is_match(flow, fields):
+        for field, value in fields.iteritems():
+            if field == 'cookie':
+                if not _is_cookie_match(flow.get('cookie', '0x0'), value):
+                    return False
+            elif flow.get(field) != value:
+                return False
+        return True
+
+    def dump_flows(self, args):
+        fields = {}
+        for arg in args:
+            fields.update(parse_flow(arg)[0])
+        lines = []
+        for key in self._get_matching_flows(fields):
+            flow, actions = self.flows[key]
+            lines.append(" cookie=%s, table=%s, priority=%s actions=%s" %
+                         (flow.get('cookie', '0x0'), flow.get('table', 0),
+                          flow.get('priority'), actions))
+        return '\n'.join(lines)
+
+    def get_flow_count(self):
+        return len(self.flows)
+
+    def get_batch_count(self):
+        """Return the number of flow mod batches, ofctl calls or bundles."""
+        return sum(1 for cmd, flows in self.calls
+                   if cmd in FLOW_COMMANDS or cmd == 'bundle')
+
+    def reset_calls(self):
+        self.calls = []
@@ -0,0 +1,149 @@
+# Copyright (c) 2014 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+from neutron.plugins.ovsvapp.drivers import openflow as of
+import socket
+import struct
+import threading
+
+OFPET_FLOW_MOD_FAILED = 3
+
+
+class FakeFlowMod(object):
+
+    def __init__(self, xid, body):
+        (self.cookie, command, self.idle_timeout, self.hard_timeout,
+         self.priority, buffer_id, out_port, flags,
+         match_len) = struct.unpack(of.NX_FLOW_MOD, body[:32])
+        self.xid = xid
+        self.table = command >> 8
+        self.command = command & 0xff
+        self.match = self._decode_match(body[32:32 + match_len])
+        self.actions = body[32 + match_len + (-match_len % 8):]
+
+    @staticmethod
+    def _decode_match(data):
+        match = {}
+        while data:
+            header = struct.unpack('!I', data[:4])[0]
+            length = header & 0xff
+            field = (header >> 16, (header >> 9) & 0x7f)
+            entry = data[4:4 + length]
+            if header & 0x100:
+                half = length / 2
+                match[field] = (entry[:half], entry[half:])
+            else:
+                match[field] = (entry, None)
+            data = data[4 + length:]
+        return match
+
+    def get_field(self, nxm_field):
+        return self.match.get(nxm_field[:2])
+
+
+class FakeSwitch(object):
+    """OpenFlow switch test double serving a bridge management socket.
+
+    Records the flow mods it receives and keeps a flow table of added
+    flows, deletions only honour the table and the cookie match.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.flow_mods = []
+        self.flows = {}
+        self.connections = 0
+        # Flow mods for which this returns True are rejected
+        self.reject = lambda flow_mod: False
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            try:
+                self._handle(conn)
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    @staticmethod
+    def _recv_exact(conn, length):
+        data = ''
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _handle(self, conn):
+        while True:
+            header = self._recv_exact(conn, of.OFP_HEADER_LEN)
+            if header is None:
+                return
+            version, msg_type, length, xid = struct.unpack(of.OFP_HEADER,
+                                                           header)
+            body = self._recv_exact(conn, length - of.OFP_HEADER_LEN)
+            if msg_type == of.OFPT_HELLO:
+                conn.sendall(struct.pack(of.OFP_HEADER, version, of.OFPT_HELLO,
+                                         of.OFP_HEADER_LEN, xid))
+            elif msg_type == of.OFPT_BARRIER_REQUEST:
+                conn.sendall(struct.pack(of.OFP_HEADER, version,
+                                         of.OFPT_BARRIER_REPLY,
+                                         of.OFP_HEADER_LEN, xid))
+            elif msg_type == of.OFPT_VENDOR:
+                vendor, subtype = struct.unpack('!II', body[:8])
+                if subtype == of.NXT_FLOW_MOD:
+                    self._flow_mod(conn, version, xid,
+                                   FakeFlowMod(xid, body[8:]))
+
+    def _flow_mod(self, conn, version, xid, flow_mod):
+        if self.reject(flow_mod):
+            error = struct.pack('!HH', OFPET_FLOW_MOD_FAILED, 0)
+            conn.sendall(struct.pack(of.OFP_HEADER, version, of.OFPT_ERROR,
+                                     of.OFP_HEADER_LEN + len(error), xid) +
+                         error)
+            return
+        self.flow_mods.append(flow_mod)
+        if flow_mod.command == of.OFPFC_ADD:
+            key = (flow_mod.table, flow_mod.priority,
+                   tuple(sorted(flow_mod.match.items())))
+            self.flows[key] = flow_mod
+        elif flow_mod.command == of.OFPFC_DELETE:
+            cookie = flow_mod.get_field(of.NXM_NX_COOKIE)
+            for key, flow in self.flows.items():
+                if (flow_mod.table != of.OFPTT_ALL and
+                        flow.table != flow_mod.table):
+                    continue
+                if cookie is not None:
+                    value = int(cookie[0].encode('hex'), 16)
+                    mask = int((cookie[1] or '\xff' * 8).encode('hex'), 16)
+                    if flow.cookie & mask != value:
+                        continue
+                del self.flows[key]
@@ -0,0 +1,77 @@
+# Copyright (c) 2014 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import mock
+from neutron.plugins.ovsvapp.drivers import ovs_firewall as ovs_fw
+from neutron.tests import base
+from neutron.tests.unit.ovsvapp.drivers import benchmark_ovs_firewall as bench
+from neutron.tests.unit.ovsvapp.drivers import fake_bridge
+
+
+class TestFakeOVSFBridge(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestFakeOVSFBridge, self).setUp()
+        with mock.patch('neutron.agent.linux.ovs_lib.OVSBridge.__init__',
+                        return_value=None):
+            self.br = fake_bridge.FakeOVSFBridge()
+
+    def test_add_delete_flows(self):
+        with self.br.deferred() as deferred_br:
+            deferred_br.add_flow(table=0, priority=10, cookie='0x1',
+                                 dl_vlan=100, actions='drop')
+            deferred_br.add_flow(table=2, priority=10, cookie='0x1',
+                                 proto='tcp', actions='normal')
+            deferred_br.add_flow(table=0, priority=10, cookie='0x2',
+                                 dl_vlan=200, actions='drop')
+        self.assertEqual(3, self.br.get_flow_count())
+        self.assertEqual([('add-flows', 3)], self.br.calls)
+        self.assertIn("table=2, priority=10 actions=normal",
+                      self.br.dump_flows_for_table(2))
+        self.br.delete_flows(table=0, cookie='0x1/-1')
+        self.assertEqual(2, self.br.get_flow_count())
+        # A strict delete leaves flows of other priorities
+        self.br.delete_flows_strict(table=0, priority=20, cookie='0x2/-1',
+                                    dl_vlan=200)
+        self.assertEqual(2, self.br.get_flow_count())
+        self.br.delete_flows_strict(table=0, priority=10, cookie='0x2/-1',
+                                    dl_vlan=200)
+        self.assertEqual(1, self.br.get_flow_count())
+        self.br.delete_flows(cookie='0x0/0xfffffffffffffffc')
+        self.assertEqual(0, self.br.get_flow_count())
+        self.assertEqual(5, self.br.get_batch_count())
+        self.assertEqual(7, self.br.flow_stats['flows'])
+
+
+class TestOVSFirewallBenchmark(base.BaseTestCase):
+
+    def test_run_benchmark(self):
+        for scenario in bench.SCENARIOS:
+            results = bench.run_benchmark(scenario, 3)
+            self.assertEqual(list(bench.PHASES),
+                             [result['phase'] for result in results])
+            prepare, update, clean = results
+            self.assertTrue(prepare['flows'] > 3)
+            self.assertTrue(update['flows'] > 0)
+            self.assertEqual(1, prepare['batches'])
+            # Only the base flows are left
+            self.assertTrue(0 < clean['installed'] < prepare['installed'])
+
+    def test_run_benchmark_no_batch(self):
+        results = bench.run_benchmark('port_ranges', 2, batch=False,
+                                      driver_class=ovs_fw.
+                                      OVSConntrackFirewallDriver)
+        self.assertEqual(2, results[0]['batches'])
@@ -0,0 +1,165 @@
+# Copyright (c) 2014 Hewlett-Packard Development Company, L.P.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import mock
+import os
+import shutil
+import struct
+import tempfile
+from neutron.plugins.ovsvapp.drivers import openflow as of
+from neutron.plugins.ovsvapp.drivers import ovs_firewall as ovs_fw
+from neutron.tests import base
+from neutron.tests.unit.ovsvapp.drivers import fake_switch
+from oslo.config import cfg
+
+fake_flow = {'table': 0,
+             'priority': 20,
+             'cookie': '0x5347000000000001',
+             'dl_vlan': '100',
+             'dl_dst': '00:11:22:33:44:55',
+             'in_port': 2,
+             'proto': 'tcp',
+             'nw_src': '10.0.0.0/8',
+             'tp_dst': '0x0050/0xfff0',
+             'actions': 'resubmit(,2),output:3'}
+
+
+class TestOpenFlowEncoding(base.BaseTestCase):
+
+    def _decode(self, msg):
+        version, msg_type, length, xid = struct.unpack(of.OFP_HEADER,
+                                                       msg[:8])
+        self.assertEqual(of.OFPT_VENDOR, msg_type)
+        self.assertEqual(len(msg), length)
+        return fake_switch.FakeFlowMod(xid, msg[16:])
+
+    def test_encode_flow_mod_add(self):
+        flow_mod = self._decode(of.encode_flow_mod('add', fake_flow, 7))
+        self.assertEqual(7, flow_mod.xid)
+        self.assertEqual(of.OFPFC_ADD, flow_mod.command)
+        self.assertEqual(0, flow_mod.table)
+        self.assertEqual(20, flow_mod.priority)
+        self.assertEqual(0x5347000000000001, flow_mod.cookie)
+        self.assertEqual(('\x10\x64', '\x1f\xff'),
+                         flow_mod.get_field(of.NXM_OF_VLAN_TCI))
+        self.assertEqual(('\x08\x00', None),
+                         flow_mod.get_field(of.NXM_OF_ETH_TYPE))
+        self.assertEqual(('\x06', None),
+                         flow_mod.get_field(of.NXM_OF_IP_PROTO))
+        self.assertEqual(('\x0a\x00\x00\x00', '\xff\x00\x00\x00'),
+                         flow_mod.get_field(of.NXM_OF_IP_SRC))
+        self.assertEqual(('\x00\x50', '\xff\xf0'),
+                         flow_mod.get_field(of.NXM_OF_TCP_DST))
+        self.assertEqual(24, len(flow_mod.actions))
+
+    def test_encode_flow_mod_delete_cookie(self):
+        flow_mod = self._decode(of.encode_flow_mod(
+            'del', {'cookie': '0x5347000000000001/-1'}, 1))
+        self.assertEqual(of.OFPFC_DELETE, flow_mod.command)
+        self.assertEqual(of.OFPTT_ALL, flow_mod.table)
+        self.assertEqual(('\x53\x47\x00\x00\x00\x00\x00\x01', None),
+                         flow_mod.get_field(of.NXM_NX_COOKIE))
+
+    def test_encode_flow_mod_delete_strict(self):
+        flow_mod = self._decode(of.encode_flow_mod(
+            'del_strict', {'table': 0, 'priority': 20,
+                           'cookie': '0x5347000000000001/-1',
+                           'dl_vlan': 100}, 1))
+        self.assertEqual(of.OFPFC_DELETE_STRICT, flow_mod.command)
+        self.assertEqual(20, flow_mod.priority)
+        self.assertEqual(('\x53\x47\x00\x00\x00\x00\x00\x01', None),
+                         flow_mod.get_field(of.NXM_NX_COOKIE))
+
+    def test_encode_actions(self):
+        self.assertEqual('', of.encode_actions('drop'))
+        self.assertEqual(struct.pack('!HHHH', 0, 8, of.OFPP_NORMAL, 0),
+                         of.encode_actions('normal'))
+        conjunction = of.encode_actions('conjunction(9,2/2)')
+        self.assertEqual((1, 2, 9), struct.unpack('!BBI', conjunction[10:]))
+        load = of.encode_actions('load:5->NXM_NX_REG0[]')
+        self.assertEqual((31, of.nxm_header(*of.NXM_NX_REG[0]), 5),
+                         struct.unpack('!HIQ', load[10:]))
+
+    def test_not_encodable(self):
+        self.assertRaises(of.NotEncodable, of.encode_flow_mod, 'add',
+                          dict(fake_flow, actions='learn(table=5)'), 1)
+        self.assertRaises(of.NotEncodable, of.encode_flow_mod, 'add',
+                          dict(fake_flow, ct_state='+trk'), 1)
+        self.assertRaises(of.NotEncodable, of.encode_flow_mod, 'mod',
+                          fake_flow, 1)
+        self.assertRaises(of.NotEncodable, of.encode_flow_mod, 'add',
+                          dict(fake_flow, proto='ip'), 1)
+
+
+class TestOpenFlowConnection(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestOpenFlowConnection, self).setUp()
+        cfg.CONF.set_override('flow_backend', 'native', 'SECURITYGROUP')
+        self.rundir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.rundir)
+        self.switch = fake_switch.FakeSwitch(os.path.join(self.rundir,
+                                                          'br-fake.mgmt'))
+        self.addCleanup(self.switch.stop)
+        with mock.patch.object(of, 'OVS_RUNDIR', self.rundir):
+            with mock.patch('neutron.agent.linux.ovs_lib.OVSBridge.'
+                            '__init__', return_value=None):
+                self.br = ovs_fw.OVSFBridge("br-fake", "sudo",
+                                            ('del', 'mod', 'add'))
+
+    def test_send_flow_mods(self):
+        conn = self.br.native
+        conn.send_flow_mods('add', [fake_flow, dict(fake_flow, cookie='0x2',
+                                                    tp_dst=443)])
+        self.assertEqual(2, len(self.switch.flows))
+        conn.send_flow_mods('del', [{'cookie': '0x2/-1'}])
+        self.assertEqual(1, len(self.switch.flows))
+        self.assertEqual(1, self.switch.connections)
+
+    def test_send_flow_mods_rejected(self):
+        self.switch.reject = lambda flow_mod: flow_mod.priority == 21
+        self.assertRaises(of.OpenFlowError, self.br.native.send_flow_mods,
+                          'add', [fake_flow, dict(fake_flow, priority=21)])
+        self.assertEqual(1, len(self.switch.flows))
+
+    def test_deferred_bridge_native(self):
+        with mock.patch.object(self.br, 'run_ofctl') as run_ofctl_fn:
+            with self.br.deferred(order=('del', 'mod', 'add')) as deferred_br:
+                deferred_br.add_flow(**fake_flow)
+                deferred_br.delete_flows(cookie='0x1/-1')
+            self.assertFalse(run_ofctl_fn.called)
+        self.assertEqual(2, len(self.switch.flow_mods))
+        self.assertEqual(2, self.br.flow_stats['native_calls'])
+        self.assertEqual(0, self.br.flow_stats['ofctl_calls'])
+
+    def test_deferred_bridge_not_encodable(self):
+        with mock.patch.object(self.br, 'run_ofctl') as run_ofctl_fn:
+            with self.br.deferred() as deferred_br:
+                deferred_br.add_flow(**dict(fake_flow,
+                                            actions='learn(table=5)'))
+            run_ofctl_fn.assert_called_once_with('add-flows', ['-'],
+                                                 mock.ANY)
+        self.assertEqual([], self.switch.flow_mods)
+        self.assertIsNone(self.br.native.sock)
+
+    def test_deferred_bridge_unavailable(self):
+        self.br.native.path = os.path.join(self.rundir, 'missing.mgmt')
+        with mock.patch.object(self.br, 'run_ofctl') as run_ofctl_fn:
+            for _i in range(2):
+                with self.br.deferred() as deferred_br:
+                    deferred_br.add_flow(**fake_flow)
+            self.assertEqual(2, run_ofctl_fn.call_count)
+        self.assertTrue(self.br._native_retry_at)
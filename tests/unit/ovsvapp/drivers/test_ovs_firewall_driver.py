@@ -15,6 +15,9 @@
 
 import contextlib
 import mock
+import os
+import shutil
+import tempfile
 from neutron.plugins.ovsvapp.drivers import ovs_firewall as ovs_fw
 from neutron.tests import base
 from oslo.config import cfg
@@ -43,6 +46,7 @@ class TestOVSFirewallDriver(base.BaseTestCase):
         super(TestOVSFirewallDriver, self).setUp()
         cfg.CONF.set_override('security_bridge',
                               "br-fake:fake_if", 'SECURITYGROUP')
+        cfg.CONF.set_override('cookie_state_file', None, 'SECURITYGROUP')
         with contextlib.nested(
             mock.patch('neutron.agent.linux.ovs_lib.OVSBridge.'
                        'get_port_ofport'),
@@ -50,7 +54,9 @@ class TestOVSFirewallDriver(base.BaseTestCase):
             mock.patch('neutron.plugins.ovsvapp.agent.'
                 'portCache'),
             mock.patch('neutron.plugins.ovsvapp.drivers.ovs_firewall.'
-                       'OVSFirewallDriver.setup_base_flows')
+                       'OVSFirewallDriver.setup_base_flows'),
+            mock.patch('neutron.plugins.ovsvapp.drivers.ovs_firewall.'
+                       'OVSFirewallDriver.setup_learn_table_limits')
                   ):
             self.ovs_firewall = ovs_fw.OVSFirewallDriver()
             self.ovs_firewall.sg_br = mock.Mock()
@@ -261,8 +267,9 @@ class TestOVSFirewallDriver(base.BaseTestCase):
         deferred_obj = mock.Mock()
         with mock.patch.object(deferred_obj, 'delete_flows') as delete_flow_fn:
             self.ovs_firewall.filtered_ports = {"123": fake_port}
+            cookie = self.ovs_firewall.cookies.get("123")
             self.ovs_firewall._remove_flows(deferred_obj, fake_port)
-            self.assertTrue(delete_flow_fn.called)
+            delete_flow_fn.assert_any_call(cookie="0x%x/-1" % cookie)
 
     def test_add_flow_with_range(self):
         deferred_obj = mock.Mock()
@@ -298,3 +305,1120 @@ class TestOVSFirewallDriver(base.BaseTestCase):
         self.assertTrue(self.ovs_firewall._defer_apply)
         self.ovs_firewall.filter_defer_apply_off()
         self.assertFalse(self.ovs_firewall._defer_apply)
+
+    def test_filter_defer_apply_collapses(self):
+        port1 = dict(fake_port, id="1")
+        port2 = dict(fake_port, id="2")
+        port3 = dict(fake_port, id="3")
+        self.ovs_firewall.filtered_ports = {"2": port2, "3": port3}
+        self.ovs_firewall.port_flows = {"2": {}}
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall, 'batch_apply'),
+            mock.patch.object(self.ovs_firewall, '_setup_flows'),
+            mock.patch.object(self.ovs_firewall, '_add_flows'),
+            mock.patch.object(self.ovs_firewall, '_remove_flows'),
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred')
+                              ) as (batch_apply_fn, _setup_flows_fn,
+                                    _add_flows_fn, _remove_flows_fn,
+                                    deferred_fn):
+            with self.ovs_firewall.defer_apply():
+                with self.ovs_firewall.defer_apply():
+                    # Prepared and removed, never applied
+                    self.ovs_firewall.prepare_port_filter(port1)
+                    self.ovs_firewall.remove_port_filter("1")
+                    # Only the last update is applied
+                    self.ovs_firewall.update_port_filter(port2)
+                    self.ovs_firewall.update_port_filter(
+                        dict(port2, security_group_rules=[]))
+                self.ovs_firewall.clean_port_filters(["3"],
+                                                     remove_port=True)
+                self.ovs_firewall.update_port_filter(port3)
+                self.assertFalse(deferred_fn.called)
+                self.assertEqual(["2", "3"],
+                                 list(self.ovs_firewall._deferred_ops))
+            self.assertTrue(batch_apply_fn.called)
+            _add_flows_fn.assert_called_once_with(mock.ANY, mock.ANY)
+            self.assertEqual(
+                [], _add_flows_fn.call_args[0][1]['security_group_rules'])
+            _remove_flows_fn.assert_called_once_with(mock.ANY, port3)
+        self.assertEqual(["2"], self.ovs_firewall.filtered_ports.keys())
+        self.assertFalse(self.ovs_firewall._defer_apply)
+
+    def test_filter_defer_apply_prepare_supersedes_update(self):
+        port = dict(fake_port, id="1")
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall, '_setup_flows'),
+            mock.patch.object(self.ovs_firewall, '_add_flows'),
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred')
+                              ) as (_setup_flows_fn, _add_flows_fn,
+                                    deferred_fn):
+            with self.ovs_firewall.defer_apply():
+                self.ovs_firewall.update_port_filter(port)
+                self.ovs_firewall.prepare_port_filter(port)
+                self.assertEqual(
+                    'prepare', self.ovs_firewall._deferred_ops["1"]['op'])
+            self.assertTrue(_setup_flows_fn.called)
+        self.assertIn("1", self.ovs_firewall.filtered_ports)
+
+    def test_filter_defer_apply_other_thread_not_deferred(self):
+        port = dict(fake_port, id="1")
+        self.ovs_firewall.filtered_ports = {"1": port}
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall, '_remove_flows'),
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred')
+                              ) as (_remove_flows_fn, deferred_fn):
+            with self.ovs_firewall.defer_apply():
+                self.ovs_firewall.update_port_filter(port)
+                other = threading.Thread(
+                    target=self.ovs_firewall.remove_port_filter,
+                    args=("1",))
+                other.start()
+                other.join()
+                # Applied right away, the queued update is dropped
+                _remove_flows_fn.assert_called_once_with(mock.ANY, port)
+                self.assertEqual({}, self.ovs_firewall._deferred_ops)
+                self.assertTrue(self.ovs_firewall._defer_apply)
+            self.assertEqual(1, deferred_fn.call_count)
+        self.assertEqual({}, self.ovs_firewall.filtered_ports)
+        self.assertFalse(self.ovs_firewall._defer_apply)
+
+    def test_get_port_range_masks(self):
+        masks = ovs_fw.get_port_range_masks(1024, 65535)
+        self.assertEqual([(1024, 0xfc00), (2048, 0xf800), (4096, 0xf000),
+                          (8192, 0xe000), (16384, 0xc000), (32768, 0x8000)],
+                         masks)
+        self.assertEqual([(80, 0xffff)], ovs_fw.get_port_range_masks(80, 80))
+        self.assertEqual([(0, 0)], ovs_fw.get_port_range_masks(0, 65535))
+
+    def test_get_port_range_masks_covers_range(self):
+        for port_min, port_max in [(1, 1), (3, 17), (2001, 2009),
+                                   (1000, 1999), (0, 1023)]:
+            covered = set()
+            for value, mask in ovs_fw.get_port_range_masks(port_min,
+                                                           port_max):
+                covered.update(port for port in xrange(65536)
+                               if port & mask == value)
+            self.assertEqual(set(xrange(port_min, port_max + 1)), covered)
+
+    def test_get_cookie_masks(self):
+        prefix = ovs_fw.COOKIE_PREFIX
+        cookies = [prefix | index for index in (4, 5, 6, 7, 9, 12)]
+        masks = ovs_fw.get_cookie_masks(cookies)
+        self.assertEqual([(prefix | 4, 0xfffffffffffffffc),
+                          (prefix | 9, 0xffffffffffffffff),
+                          (prefix | 12, 0xffffffffffffffff)], masks)
+        covered = set(prefix | index for index in xrange(64)
+                      if any((prefix | index) & mask == value
+                             for value, mask in masks))
+        self.assertEqual(set(cookies), covered)
+
+    def test_add_flow_with_range_compressed(self):
+        deferred_obj = mock.Mock()
+        flow = {"proto": "tcp"}
+        self.ovs_firewall.add_flow_with_range(deferred_obj, flow,
+                                              1024, 65535)
+        self.assertEqual(6, deferred_obj.add_flow.call_count)
+        deferred_obj.add_flow.assert_any_call(proto="tcp",
+                                              tp_dst="0x8000/0x8000")
+
+    def test_add_flow_with_range_uncompressed(self):
+        cfg.CONF.set_override('port_range_compression', False,
+                              'SECURITYGROUP')
+        self.addCleanup(cfg.CONF.clear_override, 'port_range_compression',
+                        'SECURITYGROUP')
+        deferred_obj = mock.Mock()
+        flow = {"proto": "tcp"}
+        self.ovs_firewall.add_flow_with_range(deferred_obj, flow,
+                                              2001, 2009, 67, 77)
+        self.assertEqual(99, deferred_obj.add_flow.call_count)
+
+    def _get_conjunction_port(self):
+        rules = []
+        for prefix in ["10.0.0.0/24", "10.0.2.0/24", "10.0.4.0/24",
+                       "10.0.6.5/32"]:
+            for pr_min, pr_max in [(80, 80), (8080, 8081)]:
+                rules.append({"direction": "ingress",
+                              "protocol": "tcp",
+                              "port_range_min": pr_min,
+                              "port_range_max": pr_max,
+                              "ethertype": "IPv4",
+                              "source_ip_prefix": prefix})
+        rules.append({"direction": "egress", "ethertype": "IPv4"})
+        return dict(fake_port, security_group_rules=rules)
+
+    def test_get_conjunction_groups(self):
+        port = self._get_conjunction_port()
+        groups, remaining = self.ovs_firewall._get_conjunction_groups(
+            port["security_group_rules"])
+        self.assertEqual(1, len(groups))
+        direction, dest_ip_prefix, prefixes, port_specs = groups[0]
+        self.assertEqual("ingress", direction)
+        self.assertEqual(4, len(prefixes))
+        self.assertEqual([("tcp", 80, 80, None, None),
+                          ("tcp", 8080, 8081, None, None)], port_specs)
+        self.assertEqual([{"direction": "egress", "ethertype": "IPv4"}],
+                         remaining)
+
+    def test_get_conjunction_groups_small_group(self):
+        rules = self._get_conjunction_port()["security_group_rules"][:4]
+        groups, remaining = self.ovs_firewall._get_conjunction_groups(rules)
+        self.assertEqual([], groups)
+        self.assertEqual(rules, remaining)
+
+    def test_add_flows_conjunction(self):
+        cfg.CONF.set_override('use_conjunction', True, 'SECURITYGROUP')
+        self.addCleanup(cfg.CONF.clear_override, 'use_conjunction',
+                        'SECURITYGROUP')
+        port = self._get_conjunction_port()
+        self.ovs_firewall.filtered_ports = {"123": port}
+        deferred_obj = mock.Mock()
+        self.ovs_firewall._add_flows(deferred_obj, port)
+        actions = [call[1]["actions"]
+                   for call in deferred_obj.add_flow.call_args_list]
+        self.assertEqual(4, actions.count("conjunction(1,1/2)"))
+        self.assertEqual(2, actions.count("conjunction(1,2/2)"))
+        conj_flows = [call[1] for call in deferred_obj.add_flow.call_args_list
+                      if "conj_id" in call[1]]
+        self.assertEqual(1, len(conj_flows))
+        self.assertEqual(1, conj_flows[0]["conj_id"])
+        conj_priorities = set(
+            flow["priority"] for flow in
+            [call[1] for call in deferred_obj.add_flow.call_args_list]
+            if "conj_id" in flow or "conjunction" in flow["actions"])
+        self.assertEqual(set([ovs_fw.SG_CONJ_PRI]), conj_priorities)
+        # 7 conjunctive flows and one plain egress flow instead of 9
+        self.assertEqual(8, deferred_obj.add_flow.call_count)
+
+    def test_add_flows_conjunction_shared_clauses(self):
+        cfg.CONF.set_override('use_conjunction', True, 'SECURITYGROUP')
+        self.addCleanup(cfg.CONF.clear_override, 'use_conjunction',
+                        'SECURITYGROUP')
+        # Keeps the 80-81 rule of 10.0.0.0/24 covered by its 78-81 one
+        cfg.CONF.set_override('normalize_rules', False, 'SECURITYGROUP')
+        self.addCleanup(cfg.CONF.clear_override, 'normalize_rules',
+                        'SECURITYGROUP')
+        rules = []
+        for prefixes, ports in (
+                (["10.0.0.0/24", "10.1.0.0/24", "10.2.0.0/24"],
+                 [(22, 22), (80, 81), (443, 443)]),
+                (["10.0.0.0/24", "10.5.0.0/24", "10.6.0.0/24"],
+                 [(5000, 5000), (6000, 6000), (78, 81)])):
+            for prefix in prefixes:
+                for pr_min, pr_max in ports:
+                    rules.append({"direction": "ingress",
+                                  "protocol": "tcp",
+                                  "port_range_min": pr_min,
+                                  "port_range_max": pr_max,
+                                  "ethertype": "IPv4",
+                                  "source_ip_prefix": prefix})
+        port = dict(fake_port, security_group_rules=rules)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        deferred_obj = mock.Mock()
+        self.ovs_firewall._add_flows(deferred_obj, port)
+        flows = [call[1] for call in deferred_obj.add_flow.call_args_list]
+        matches = [ovs_fw.get_flow_match_key(flow) for flow in flows]
+        self.assertEqual(len(set(matches)), len(matches))
+        # The shared prefix and port mask are clauses of both groups
+        shared = [flow["actions"] for flow in flows
+                  if flow.get("nw_src") == "10.0.0.0/24" or
+                  flow.get("tp_dst") == "0x0050/0xfffe"]
+        self.assertEqual(["conjunction(1,1/2),conjunction(2,1/2)",
+                          "conjunction(1,2/2),conjunction(2,2/2)"],
+                         sorted(shared))
+
+    def test_get_conjunction_groups_egress(self):
+        rules = [dict(rule, direction="egress",
+                      dest_ip_prefix=rule["source_ip_prefix"],
+                      source_ip_prefix=None)
+                 for rule in self._get_conjunction_port()[
+                     "security_group_rules"][:-1]]
+        groups, remaining = self.ovs_firewall._get_conjunction_groups(
+            rules)
+        self.assertEqual(1, len(groups))
+        self.assertEqual("egress", groups[0][0])
+        self.assertEqual(4, len(groups[0][2]))
+        self.assertEqual([], remaining)
+        flows = self.ovs_firewall._compile_conjunction_groups(groups)[0][2]
+        self.assertEqual(4, len([flow for flow in flows if "nw_dst" in flow
+                                 and "nw_src" not in flow]))
+
+    def test_add_flows_rule_cache(self):
+        port1 = dict(fake_port, segmentation_id=100)
+        port2 = dict(fake_port, id="456", segmentation_id=200,
+                     mac_address="00:11:22:33:44:66")
+        self.ovs_firewall.filtered_ports = {"123": port1, "456": port2}
+        cache = self.ovs_firewall.rule_cache
+        with mock.patch.object(self.ovs_firewall, '_compile_rules',
+                               wraps=self.ovs_firewall._compile_rules
+                               ) as compile_fn:
+            flows1 = self.ovs_firewall._get_port_flows(port1)
+            flows2 = self.ovs_firewall._get_port_flows(port2)
+            self.assertEqual(1, compile_fn.call_count)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(0.5, cache.get_hit_rate())
+        self.assertEqual(len(flows1), len(flows2))
+        for flow in flows2.itervalues():
+            if flow['table'] == ovs_fw.SG_DEFAULT_TABLE_ID:
+                self.assertEqual(200, flow['dl_vlan'])
+                self.assertEqual("00:11:22:33:44:66", flow["dl_dst"])
+        self.ovs_firewall.rule_cache = None
+        self.assertEqual(flows1, self.ovs_firewall._get_port_flows(port1))
+
+    def test_normalize_rules(self):
+        tcp_rule = {"direction": "ingress", "protocol": "tcp",
+                    "ethertype": "IPv4", "port_range_min": 80,
+                    "port_range_max": 80}
+        rules = [dict(tcp_rule, source_ip_prefix="10.0.0.0/25"),
+                 dict(tcp_rule, source_ip_prefix="10.0.0.128/25"),
+                 dict(tcp_rule, source_ip_prefix="10.0.0.128/25",
+                      security_group_id="other"),
+                 dict(tcp_rule, port_range_min=1, port_range_max=1024,
+                      source_ip_prefix="172.16.0.0/12"),
+                 dict(tcp_rule, source_ip_prefix="172.16.1.0/24"),
+                 dict(tcp_rule, protocol="udp",
+                      source_ip_prefix="192.168.0.1/32"),
+                 {"direction": "egress", "ethertype": "IPv4"},
+                 dict(tcp_rule, direction="egress",
+                      dest_ip_prefix="10.1.0.0/16")]
+        normalized = ovs_fw.normalize_rules(rules)
+        self.assertEqual([dict(tcp_rule, source_ip_prefix="10.0.0.0/24"),
+                          rules[3], rules[5], rules[6]], normalized)
+
+    def test_add_flows_normalized(self):
+        rule = {"direction": "ingress", "protocol": "tcp",
+                "ethertype": "IPv4", "port_range_min": 22,
+                "port_range_max": 22, "source_ip_prefix": "10.0.0.0/8"}
+        narrow_rule = dict(rule, source_ip_prefix="10.1.0.0/16")
+        port = dict(fake_port, segmentation_id=100,
+                    security_group_rules=[rule, dict(rule), narrow_rule])
+        self.ovs_firewall.filtered_ports = {"123": port}
+        deferred_obj = mock.Mock()
+        self.ovs_firewall._add_flows(deferred_obj, port)
+        self.assertEqual(1, deferred_obj.add_flow.call_count)
+        compiled, saved = self.ovs_firewall._get_compiled_rules(
+            port["security_group_rules"])
+        self.assertEqual(2, saved)
+
+    def test_rule_cache_lru(self):
+        cache = ovs_fw.RuleCache(2)
+        cache.put('a', [])
+        cache.put('b', [])
+        self.assertEqual([], cache.get('a'))
+        cache.put('c', [])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(['a', 'c'], list(cache.entries))
+
+    def _get_rules_port(self, *dports):
+        rules = [{"direction": "ingress",
+                  "protocol": "tcp",
+                  "port_range_min": dport,
+                  "port_range_max": dport,
+                  "ethertype": "IPv4"} for dport in dports]
+        return dict(fake_port, security_group_rules=rules)
+
+    def test_update_port_filter_incremental(self):
+        port = self._get_rules_port(80, 443)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port)
+            # Two rule flows and the state flow
+            self.assertEqual(3, deferred_br.add_flow.call_count)
+            deferred_br.reset_mock()
+
+            self.ovs_firewall.update_port_filter(self._get_rules_port(80, 22))
+            deleted = [call[1] for call in
+                       deferred_br.delete_flows_strict.call_args_list]
+            added = [call[1] for call in
+                     deferred_br.add_flow.call_args_list]
+        self.assertEqual([443], [flow["tp_dst"] for flow in deleted
+                                 if "tp_dst" in flow])
+        self.assertEqual([22], [flow["tp_dst"] for flow in added
+                                if "tp_dst" in flow])
+        self.assertEqual(2, len(deleted))
+        self.assertEqual(2, len(added))
+        self.assertEqual({'updates': 1, 'flows_added': 2,
+                          'flows_removed': 2},
+                         self.ovs_firewall.delta_stats)
+        self.assertEqual(3, len(self.ovs_firewall.port_flows["123"]))
+
+    def test_update_port_filter_unchanged(self):
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port)
+            deferred_br.reset_mock()
+            self.ovs_firewall.update_port_filter(port)
+            self.assertFalse(deferred_br.delete_flows.called)
+            self.assertFalse(deferred_br.add_flow.called)
+
+    def test_apply_flow_delta_strict_deletes(self):
+        wide = {"table": 0, "cookie": "0x1", "proto": "ip",
+                "nw_src": "10.0.0.0/8", "priority": 10, "actions": "normal"}
+        narrow = {"table": 0, "cookie": "0x1", "proto": "tcp",
+                  "nw_src": "10.1.0.0/16", "tp_dst": 80,
+                  "priority": 20, "actions": "normal"}
+        other = {"table": 0, "cookie": "0x1", "proto": "tcp",
+                 "nw_src": "20.0.0.0/8", "tp_dst": 80,
+                 "priority": 20, "actions": "normal"}
+        old_flows = dict((ovs_fw.get_flow_key(flow), flow)
+                         for flow in (wide, narrow, other))
+        new_flows = dict((ovs_fw.get_flow_key(flow), flow)
+                         for flow in (narrow, other))
+        deferred_obj = mock.Mock()
+        added, removed = self.ovs_firewall._apply_flow_delta(
+            deferred_obj, old_flows, new_flows)
+        self.assertEqual((0, 1), (added, removed))
+        # Only the wide flow goes, the narrow one it covers is kept
+        deferred_obj.delete_flows_strict.assert_called_once_with(
+            table=0, cookie="0x1/-1", proto="ip", nw_src="10.0.0.0/8",
+            priority=10)
+        self.assertFalse(deferred_obj.delete_flows.called)
+        self.assertFalse(deferred_obj.add_flow.called)
+
+    def test_cookie_allocator(self):
+        allocator = ovs_fw.CookieAllocator()
+        cookie1 = allocator.get("port1")
+        cookie2 = allocator.get("port2")
+        self.assertNotEqual(cookie1, cookie2)
+        self.assertEqual(cookie1, allocator.get("port1"))
+        self.assertEqual(ovs_fw.COOKIE_PREFIX,
+                         cookie1 & ovs_fw.COOKIE_PREFIX_MASK)
+        allocator.release("port1")
+        self.assertIsNone(allocator.lookup("port1"))
+        self.assertEqual(cookie1, allocator.get("port3"))
+
+    def test_cookie_allocator_persistence(self):
+        state_file = os.path.join(tempfile.mkdtemp(), "cookies.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(state_file))
+        allocator = ovs_fw.CookieAllocator(state_file)
+        cookie = allocator.get("port1")
+        self.assertEqual(cookie,
+                         ovs_fw.CookieAllocator(state_file).lookup("port1"))
+
+    def test_cookie_allocator_reuses_lowest_free(self):
+        allocator = ovs_fw.CookieAllocator()
+        cookies = [allocator.get("port%d" % i) for i in range(4)]
+        allocator.release("port2")
+        allocator.release("port0")
+        self.assertEqual(cookies[0], allocator.get("new1"))
+        self.assertEqual(cookies[2], allocator.get("new2"))
+        self.assertEqual(cookies[3] + 1, allocator.get("new3"))
+
+    def test_cookie_allocator_batch_saves_once(self):
+        state_file = os.path.join(tempfile.mkdtemp(), "cookies.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(state_file))
+        allocator = ovs_fw.CookieAllocator(state_file)
+        with mock.patch.object(ovs_fw.os, 'rename',
+                               wraps=os.rename) as rename_fn:
+            with allocator.batch():
+                for i in range(10):
+                    allocator.get("port%d" % i)
+                allocator.release("port3")
+            self.assertEqual(1, rename_fn.call_count)
+        reloaded = ovs_fw.CookieAllocator(state_file)
+        self.assertEqual(allocator.cookies, reloaded.cookies)
+        self.assertEqual(allocator.lookup("port4") - 1,
+                         reloaded.get("port3"))
+
+    def test_clean_port_filters_unknown_port_no_cookie(self):
+        self.ovs_firewall.filtered_ports = {"new": dict(fake_port,
+                                                        id="new")}
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred'):
+            self.ovs_firewall.clean_port_filters(["new", "unknown"])
+        self.assertIsNone(self.ovs_firewall.cookies.lookup("new"))
+        self.assertIsNone(self.ovs_firewall.cookies.lookup("unknown"))
+
+    def test_get_cookie_stable(self):
+        self.assertEqual(self.ovs_firewall.get_cookie(fake_port),
+                         self.ovs_firewall.get_cookie(dict(fake_port)))
+        self.assertNotEqual(self.ovs_firewall.get_cookie(fake_port),
+                            self.ovs_firewall.get_cookie({'id': '456'}))
+
+    def test_load_installed_flows(self):
+        cookie = self.ovs_firewall.cookies.get("123")
+        stale_cookie = ovs_fw.COOKIE_PREFIX | 0x99
+        dump = ("NXST_FLOW reply (xid=0x4):\n"
+                " cookie=0x%x, duration=2s, table=250, n_packets=0, "
+                "priority=0,metadata=0xabc actions=drop\n"
+                " cookie=0x%x, duration=2s, table=0, n_packets=0, "
+                "priority=20,tcp,tp_dst=80 actions=NORMAL\n"
+                " cookie=0x0, duration=2s, table=0, n_packets=0, "
+                "priority=10,arp actions=NORMAL\n" % (cookie, stale_cookie))
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall.sg_br, 'run_ofctl',
+                              return_value=dump),
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred')
+                              ) as (run_ofctl_fn, deferred_fn):
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall._load_installed_flows()
+            deferred_br.delete_flows.assert_called_once_with(
+                cookie="0x%x/-1" % stale_cookie)
+        self.assertEqual({cookie: 0xabc},
+                         self.ovs_firewall.installed_digests)
+
+    def test_update_port_filter_adopts_installed_flows(self):
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        flows = self.ovs_firewall._get_port_flows(port)
+        cookie = self.ovs_firewall.cookies.lookup("123")
+        self.ovs_firewall.installed_digests = {
+            cookie: ovs_fw.get_flows_digest(flows)}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.update_port_filter(port)
+            self.assertFalse(deferred_br.add_flow.called)
+            self.assertFalse(deferred_br.delete_flows.called)
+        self.assertEqual(flows, self.ovs_firewall.port_flows["123"])
+        self.assertEqual({}, self.ovs_firewall.installed_digests)
+
+    def test_update_port_filter_outdated_installed_flows(self):
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        cookie = self.ovs_firewall.cookies.get("123")
+        self.ovs_firewall.installed_digests = {cookie: 0x1}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.update_port_filter(port)
+            self.assertTrue(deferred_br.add_flow.called)
+            deferred_br.delete_flows.assert_any_call(
+                cookie="0x%x/-1" % cookie)
+
+    def test_remove_stale_flows(self):
+        cookie = self.ovs_firewall.cookies.get("gone")
+        self.ovs_firewall.installed_digests = {cookie: 0x1}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.remove_stale_flows()
+            deferred_br.delete_flows.assert_called_once_with(
+                cookie="0x%x/-1" % cookie)
+        self.assertIsNone(self.ovs_firewall.cookies.lookup("gone"))
+        self.assertEqual({}, self.ovs_firewall.installed_digests)
+
+    def test_batch_apply(self):
+        port1 = self._get_rules_port(80)
+        port2 = dict(self._get_rules_port(443), id="456")
+        self.ovs_firewall.filtered_ports = {"123": port1, "456": port2}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            batch_br = deferred_fn.return_value
+            with self.ovs_firewall.batch_apply():
+                with self.ovs_firewall.batch_apply():
+                    self.ovs_firewall.prepare_port_filter(port1)
+                self.ovs_firewall.prepare_port_filter(port2)
+                self.assertFalse(batch_br.apply_flows.called)
+            batch_br.apply_flows.assert_called_once_with()
+            deferred_fn.assert_any_call(order=('del', 'mod', 'add'))
+            deferred_fn.assert_any_call(full_ordered=True,
+                                        order=('del', 'mod', 'add'),
+                                        batch=batch_br)
+        self.assertIsNone(self.ovs_firewall._batch_br)
+
+    def test_batch_apply_failure(self):
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_fn.return_value.apply_flows.side_effect = Exception()
+            with self.ovs_firewall.batch_apply():
+                self.ovs_firewall.prepare_port_filter(port)
+        self.assertNotIn("123", self.ovs_firewall.port_flows)
+
+    def test_batch_apply_flush_before_removal(self):
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            batch_br = deferred_fn.return_value
+            with self.ovs_firewall.batch_apply():
+                self.ovs_firewall.prepare_port_filter(port)
+                self.ovs_firewall.remove_port_filter("123")
+                self.assertEqual(1, batch_br.apply_flows.call_count)
+            self.assertEqual(2, batch_br.apply_flows.call_count)
+
+    def test_deferred_bridge_joins_batch(self):
+        br = mock.Mock()
+        batch_br = ovs_fw.OVSFDeferredBridge(br)
+        with ovs_fw.OVSFDeferredBridge(br, full_ordered=True,
+                                       batch=batch_br) as deferred_br:
+            deferred_br.add_flow(table=0, priority=1, actions="drop")
+        self.assertFalse(br.do_action_flows.called)
+        self.assertEqual([('add', {'table': 0, 'priority': 1,
+                                   'actions': "drop"})],
+                         batch_br.action_flow_tuples)
+
+    def _get_bridge(self):
+        with mock.patch('neutron.agent.linux.ovs_lib.OVSBridge.__init__',
+                        return_value=None):
+            br = ovs_fw.OVSFBridge("br-fake", "sudo", ('del', 'mod', 'add'))
+        br.br_name = "br-fake"
+        br.root_helper = "sudo"
+        return br
+
+    def test_deferred_bridge_bundle(self):
+        cfg.CONF.set_override('use_bundle', True, 'SECURITYGROUP')
+        br = self._get_bridge()
+        with mock.patch.object(ovs_fw.utils, 'execute') as execute_fn:
+            with br.deferred(order=('del', 'mod', 'add')) as deferred_br:
+                deferred_br.add_flow(table=0, priority=1, actions="drop")
+                deferred_br.delete_flows(table=0, cookie="0x1/-1")
+            execute_fn.assert_called_once_with(
+                ["ovs-ofctl", "add-flows", "br-fake", "--bundle",
+                 "-O", "OpenFlow14", "-"], root_helper="sudo",
+                process_input=mock.ANY)
+            lines = execute_fn.call_args[1]['process_input'].split('\n')
+            self.assertEqual(2, len(lines))
+            self.assertTrue(lines[0].startswith("delete "))
+            self.assertTrue(lines[1].startswith("add "))
+        self.assertEqual(2, br.flow_stats['flows'])
+        self.assertEqual(1, br.flow_stats['ofctl_calls'])
+
+    def test_deferred_bridge_bundle_fallback(self):
+        cfg.CONF.set_override('use_bundle', True, 'SECURITYGROUP')
+        br = self._get_bridge()
+        with contextlib.nested(
+            mock.patch.object(ovs_fw.utils, 'execute',
+                              side_effect=RuntimeError()),
+            mock.patch.object(br, 'run_ofctl')
+                              ) as (execute_fn, run_ofctl_fn):
+            with br.deferred(order=('del', 'mod', 'add')) as deferred_br:
+                deferred_br.add_flow(table=0, priority=1, actions="drop")
+                deferred_br.delete_flows(table=0, cookie="0x1/-1")
+            self.assertEqual(2, run_ofctl_fn.call_count)
+        self.assertEqual(2, br.flow_stats['flows'])
+
+    def _get_ruleset_flows(self, deferred_br, cookie):
+        return [call[1] for call in deferred_br.add_flow.call_args_list
+                if call[1].get('cookie') == "0x%x" % cookie]
+
+    def test_shared_rule_tables(self):
+        cfg.CONF.set_override('shared_rule_tables', True, 'SECURITYGROUP')
+        port1 = self._get_rules_port(80, 443)
+        port2 = dict(self._get_rules_port(443, 80), id="456",
+                     mac_address="00:11:22:33:44:66")
+        self.ovs_firewall.filtered_ports = {"123": port1, "456": port2}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port1)
+            self.ovs_firewall.prepare_port_filter(port2)
+            self.assertEqual(1, len(self.ovs_firewall.rulesets))
+            key = self.ovs_firewall.port_rulesets["123"]
+            self.assertEqual(key, self.ovs_firewall.port_rulesets["456"])
+            ruleset = self.ovs_firewall.rulesets[key]
+            # Two rule flows and the state flow, installed once
+            shared_flows = self._get_ruleset_flows(deferred_br,
+                                                   ruleset['cookie'])
+            self.assertEqual(3, len(shared_flows))
+            rule_flows = [flow for flow in shared_flows
+                          if flow['table'] != ovs_fw.SG_STATE_TABLE_ID]
+            self.assertEqual(ruleset['tag'], rule_flows[0]['reg0'])
+            self.assertEqual(ovs_fw.SG_SHARED_INGRESS_TABLE_ID,
+                             rule_flows[0]['table'])
+            # Ingress and egress classifiers and the state flow per port
+            self.assertEqual(3, len(self.ovs_firewall.port_flows["456"]))
+            classifier = [flow for flow in
+                          self.ovs_firewall.port_flows["456"].itervalues()
+                          if flow['table'] == ovs_fw.SG_DEFAULT_TABLE_ID][0]
+            self.assertIn("load:%s->NXM_NX_REG0[]" % ruleset['tag'],
+                          classifier['actions'])
+
+            self.ovs_firewall.remove_port_filter("123")
+            self.assertEqual(set(["456"]), ruleset['ports'])
+            self.ovs_firewall.remove_port_filter("456")
+            deferred_br.delete_flows.assert_any_call(
+                cookie="0x%x/-1" % ruleset['cookie'])
+        self.assertEqual({}, self.ovs_firewall.rulesets)
+        self.assertIsNone(self.ovs_firewall.cookies.lookup(key))
+
+    def test_shared_rule_tables_rules_changed(self):
+        cfg.CONF.set_override('shared_rule_tables', True, 'SECURITYGROUP')
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port)
+            old_key = self.ovs_firewall.port_rulesets["123"]
+            old_cookie = self.ovs_firewall.rulesets[old_key]['cookie']
+            deferred_br.reset_mock()
+            self.ovs_firewall.update_port_filter(self._get_rules_port(22))
+            new_key = self.ovs_firewall.port_rulesets["123"]
+            self.assertNotEqual(old_key, new_key)
+            self.assertEqual([new_key], self.ovs_firewall.rulesets.keys())
+            deferred_br.delete_flows.assert_any_call(
+                cookie="0x%x/-1" % old_cookie)
+
+    def test_shared_rule_tables_batch_keeps_released_ruleset(self):
+        cfg.CONF.set_override('shared_rule_tables', True, 'SECURITYGROUP')
+        port = self._get_rules_port(80)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred'):
+            self.ovs_firewall.prepare_port_filter(port)
+            old_key = self.ovs_firewall.port_rulesets["123"]
+            with self.ovs_firewall.batch_apply():
+                self.ovs_firewall.update_port_filter(
+                    self._get_rules_port(22))
+                self.assertIn(old_key, self.ovs_firewall.rulesets)
+            self.assertNotIn(old_key, self.ovs_firewall.rulesets)
+            self.assertEqual(1, len(self.ovs_firewall.rulesets))
+
+    def _get_remote_group_port(self, *ips, **kwargs):
+        rules = [{"direction": "ingress",
+                  "protocol": "tcp",
+                  "port_range_min": 22,
+                  "port_range_max": 22,
+                  "ethertype": "IPv4",
+                  "remote_group_id": "sg1",
+                  "source_ip_prefix": "%s/32" % ip} for ip in ips]
+        return dict(fake_port, security_group_rules=rules, **kwargs)
+
+    def _get_address_set_flows(self, deferred_br):
+        cookie = "0x%x" % self.ovs_firewall.cookies.get(
+            ovs_fw.ADDRSET_COOKIE_OWNER)
+        return [call[1] for call in deferred_br.add_flow.call_args_list
+                if call[1].get('cookie') == cookie]
+
+    def test_address_set_tables(self):
+        cfg.CONF.set_override('address_set_tables', True, 'SECURITYGROUP')
+        port1 = self._get_remote_group_port("10.0.0.1", "10.0.0.2")
+        port2 = self._get_remote_group_port("10.0.0.1", "10.0.0.2",
+                                            id="456")
+        self.ovs_firewall.filtered_ports = {"123": port1, "456": port2}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port1)
+            self.ovs_firewall.prepare_port_filter(port2)
+            # Both members in the source and destination tables, once
+            self.assertEqual(4, len(self._get_address_set_flows(deferred_br)))
+            self.assertEqual({"10.0.0.1/32": 1, "10.0.0.2/32": 1},
+                             self.ovs_firewall.address_set_ips)
+            flows = self.ovs_firewall.port_flows["123"].values()
+            rule_flows = [flow for flow in flows
+                          if flow.get('reg1') == "0x1/0x1"]
+            self.assertEqual(1, len(rule_flows))
+            self.assertEqual(ovs_fw.SG_REMOTE_INGRESS_TABLE_ID,
+                             rule_flows[0]['table'])
+            self.assertNotIn('nw_src', rule_flows[0])
+            dispatch_flows = [flow for flow in flows
+                              if flow.get('priority') == ovs_fw.SG_LOW_PRI]
+            self.assertEqual(1, len(dispatch_flows))
+
+            deferred_br.reset_mock()
+            port1 = self._get_remote_group_port("10.0.0.1", "10.0.0.2",
+                                                "10.0.0.3")
+            self.ovs_firewall.update_port_filter(port1)
+            address_set_flows = self._get_address_set_flows(deferred_br)
+            self.assertEqual(2, len(address_set_flows))
+            self.assertEqual("10.0.0.3/32", address_set_flows[0]['nw_src'])
+            self.assertEqual(0, self.ovs_firewall.delta_stats['flows_added'])
+
+            deferred_br.reset_mock()
+            self.ovs_firewall.remove_port_filter("123")
+            self.assertEqual(3, len(self.ovs_firewall.address_set_ips))
+            self.ovs_firewall.remove_port_filter("456")
+            deferred_br.delete_flows.assert_any_call(
+                table=ovs_fw.SG_ADDRSET_SRC_TABLE_ID, proto='ip',
+                nw_src="10.0.0.3/32")
+        self.assertEqual({}, self.ovs_firewall.address_sets)
+        self.assertEqual({}, self.ovs_firewall.address_set_ips)
+
+    def test_address_set_tables_batch_clears_member(self):
+        cfg.CONF.set_override('address_set_tables', True, 'SECURITYGROUP')
+        port = self._get_remote_group_port("10.0.0.1", "10.0.0.2")
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port)
+            with self.ovs_firewall.batch_apply():
+                self.ovs_firewall.update_port_filter(
+                    self._get_remote_group_port("10.0.0.1"))
+                self.assertFalse(deferred_br.delete_flows.called)
+                self.assertEqual(
+                    "load:0x0->NXM_NX_REG1[]",
+                    deferred_br.add_flow.call_args_list[-1][1]['actions'])
+            deferred_br.delete_flows.assert_any_call(
+                table=ovs_fw.SG_ADDRSET_DST_TABLE_ID, proto='ip',
+                nw_dst="10.0.0.2/32")
+        self.assertEqual({"10.0.0.1/32": 1},
+                         self.ovs_firewall.address_set_ips)
+
+    def test_setup_learn_table_limits(self):
+        cfg.CONF.set_override('learn_table_flow_limit', 1000,
+                              'SECURITYGROUP')
+        self.ovs_firewall.sg_br.br_name = "br-fake"
+        self.ovs_firewall.setup_learn_table_limits()
+        args = self.ovs_firewall.sg_br.run_vsctl.call_args[0][0]
+        self.assertIn("flow_limit=1000", args)
+        self.assertIn("overflow_policy=evict", args)
+        self.assertEqual("flow_tables:%s=@ft" % ovs_fw.SG_LEARN_TABLE_ID,
+                         args[-1])
+        cfg.CONF.set_override('learn_table_flow_limit', 0, 'SECURITYGROUP')
+        self.ovs_firewall.setup_learn_table_limits()
+        self.ovs_firewall.sg_br.run_vsctl.assert_called_with(
+            ["remove", "Bridge", "br-fake", "flow_tables",
+             str(ovs_fw.SG_LEARN_TABLE_ID)])
+
+    def test_sample_learn_table(self):
+        cfg.CONF.set_override('learn_table_port_flow_limit', 1,
+                              'SECURITYGROUP')
+        self.ovs_firewall.filtered_ports = {
+            "123": dict(fake_port, segmentation_id=100),
+            "456": dict(fake_port, id="456", segmentation_id=100,
+                        mac_address="00:11:22:33:44:66")}
+        self.ovs_firewall.sg_br.dump_flows_for_table.return_value = (
+            " cookie=0x0, table=5, idle_timeout=7200, priority=20,tcp,"
+            "dl_src=00:11:22:33:44:55,dl_dst=00:11:22:33:44:66 "
+            "actions=output:1\n"
+            " cookie=0x0, table=5, idle_timeout=7200, priority=20,tcp,"
+            "dl_src=00:11:22:33:44:77,dl_dst=00:11:22:33:44:55 "
+            "actions=output:1\n"
+            " cookie=0x0, table=5, idle_timeout=30, priority=20,icmp,"
+            "dl_vlan=100,nw_dst=10.0.0.1,icmp_type=0 actions=output:1\n"
+            " cookie=0x0, table=5, priority=0 actions=drop")
+        with mock.patch.object(self.ovs_firewall,
+                               'flush_learned_flows') as flush_fn:
+            # The ICMP flow without MAC addresses is counted too
+            self.assertEqual(3, self.ovs_firewall.sample_learn_table())
+            flush_fn.assert_called_once_with("123")
+        self.assertEqual({"123": 2, "456": 1},
+                         self.ovs_firewall.learn_stats['ports'])
+
+    def test_flush_learned_flows(self):
+        self.ovs_firewall.filtered_ports = {
+            "123": dict(fake_port, segmentation_id=100)}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.flush_learned_flows("123")
+        self.assertEqual(2, deferred_br.delete_flows.call_count)
+        for call in deferred_br.delete_flows.call_args_list:
+            self.assertEqual(ovs_fw.SG_LEARN_TABLE_ID, call[1]['table'])
+            self.assertEqual("0x0064/0x0fff", call[1]['vlan_tci'])
+
+    def test_learned_flow_cookies(self):
+        cfg.CONF.set_override('learned_flow_cookies', True, 'SECURITYGROUP')
+        port = dict(fake_port, segmentation_id=100)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        cookie = self.ovs_firewall.get_cookie(port)
+        flows = self.ovs_firewall._get_port_flows(port).values()
+        learn_flows = [flow for flow in flows
+                       if flow['table'] == ovs_fw.SG_IP_TABLE_ID]
+        self.assertEqual(12, len(learn_flows))
+        for flow in learn_flows:
+            self.assertEqual(cookie, flow['cookie'])
+            self.assertIn("learn(cookie=%s,table=%s," %
+                          (cookie, ovs_fw.SG_LEARN_TABLE_ID),
+                          flow['actions'])
+        deferred_obj = mock.Mock()
+        self.ovs_firewall._remove_flows(deferred_obj, port)
+        deferred_obj.delete_flows.assert_called_once_with(
+            cookie="%s/-1" % cookie)
+
+    def test_clean_port_filters_learned_flow_cookies(self):
+        cfg.CONF.set_override('learned_flow_cookies', True, 'SECURITYGROUP')
+        ports = {}
+        for port_id in ("1", "2", "3", "4"):
+            ports[port_id] = dict(fake_port, id=port_id, segmentation_id=100)
+            self.ovs_firewall.cookies.get(port_id)
+        self.ovs_firewall.filtered_ports = ports
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.clean_port_filters(["2", "3"],
+                                                 remove_port=True)
+        deferred_br.delete_flows.assert_called_once_with(
+            cookie="0x%x/0x%x" % (ovs_fw.COOKIE_PREFIX | 2,
+                                  0xfffffffffffffffe))
+        self.assertEqual(["1", "4"], sorted(self.ovs_firewall.filtered_ports))
+
+    def test_pipeline_tables(self):
+        cfg.CONF.set_override('pipeline_tables', True, 'SECURITYGROUP')
+        self.ovs_firewall.phy_ofport = 1
+        self.ovs_firewall.patch_ofport = 2
+        self.ovs_firewall.setup_pipeline_flows()
+        flows = [call[1] for call in
+                 self.ovs_firewall.sg_br.add_flow.call_args_list]
+        dispatch = dict((flow['in_port'], flow['actions']) for flow in flows
+                        if flow['table'] == ovs_fw.SG_DEFAULT_TABLE_ID)
+        self.assertEqual({2: "resubmit(,%s)" % ovs_fw.SG_INGRESS_TABLE_ID,
+                          1: "resubmit(,%s)" % ovs_fw.SG_EGRESS_TABLE_ID},
+                         dispatch)
+        port = dict(fake_port, segmentation_id=100)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        for flow in self.ovs_firewall._get_port_flows(port).itervalues():
+            if flow['table'] == ovs_fw.SG_STATE_TABLE_ID:
+                continue
+            self.assertEqual(ovs_fw.SG_INGRESS_TABLE_ID, flow['table'])
+            self.assertNotIn('in_port', flow)
+            self.assertEqual(100, flow['dl_vlan'])
+
+    def test_remove_stale_flows_pipeline_tables(self):
+        cookie = self.ovs_firewall.cookies.get(ovs_fw.PIPELINE_COOKIE_OWNER)
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.remove_stale_flows()
+            deferred_br.delete_flows.assert_called_once_with(
+                cookie="0x%x/-1" % cookie)
+        self.assertIsNone(self.ovs_firewall.cookies.lookup(
+            ovs_fw.PIPELINE_COOKIE_OWNER))
+
+    def _prepare_shadow_ports(self):
+        ports = [dict(fake_port, id=port_id, segmentation_id=100,
+                      security_groups=sgs)
+                 for port_id, sgs in (("1", ["sg1"]), ("2", ["sg1", "sg2"]))]
+        self.ovs_firewall.filtered_ports = dict((port['id'], port)
+                                                for port in ports)
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred'):
+            for port in ports:
+                self.ovs_firewall.prepare_port_filter(port)
+        return ports
+
+    def test_flow_shadow(self):
+        ports = self._prepare_shadow_ports()
+        shadow = self.ovs_firewall.shadow
+        flows = self.ovs_firewall.get_installed_flows("1")
+        self.assertEqual(sorted(self.ovs_firewall.port_flows["1"].values()),
+                         sorted(flows))
+        self.assertEqual({"sg1": 2 * len(flows), "sg2": len(flows)},
+                         self.ovs_firewall.get_security_group_flow_counts())
+        self.assertEqual("1", shadow.cookies[self.ovs_firewall.cookies.get(
+            "1")])
+        self.assertEqual(2, shadow.tables[ovs_fw.SG_STATE_TABLE_ID])
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred'):
+            self.ovs_firewall.remove_port_filter(ports[1]['id'])
+        self.assertEqual({"sg1": len(flows)},
+                         self.ovs_firewall.get_security_group_flow_counts())
+        self.assertEqual(1, shadow.tables[ovs_fw.SG_STATE_TABLE_ID])
+        self.assertEqual([], self.ovs_firewall.get_installed_flows("2"))
+
+    def test_stage_port_filter(self):
+        ports = [dict(fake_port, id=port_id) for port_id in ("1", "2")]
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred'),
+            mock.patch.object(self.ovs_firewall, 'clean_port_filters')
+        ) as (deferred_fn, clean_fn):
+            for port in ports:
+                self.ovs_firewall.stage_port_filter(port)
+            self.assertFalse(deferred_fn.called)
+            self.assertFalse(clean_fn.called)
+            self.assertEqual(["1", "2"],
+                             sorted(self.ovs_firewall.filtered_ports))
+            self.assertEqual(1, len(self.ovs_firewall._staged_rules))
+            self.assertEqual(1, len(self.ovs_firewall.rule_cache.entries))
+            self.assertEqual(ports[0],
+                             self.ovs_firewall.pop_staged_port("1"))
+            self.assertIsNone(self.ovs_firewall.pop_staged_port("1"))
+            # A port with installed flows loses them
+            self.ovs_firewall.port_flows["1"] = {}
+            self.ovs_firewall.stage_port_filter(ports[0])
+            clean_fn.assert_called_once_with(["1"])
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred'):
+            self.ovs_firewall.remove_port_filter("1")
+            self.ovs_firewall.prepare_port_filter(ports[1])
+        self.assertEqual({}, self.ovs_firewall.staged_ports)
+        self.assertEqual({}, self.ovs_firewall._staged_rules)
+
+    def test_get_ports_for_security_groups(self):
+        port1 = dict(fake_port, id="1", security_groups=["sg1"],
+                     security_group_source_groups=["sg2"])
+        port2 = dict(fake_port, id="2", security_groups=["sg1", "sg2"],
+                     security_group_source_groups=[])
+        get_ports = self.ovs_firewall.get_ports_for_security_groups
+        with mock.patch.object(self.ovs_firewall.sg_br, 'deferred'):
+            self.ovs_firewall.prepare_port_filter(port1)
+            self.ovs_firewall.prepare_port_filter(port2)
+            self.assertEqual(set(["1", "2"]), get_ports(["sg1"]))
+            self.assertEqual(set(["2"]), get_ports(["sg2", "sg3"]))
+            self.assertEqual(set(["1"]), get_ports(
+                ["sg2"], 'security_group_source_groups'))
+            self.ovs_firewall.update_port_filter(
+                dict(port1, security_groups=["sg3"]))
+            self.assertEqual(set(["2"]), get_ports(["sg1"]))
+            self.assertEqual(set(["1"]), get_ports(["sg3"]))
+            self.ovs_firewall.remove_port_filter("1")
+            self.ovs_firewall.remove_port_filter("2")
+        self.assertEqual({'security_groups': {},
+                          'security_group_source_groups': {}},
+                         self.ovs_firewall.sg_port_index)
+
+    def _get_dumped_flow(self, flow):
+        match = [value if key == 'proto' else "%s=%s" % (key, value)
+                 for key, value in sorted(flow.iteritems())
+                 if key not in ('cookie', 'table', 'priority', 'actions')]
+        return (" cookie=%s, duration=1s, table=%s, n_packets=0, "
+                "n_bytes=0, priority=%s" %
+                (flow['cookie'], flow['table'], flow['priority']) +
+                "".join("," + field for field in match) +
+                " actions=drop")
+
+    def _get_shadow_dump(self, port_ids=("1", "2")):
+        dump = []
+        for port_id in port_ids:
+            for flow in self.ovs_firewall.port_flows[port_id].itervalues():
+                dump.append(self._get_dumped_flow(flow))
+        return dump
+
+    def _dump_flows(self, dump):
+        def _dump_cookie_flows(cmd, args):
+            value, mask = [int(x, 16) for x in args[0][7:].split('/')]
+            return '\n'.join(
+                line for line in dump
+                if int(ovs_fw.FLOW_COOKIE_RE.search(line).group(1),
+                       16) & mask == value)
+        return _dump_cookie_flows
+
+    def test_audit_flows(self):
+        self._prepare_shadow_ports()
+        dump = self._get_shadow_dump()
+        # A learned flow of port 1 and a missing flow of port 2
+        dump.append(" cookie=%s, table=%s, priority=20 actions=output:1" %
+                    (self.ovs_firewall.get_cookie({'id': "1"}),
+                     ovs_fw.SG_LEARN_TABLE_ID))
+        dump.pop(-2)
+        with mock.patch.object(self.ovs_firewall.sg_br, 'run_ofctl',
+                               side_effect=self._dump_flows(dump)) as \
+                ofctl_fn:
+            self.assertEqual(["2"], self.ovs_firewall.audit_flows())
+            self.assertEqual(
+                [mock.call("dump-flows", ["cookie=0x%x/0x%x" % (
+                    ovs_fw.COOKIE_PREFIX | 1, 0xffffffffffffffff)]),
+                 mock.call("dump-flows", ["cookie=0x%x/0x%x" % (
+                     ovs_fw.COOKIE_PREFIX | 2, 0xffffffffffffffff)])],
+                ofctl_fn.call_args_list)
+
+    def test_reconcile_flows(self):
+        cfg.CONF.set_override('flow_reconcile_batch_size', 1,
+                              'SECURITYGROUP')
+        self._prepare_shadow_ports()
+        dump = self._get_shadow_dump()
+        dump.remove(self._get_dumped_flow(
+            [flow for flow in self.ovs_firewall.port_flows["1"].itervalues()
+             if flow['table'] == ovs_fw.SG_STATE_TABLE_ID][0]))
+        # Port 1 lost its state flow, port 2 has an extra table 0 flow
+        dump.append(" cookie=%s, table=0, priority=99 actions=drop" %
+                    self.ovs_firewall.get_cookie({'id': "2"}))
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall.sg_br, 'run_ofctl',
+                              side_effect=self._dump_flows(dump)),
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred')
+        ) as (ofctl_fn, deferred_fn):
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.assertEqual(["1"], self.ovs_firewall.reconcile_flows())
+            deferred_br.add_flow.assert_called_once_with(
+                **[flow for flow in self.ovs_firewall.port_flows[
+                    "1"].itervalues()
+                   if flow['table'] == ovs_fw.SG_STATE_TABLE_ID][0])
+            self.assertFalse(deferred_br.delete_flows.called)
+            deferred_br.reset_mock()
+            self.assertEqual(["2"], self.ovs_firewall.reconcile_flows())
+            deferred_br.delete_flows.assert_called_once_with(
+                table=0,
+                cookie="0x%x/-1" % (ovs_fw.COOKIE_PREFIX | 2))
+            self.assertEqual(
+                len(self.ovs_firewall.port_flows["2"]) - 1,
+                deferred_br.add_flow.call_count)
+            self.assertEqual(2, ofctl_fn.call_count)
+            self.ovs_firewall._defer_apply = True
+            self.assertEqual([], self.ovs_firewall.reconcile_flows())
+            self.assertEqual(2, ofctl_fn.call_count)
+        self.assertEqual({'audited': 2, 'repaired': 2},
+                         self.ovs_firewall.reconcile_stats)
+
+    def test_parse_dumped_flow(self):
+        flow = dict(table=0, cookie="0x5", priority=20, proto="tcp",
+                    dl_vlan=100, nw_src="10.0.0.5/8",
+                    tp_dst="0x0050/0xfff0", actions="NORMAL")
+        line = (" cookie=0x5, duration=3.5s, table=0, n_packets=2, "
+                "n_bytes=120, idle_age=1, priority=20,tcp,dl_vlan=100,"
+                "nw_src=10.0.0.0/8,tp_dst=0x50/0xfff0 actions=NORMAL")
+        self.assertEqual((5, 0, ovs_fw.get_flow_match_key(flow)),
+                         ovs_fw.parse_dumped_flow(line))
+        self.assertNotEqual(
+            ovs_fw.get_flow_match_key(dict(flow, tp_dst=443)),
+            ovs_fw.get_flow_match_key(flow))
+        self.assertIsNone(
+            ovs_fw.parse_dumped_flow("NXST_FLOW reply (xid=0x4):"))
+
+    def test_reconcile_flows_modified_flow(self):
+        self._prepare_shadow_ports()
+        dump = self._get_shadow_dump(port_ids=("1",))
+        flow = [flow for flow in self.ovs_firewall.port_flows["1"].itervalues()
+                if flow['table'] == 0 and 'nw_src' in flow][0]
+        # Same number of flows, one of them matches another prefix
+        dump[dump.index(self._get_dumped_flow(flow))] = (
+            self._get_dumped_flow(dict(flow, nw_src="160.1.1.0/22")))
+        self.ovs_firewall.shadow.remove("2")
+        with contextlib.nested(
+            mock.patch.object(self.ovs_firewall.sg_br, 'run_ofctl',
+                              side_effect=self._dump_flows(dump)),
+            mock.patch.object(self.ovs_firewall.sg_br, 'deferred')
+        ) as (ofctl_fn, deferred_fn):
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.assertEqual(["1"], self.ovs_firewall.audit_flows())
+            self.assertEqual(["1"], self.ovs_firewall.reconcile_flows())
+            deferred_br.delete_flows.assert_called_once_with(
+                table=0, cookie="0x%x/-1" % (ovs_fw.COOKIE_PREFIX | 1))
+            deferred_br.add_flow.assert_any_call(**flow)
+
+
+class TestOVSConntrackFirewallDriver(base.BaseTestCase):
+    def setUp(self):
+        super(TestOVSConntrackFirewallDriver, self).setUp()
+        cfg.CONF.set_override('security_bridge',
+                              "br-fake:fake_if", 'SECURITYGROUP')
+        cfg.CONF.set_override('cookie_state_file', None, 'SECURITYGROUP')
+        with contextlib.nested(
+            mock.patch('neutron.agent.linux.ovs_lib.OVSBridge.'
+                       'get_port_ofport', return_value=3),
+            mock.patch('neutron.agent.linux.ovs_lib.OVSBridge.__init__',
+                       return_value=None),
+            mock.patch('neutron.plugins.ovsvapp.agent.'
+                'portCache'),
+            mock.patch('neutron.plugins.ovsvapp.drivers.ovs_firewall.'
+                       'OVSFirewallDriver.setup_base_flows'),
+            mock.patch('neutron.plugins.ovsvapp.drivers.ovs_firewall.'
+                       'OVSFirewallDriver.setup_learn_table_limits')
+                  ):
+            self.ovs_firewall = ovs_fw.OVSConntrackFirewallDriver()
+            self.ovs_firewall.sg_br = mock.Mock()
+
+    def test_setup_base_flows(self):
+        with mock.patch.object(self.ovs_firewall,
+                               'add_icmp_learn_flow') as add_icmp_learn_fn:
+            self.ovs_firewall.setup_base_flows()
+            self.assertFalse(add_icmp_learn_fn.called)
+        flows = [call[1] for call in
+                 self.ovs_firewall.sg_br.add_flow.call_args_list]
+        self.assertFalse([flow for flow in flows
+                          if 'learn(' in flow['actions']])
+        ct_flows = [flow for flow in flows if flow.get('ct_state') == "-trk"]
+        self.assertEqual(2, len(ct_flows))
+        self.assertIn("ct(table=%s,zone=NXM_NX_REG6[0..15])" %
+                      ovs_fw.SG_CONNTRACK_TABLE_ID, ct_flows[0]['actions'])
+
+    def test_prepare_port_filter_commits(self):
+        rules = [{"direction": "ingress",
+                  "protocol": "tcp",
+                  "port_range_min": 22,
+                  "port_range_max": 22,
+                  "ethertype": "IPv4"}]
+        port = dict(fake_port, security_group_rules=rules)
+        self.ovs_firewall.filtered_ports = {"123": port}
+        with mock.patch.object(self.ovs_firewall.sg_br,
+                               'deferred') as deferred_fn:
+            deferred_br = deferred_fn.return_value.__enter__.return_value
+            self.ovs_firewall.prepare_port_filter(port)
+            flows = [call[1] for call in deferred_br.add_flow.call_args_list
+                     if call[1].get('tp_dst') == 22]
+            self.assertEqual("ct(commit,zone=NXM_NX_REG6[0..15]),output:3",
+                             flows[0]['actions'])